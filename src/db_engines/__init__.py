@@ -0,0 +1,44 @@
+"""
+Classes and utils for use with common database tools (e.g. MySQL, MongoDB).
+
+Submodules and the names below are imported on first access, so that importing the package is cheap and a process only
+loads the backends it uses (e.g. the MySQL engine never imports pymongo and vice versa). pandas is only imported when
+a DataFrame is built.
+"""
+
+import importlib
+
+
+_LAZY_NAMES = dict(
+    MySQLEngine='mysql_engine',
+    MongoDBEngine='mongodb_engine',
+    DBEngineError='exceptions',
+    MySQLEngineError='exceptions',
+    SQLScriptError='exceptions',
+    MongoDBEngineError='exceptions',
+    AdmissionError='exceptions',
+    AdmissionPolicy='admission_utils',
+    DtypePolicy='dtype_utils',
+    RetryPolicy='retry_utils',
+    MySQLQuery='lazy_query',
+    MongoDBQuery='lazy_query',
+)
+
+__all__ = list(_LAZY_NAMES)
+
+
+def __getattr__(name: str):
+    if name in _LAZY_NAMES:
+        val = getattr(importlib.import_module(f'.{_LAZY_NAMES[name]}', __name__), name)
+    else:
+        try:
+            val = importlib.import_module(f'.{name}', __name__)
+        except ModuleNotFoundError as e:
+            if e.name != f'{__name__}.{name}':
+                raise
+            raise AttributeError(f'module {__name__!r} has no attribute {name!r}') from None
+    globals()[name] = val # later lookups bypass __getattr__
+    return val
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
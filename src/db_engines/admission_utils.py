@@ -0,0 +1,219 @@
+"""Admission control: per-host concurrency limits with priority queueing and an adaptive (AIMD) limit"""
+
+from typing import Optional, Callable, Dict, List, Generator
+from contextlib import contextmanager
+import heapq
+import itertools
+import threading
+import time
+
+from .exceptions import AdmissionError
+from .deadline_utils import Deadline
+
+
+PRIORITIES = dict(interactive=0, batch=1) # lower is admitted first
+
+_local = threading.local() # per-thread priority, see priority()
+
+
+
+class AdmissionPolicy():
+    """
+    Configuration for limiting the number of concurrent operations on a host (see AdmissionController).
+
+    At most 'max_concurrency' operations run at a time, and further ones wait in a queue in order of priority, then
+    arrival. Waiting is bounded by queue_timeout_s and by the operation's deadline, and at most max_queue_len
+    operations may wait (None: unbounded); operations that can't be admitted raise AdmissionError.
+
+    If adaptive is True, the limit adapts to the observed latency between min_concurrency and max_concurrency (AIMD):
+    it grows by one for every 'limit' operations that complete within the target latency, and shrinks by
+    decrease_factor when one is slower or fails because the server is overloaded. The target is target_latency_s or,
+    if not specified, latency_tolerance times the lowest latency seen recently, i.e. the latency of an unloaded server.
+
+    Operations that hold a slot for long (e.g. a MySQL scan or transaction) count against the limit. A thread that
+    already holds a slot is admitted again without queueing, so that it can't wait on itself (e.g. when it makes other
+    calls while consuming a scan); such nested operations may briefly exceed the limit. Waiting for a slot held by
+    another thread can still deadlock (e.g. a scan prefetched by a background thread that waits for the consumer), so
+    queue_timeout_s is finite by default.
+    """
+    def __init__(self,
+                 max_concurrency: int = 16,
+                 min_concurrency: int = 1,
+                 adaptive: bool = False,
+                 target_latency_s: Optional[float] = None,
+                 latency_tolerance: float = 2.0,
+                 decrease_factor: float = 0.9,
+                 queue_timeout_s: Optional[float] = 60.0,
+                 max_queue_len: Optional[int] = None,
+                 default_priority: str = 'interactive'):
+        assert 1 <= min_concurrency <= max_concurrency
+        assert 0 < decrease_factor < 1 and latency_tolerance >= 1
+        assert default_priority in PRIORITIES
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.adaptive = adaptive
+        self.target_latency_s = target_latency_s
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.queue_timeout_s = queue_timeout_s
+        self.max_queue_len = max_queue_len
+        self.default_priority = default_priority
+
+
+@contextmanager
+def priority(name: str) -> Generator[None, None, None]:
+    """Run the engine calls made by this thread inside the context with a priority (see PRIORITIES)"""
+    assert name in PRIORITIES
+    prev = getattr(_local, 'priority', None)
+    _local.priority = name
+    try:
+        yield
+    finally:
+        _local.priority = prev
+
+def get_priority() -> Optional[str]:
+    """Priority set by the calling thread with priority(), if any"""
+    return getattr(_local, 'priority', None)
+
+
+class AdmissionController():
+    """
+    Thread-safe concurrency limiter for one host, see AdmissionPolicy. Wrap each operation in admit().
+    """
+    def __init__(self, policy: AdmissionPolicy):
+        self.policy = policy
+        self._cond = threading.Condition()
+        self._limit = float(policy.max_concurrency)
+        self._num_in_flight = 0
+        self._holders: Dict[int, int] = {} # thread ident -> number of slots it holds
+        self._queue: List[list] = [] # heap of waiting operations' [priority, arrival]
+        self._arrivals = itertools.count()
+        self._min_latency_s: Optional[float] = None
+        self.num_admitted = 0
+        self.num_queued = 0
+        self.num_rejected = 0
+
+    def get_limit(self) -> int:
+        """Current concurrency limit"""
+        return max(self.policy.min_concurrency, int(self._limit))
+
+    @contextmanager
+    def admit(self,
+              priority: Optional[str] = None,
+              deadline: Optional[Deadline] = None,
+              measure: bool = True,
+              is_overload_error: Optional[Callable[[BaseException], bool]] = None) \
+            -> Generator[None, None, None]:
+        """
+        Context in which an operation runs once admitted. If measure is True, its latency feeds the adaptive limit
+        (leave it False for long-lived operations like scans). Errors for which is_overload_error() is True count as
+        overload signals. The calling thread holds the slot until the context exits, even if another thread exits it
+        (e.g. a generator closed elsewhere).
+        """
+        holder = threading.get_ident()
+        self._acquire(priority, deadline, holder=holder)
+        t0 = time.monotonic()
+        overloaded = False
+        try:
+            yield
+        except BaseException as e:
+            overloaded = is_overload_error is not None and is_overload_error(e)
+            raise
+        finally:
+            self._release(time.monotonic() - t0 if measure else None, overloaded, holder=holder)
+
+    def _acquire(self,
+                 priority: Optional[str],
+                 deadline: Optional[Deadline],
+                 holder: Optional[int] = None):
+        if priority is None:
+            priority = get_priority() or self.policy.default_priority
+        timeout_s = self.policy.queue_timeout_s
+        if deadline is not None:
+            timeout_s = deadline.remaining_s() if timeout_s is None else min(timeout_s, deadline.remaining_s())
+
+        with self._cond:
+            if self._holders.get(holder, 0) > 0 or (not self._queue and self._num_in_flight < self.get_limit()):
+                self._add_in_flight(holder) # re-entrant or fast path
+                return
+            if self.policy.max_queue_len is not None and len(self._queue) >= self.policy.max_queue_len:
+                self.num_rejected += 1
+                raise AdmissionError('Admission queue is full.')
+
+            entry = [PRIORITIES[priority], next(self._arrivals)]
+            heapq.heappush(self._queue, entry)
+            self.num_queued += 1
+            t_end = None if timeout_s is None else time.monotonic() + timeout_s
+            while not (self._queue[0] is entry and self._num_in_flight < self.get_limit()):
+                remaining = None if t_end is None else t_end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+                    self._cond.notify_all() # the next waiter may now be first
+                    self.num_rejected += 1
+                    raise AdmissionError(f'Not admitted within {timeout_s:.3f} s.')
+                self._cond.wait(remaining)
+            heapq.heappop(self._queue)
+            self._add_in_flight(holder)
+            self._cond.notify_all()
+
+    def _add_in_flight(self, holder: Optional[int]):
+        self._num_in_flight += 1
+        self.num_admitted += 1
+        if holder is not None:
+            self._holders[holder] = self._holders.get(holder, 0) + 1
+
+    def _release(self,
+                 latency_s: Optional[float],
+                 overloaded: bool,
+                 holder: Optional[int] = None):
+        with self._cond:
+            self._num_in_flight -= 1
+            if holder is not None:
+                self._holders[holder] -= 1
+                if self._holders[holder] == 0:
+                    del self._holders[holder]
+            if self.policy.adaptive:
+                self._update_limit(latency_s, overloaded)
+            self._cond.notify_all()
+
+    def _update_limit(self,
+                      latency_s: Optional[float],
+                      overloaded: bool):
+        """AIMD update of the limit after an operation completes"""
+        policy = self.policy
+        if latency_s is not None:
+            # lowest latency seen recently, drifting up slowly so that it follows a server that got slower
+            if self._min_latency_s is None or latency_s < self._min_latency_s:
+                self._min_latency_s = latency_s
+            else:
+                self._min_latency_s *= 1.01
+        target = policy.target_latency_s
+        if target is None and self._min_latency_s is not None:
+            target = policy.latency_tolerance * self._min_latency_s
+        if overloaded or (latency_s is not None and target is not None and latency_s > target):
+            self._limit = max(policy.min_concurrency, self._limit * policy.decrease_factor)
+        elif latency_s is not None:
+            self._limit = min(policy.max_concurrency, self._limit + 1 / self._limit)
+
+    def get_stats(self) -> dict:
+        """Current limit, operations in flight and waiting, and counts of admitted, queued and rejected operations"""
+        with self._cond:
+            return dict(limit=self.get_limit(), num_in_flight=self._num_in_flight, num_waiting=len(self._queue),
+                        num_admitted=self.num_admitted, num_queued=self.num_queued, num_rejected=self.num_rejected)
+
+
+_CONTROLLERS: Dict[str, AdmissionController] = {}
+_CONTROLLERS_LOCK = threading.Lock()
+
+def get_admission_controller(host_key: str,
+                             policy: AdmissionPolicy) \
+        -> AdmissionController:
+    """
+    Admission controller of a host, shared by all engines of the process that connect to it so that they are limited
+    together. The controller is created with the policy of the first engine that asks for it.
+    """
+    with _CONTROLLERS_LOCK:
+        if host_key not in _CONTROLLERS:
+            _CONTROLLERS[host_key] = AdmissionController(policy)
+        return _CONTROLLERS[host_key]
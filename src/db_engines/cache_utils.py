@@ -0,0 +1,79 @@
+"""In-process caches for point lookups"""
+
+from typing import Optional, Callable, Hashable, Tuple, Any
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache():
+    """
+    Thread-safe LRU cache with a bounded number of entries and an optional time-to-live.
+
+    Reads that race with writes must not re-insert stale values: get the current version with get_version() before
+    reading from the database and pass it to put(), which is then ignored if anything was invalidated in between.
+    """
+    def __init__(self,
+                 max_size: int = 1024,
+                 ttl_s: Optional[float] = None):
+        assert max_size >= 1
+        self._max_size = max_size
+        self._ttl_s = ttl_s
+        self._entries: OrderedDict = OrderedDict() # key -> (value, time inserted)
+        self._lock = threading.Lock()
+        self._version = 0
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_version(self) -> int:
+        """Version of the cache, incremented on every invalidation"""
+        return self._version
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """Look up a key. Returns whether it was found and its value."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._ttl_s is not None and time.monotonic() - entry[1] > self._ttl_s:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.num_misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.num_hits += 1
+            return True, entry[0]
+
+    def put(self,
+            key: Hashable,
+            val: Any,
+            version: Optional[int] = None):
+        """Insert a value, evicting the least recently used entry if full. Ignored if 'version' is outdated."""
+        with self._lock:
+            if version is not None and version != self._version:
+                return
+            self._entries[key] = (val, time.monotonic())
+            self._entries.move_to_end(key)
+            if len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        """Drop a key"""
+        with self._lock:
+            self._version += 1
+            self._entries.pop(key, None)
+
+    def invalidate_where(self, pred: Callable[[Hashable], bool]):
+        """Drop all keys for which pred(key) is True"""
+        with self._lock:
+            self._version += 1
+            for key in [key for key in self._entries if pred(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        """Drop all keys"""
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
@@ -1,4 +1,11 @@
 """Macros for the DB engines"""
 
 MYSQL_FETCH_MANY_MAX_COUNT = 1000
+MYSQL_IN_LIST_MAX_COUNT = 1000
 MONGODB_FIND_MANY_MAX_COUNT = 1000
+FILE_READ_CHUNK_SIZE = 100000
+FILE_READ_CSV_BLOCK_SIZE = 16 * 2 ** 20
+MONGODB_CATALOG_TTL_S = 60.0
+MYSQL_KILL_QUERY_GRACE_S = 1.0
+MONGODB_DELETE_MANY_MAX_COUNT = 1000
+MYSQL_SCRIPT_BATCH_MAX_BYTES = 2 ** 20
@@ -0,0 +1,251 @@
+"""Bulk copy of data between MySQL tables and MongoDB collections, and bulk import from files."""
+
+from __future__ import annotations
+
+from typing import Optional, List, Dict, Callable, Iterable, Union, TYPE_CHECKING
+import datetime
+import decimal
+import time
+
+from .mysql_utils import make_upsert_query
+from .pipeline_utils import prefetch_gen
+from .io_utils import read_file_chunks
+from .constants import FILE_READ_CHUNK_SIZE, FILE_READ_CSV_BLOCK_SIZE
+from .lazy_imports import LazyModule
+
+if TYPE_CHECKING: # the engines are passed in by the caller, who has loaded them
+    from .mysql_engine import MySQLEngine
+    from .mongodb_engine import MongoDBEngine
+
+pd = LazyModule('pandas')
+bson = LazyModule('bson')
+
+
+
+def _get_first_valid(col: pd.Series):
+    """First non-null value of a column, or None"""
+    idx = col.first_valid_index()
+    return None if idx is None else col.loc[idx]
+
+def convert_df_for_mongodb(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert DataFrame columns to BSON-compatible types, one column at a time:
+        - Decimal -> float
+        - date -> datetime (at midnight)
+        - datetime -> datetime with ms precision (BSON's precision)
+    Nulls (None, NaN, NaT) become None.
+    """
+    df = df.copy()
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = df[col].dt.floor('ms')
+        elif df[col].dtype == object:
+            val = _get_first_valid(df[col])
+            if isinstance(val, decimal.Decimal):
+                df[col] = df[col].astype(float)
+            elif isinstance(val, datetime.date) and not isinstance(val, datetime.datetime):
+                df[col] = pd.to_datetime(df[col])
+            elif isinstance(val, datetime.datetime):
+                df[col] = pd.to_datetime(df[col]).dt.floor('ms')
+    return df.astype(object).where(df.notna(), None)
+
+def convert_df_for_mysql(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert DataFrame columns to types supported by the MySQL connector, one column at a time:
+        - ObjectId -> str
+        - datetime -> datetime with ms precision (as in TIMESTAMP(3) columns)
+    Nulls (None, NaN, NaT) become None.
+    """
+    df = df.copy()
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            vals = df[col].dt.tz_localize(None) if df[col].dt.tz is not None else df[col]
+            vals = vals.to_numpy().astype('datetime64[ms]').astype(object) # python datetimes, NaT -> None
+            df[col] = pd.Series(vals, index=df.index, dtype=object)
+        elif df[col].dtype == object and isinstance(_get_first_valid(df[col]), bson.ObjectId):
+            df[col] = df[col].astype(str).where(df[col].notna(), None)
+    return df.astype(object).where(df.notna(), None)
+
+
+def _run_copy(df_gen: Iterable[pd.DataFrame],
+              write_func: Callable[[pd.DataFrame], Optional[int]],
+              max_prefetch: int,
+              verbose: bool,
+              desc: str) \
+        -> dict:
+    """
+    Write chunks while the next ones are read on a background thread. write_func() returns the number of records
+    written, if some may fail without raising (None: all of them). Returns throughput stats.
+    """
+    t_start = time.time()
+    num_records = 0
+    num_failed = 0
+    num_chunks = 0
+    for df in prefetch_gen(df_gen, max_prefetch=max_prefetch):
+        if len(df) == 0:
+            continue
+        num_written = write_func(df)
+        num_written = len(df) if num_written is None else num_written
+        num_records += num_written
+        num_failed += len(df) - num_written
+        num_chunks += 1
+        if verbose:
+            dur = time.time() - t_start
+            print(f'{desc} -> Copied {num_records} records in {dur:.1f} s ({num_records / max(dur, 1e-9):.0f} '
+                  f'records/s).')
+    dur = time.time() - t_start
+    return dict(num_records=num_records, num_failed=num_failed, num_chunks=num_chunks, duration_s=dur,
+                records_per_s=num_records / dur if dur > 0 else 0.0)
+
+
+def copy_mysql_to_mongodb(mysql_engine: MySQLEngine,
+                          database: str,
+                          mongo_engine: MongoDBEngine,
+                          tablename: Optional[str] = None,
+                          query: Optional[str] = None,
+                          cols: Optional[List[str]] = None,
+                          params: Optional[Union[tuple, list, dict]] = None,
+                          transform: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None,
+                          max_prefetch: int = 2,
+                          verbose: bool = False) \
+        -> dict:
+    """
+    Copy a MySQL table (or the result of a query) into the MongoDB engine's current collection.
+
+    Chunks are read on a background thread while the previous ones are written, with at most max_prefetch chunks
+    waiting in between. Provide either tablename (copies the whole table) or query and cols (the columns returned by
+    the query). 'transform' is an optional function applied to each chunk before it's converted and written.
+
+    Returns throughput stats (number of records written and failed, chunks, duration, records per second).
+    """
+    assert (tablename is None) != (query is None)
+    if query is None:
+        df_gen = mysql_engine.select_records(database, f'SELECT * FROM {tablename}', mode='pandas',
+                                             tablename=tablename, as_generator=True)
+    else:
+        df_gen = mysql_engine.select_records(database, query, mode='pandas', cols=cols, as_generator=True,
+                                             params=params)
+
+    def write_func(df: pd.DataFrame):
+        if transform is not None:
+            df = transform(df)
+        return mongo_engine.insert_many(convert_df_for_mongodb(df).to_dict('records'))
+
+    return _run_copy(df_gen, write_func, max_prefetch, verbose, 'copy_mysql_to_mongodb()')
+
+
+def copy_mongodb_to_mysql(mongo_engine: MongoDBEngine,
+                          mysql_engine: MySQLEngine,
+                          database: str,
+                          tablename: str,
+                          filter: Optional[dict] = None,
+                          projection: Optional[dict] = None,
+                          column_map: Optional[Dict[str, str]] = None,
+                          upsert: bool = False,
+                          transform: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None,
+                          max_prefetch: int = 2,
+                          verbose: bool = False) \
+        -> dict:
+    """
+    Copy the MongoDB engine's current collection (optionally filtered and projected as in find_many_gen()) into a
+    MySQL table.
+
+    column_map maps record fields to table columns (e.g. {'_id': 'id'}); if not specified, all fields are written to
+    the columns with the same name. On duplicate key, existing rows are kept unless upsert is True, in which case
+    they're overwritten. Chunks are read on a background thread while the previous ones are written (see
+    copy_mysql_to_mongodb()).
+
+    Returns throughput stats (number of records written and failed, chunks, duration, records per second).
+    """
+    df_gen = mongo_engine.find_many_gen(filter=filter, projection=projection)
+
+    def write_func(df: pd.DataFrame):
+        if transform is not None:
+            df = transform(df)
+        if column_map is not None:
+            df = df[[key for key in column_map if key in df.columns]].rename(columns=column_map)
+        keys = list(df.columns)
+        query = make_upsert_query(tablename, keys, update_keys=None if upsert else [])
+        records = list(convert_df_for_mysql(df).itertuples(index=False, name=None))
+        mysql_engine.insert_records_to_table(database, query, records)
+
+    return _run_copy(df_gen, write_func, max_prefetch, verbose, 'copy_mongodb_to_mysql()')
+
+
+def _read_file_chunks_mapped(path: str,
+                             format: Optional[str],
+                             column_map: Optional[Dict[str, str]],
+                             chunk_size: int,
+                             csv_block_size: int) \
+        -> Iterable[pd.DataFrame]:
+    """Read only the mapped columns of a file, renamed to their destination names"""
+    columns = None if column_map is None else list(column_map)
+    for df in read_file_chunks(path, format=format, columns=columns, chunk_size=chunk_size,
+                               csv_block_size=csv_block_size):
+        yield df if column_map is None else df.rename(columns=column_map)
+
+def import_file_to_mysql(path: str,
+                         mysql_engine: MySQLEngine,
+                         database: str,
+                         tablename: str,
+                         format: Optional[str] = None,
+                         column_map: Optional[Dict[str, str]] = None,
+                         upsert: bool = False,
+                         transform: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None,
+                         chunk_size: int = FILE_READ_CHUNK_SIZE,
+                         csv_block_size: int = FILE_READ_CSV_BLOCK_SIZE,
+                         max_prefetch: int = 2,
+                         verbose: bool = False) \
+        -> dict:
+    """
+    Import a Parquet, CSV or Feather file (see read_file_chunks()) into a MySQL table.
+
+    column_map maps file columns to table columns (e.g. {'video_id': 'id'}); only those columns are read. If not
+    specified, all columns are written to the columns with the same name. Each chunk is written with a single
+    executemany(), which the connector sends as multi-row INSERTs. On duplicate key, existing rows are kept unless
+    upsert is True, in which case they're overwritten.
+
+    Chunks are read and decoded on a background thread while the previous ones are written. Peak memory is bounded by
+    about max_prefetch + 2 chunks, where a chunk is up to chunk_size records (Parquet, Feather) or csv_block_size bytes
+    of CSV.
+
+    Returns throughput stats (number of records written and failed, chunks, duration, records per second).
+    """
+    df_gen = _read_file_chunks_mapped(path, format, column_map, chunk_size, csv_block_size)
+
+    def write_func(df: pd.DataFrame):
+        if transform is not None:
+            df = transform(df)
+        query = make_upsert_query(tablename, list(df.columns), update_keys=None if upsert else [])
+        records = list(convert_df_for_mysql(df).itertuples(index=False, name=None))
+        mysql_engine.insert_records_to_table(database, query, records)
+
+    return _run_copy(df_gen, write_func, max_prefetch, verbose, 'import_file_to_mysql()')
+
+def import_file_to_mongodb(path: str,
+                           mongo_engine: MongoDBEngine,
+                           format: Optional[str] = None,
+                           column_map: Optional[Dict[str, str]] = None,
+                           transform: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None,
+                           chunk_size: int = FILE_READ_CHUNK_SIZE,
+                           csv_block_size: int = FILE_READ_CSV_BLOCK_SIZE,
+                           max_prefetch: int = 2,
+                           verbose: bool = False) \
+        -> dict:
+    """
+    Import a Parquet, CSV or Feather file (see read_file_chunks()) into the MongoDB engine's current collection.
+
+    column_map maps file columns to record fields (e.g. {'video_id': '_id'}); only those columns are read. Each chunk
+    is written with a single unordered insert_many(). Reading and writing are pipelined and memory is bounded as in
+    import_file_to_mysql().
+
+    Returns throughput stats (number of records written and failed, chunks, duration, records per second).
+    """
+    df_gen = _read_file_chunks_mapped(path, format, column_map, chunk_size, csv_block_size)
+
+    def write_func(df: pd.DataFrame):
+        if transform is not None:
+            df = transform(df)
+        return mongo_engine.insert_many(convert_df_for_mongodb(df).to_dict('records'))
+
+    return _run_copy(df_gen, write_func, max_prefetch, verbose, 'import_file_to_mongodb()')
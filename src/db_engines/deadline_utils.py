@@ -0,0 +1,33 @@
+"""Deadlines for bounding how long database operations (including their retries) may run"""
+
+from typing import Optional
+import time
+
+
+
+class Deadline():
+    """
+    Point in time by which an operation must finish, e.g. Deadline(5.0) for an operation started now that may take 5
+    seconds. The engines translate the remaining time into server-side limits (MySQL max_execution_time, MongoDB
+    maxTimeMS) and stop retrying once it has passed.
+    """
+    def __init__(self, timeout_s: float):
+        assert timeout_s > 0
+        self.timeout_s = timeout_s
+        self.expires_at = time.monotonic() + timeout_s
+
+    @classmethod
+    def from_timeout(cls, timeout_s: Optional[float]) -> Optional['Deadline']:
+        """Deadline for a timeout, or None if there is no timeout"""
+        return None if timeout_s is None else cls(timeout_s)
+
+    def remaining_s(self) -> float:
+        """Seconds left, 0 once expired"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def remaining_ms(self) -> int:
+        """Milliseconds left for a server-side limit. At least 1, since 0 means 'no limit' to the servers."""
+        return max(1, int(self.remaining_s() * 1000))
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
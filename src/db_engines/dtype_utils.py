@@ -0,0 +1,164 @@
+"""
+Dtype policy for the DataFrames returned by the engines: compact column types derived from the schema (MySQL column
+metadata) or from the first chunk of a result (MongoDB), applied identically to every chunk.
+"""
+
+from __future__ import annotations
+
+from typing import Optional, Dict, List, Sequence, Any
+import importlib.util
+
+from .lazy_imports import LazyModule
+
+pd = LazyModule('pandas')
+
+
+# MySQL column types (mysql.connector.constants.FieldType) and flags
+MYSQL_INT_BITS = {1: 8, 2: 16, 9: 32, 3: 32, 8: 64, 13: 16} # TINY, SHORT, INT24, LONG, LONGLONG, YEAR
+MYSQL_FLOAT_DTYPES = {4: 'float32', 5: 'float64'} # FLOAT, DOUBLE
+MYSQL_DATETIME_TYPES = [7, 10, 12, 14] # TIMESTAMP, DATE, DATETIME, NEWDATE
+MYSQL_STRING_TYPES = [15, 247, 249, 250, 251, 252, 253, 254] # VARCHAR, ENUM, BLOBs, VAR_STRING, STRING
+MYSQL_FLAG_UNSIGNED = 32
+MYSQL_FLAG_SET = 2048 # SET columns (type STRING), returned as Python sets
+MYSQL_CHARSET_BINARY = 63 # BINARY/VARBINARY/BLOB columns, returned as bytes
+
+
+
+class DtypePolicy():
+    """
+    How the engines type the columns of the DataFrames they return. The default is to leave typing to pandas (object
+    columns for strings and dates, int64 for all integers); with a policy:
+        - integer columns get the smallest type that fits the schema if downcast_ints is True (e.g. SMALLINT UNSIGNED
+          -> uint16), or the pandas nullable type (e.g. 'UInt16') if the column is nullable, and FLOAT columns float32
+        - string columns get string_dtype (e.g. 'string[pyarrow]', which requires pyarrow and falls back to 'string'
+          if it isn't installed, or 'string')
+        - date and time columns get datetime64[datetime_unit]
+        - columns in 'categories' become categoricals with these categories
+        - for whole (non-chunked) results, other string columns with at most categorical_max_ratio unique values per
+          row (and at least categorical_min_rows rows) become categoricals
+    Set an option to None to leave those columns to pandas.
+
+    Dtypes come from the column metadata for MySQL, and from the first chunk for MongoDB, so every chunk of a result
+    has the same dtypes and pd.concat() keeps them. Categories can't be known before the end of a chunked result, so
+    chunks only get the fixed categories.
+    """
+    def __init__(self,
+                 downcast_ints: bool = True,
+                 string_dtype: Optional[str] = 'string[pyarrow]',
+                 datetime_unit: Optional[str] = 'ms',
+                 categories: Optional[Dict[str, list]] = None,
+                 categorical_max_ratio: Optional[float] = 0.5,
+                 categorical_min_rows: int = 100):
+        assert datetime_unit in [None, 's', 'ms', 'us', 'ns']
+        assert categorical_max_ratio is None or 0 < categorical_max_ratio <= 1
+        self.downcast_ints = downcast_ints
+        if string_dtype == 'string[pyarrow]' and not is_pyarrow_installed():
+            string_dtype = 'string'
+        self.string_dtype = string_dtype
+        self.datetime_unit = datetime_unit
+        self.categories = categories if categories is not None else {}
+        self.categorical_max_ratio = categorical_max_ratio
+        self.categorical_min_rows = categorical_min_rows
+
+
+def is_pyarrow_installed() -> bool:
+    """Whether pyarrow (an optional dependency) can be imported, without importing it"""
+    return importlib.util.find_spec('pyarrow') is not None
+
+def _nullable_int_dtype(dtype: str) -> str:
+    """Pandas nullable version of a numpy integer dtype, e.g. uint16 -> UInt16"""
+    return 'UInt' + dtype[4:] if dtype.startswith('uint') else 'Int' + dtype[3:]
+
+def get_mysql_dtypes(description: Sequence[tuple],
+                     policy: DtypePolicy) \
+        -> List[Optional[Any]]:
+    """Dtype of each column of a MySQL result from its metadata (cursor.description), None to leave it to pandas"""
+    dtypes: List[Optional[Any]] = []
+    for col in description:
+        name, type_code, null_ok = col[0], col[1], col[6]
+        flags = col[7] if len(col) > 7 else 0
+        charset = col[8] if len(col) > 8 else None
+        dtype = None
+        if name in policy.categories:
+            dtype = pd.CategoricalDtype(policy.categories[name])
+        elif type_code in MYSQL_INT_BITS and policy.downcast_ints:
+            dtype = ('uint' if flags & MYSQL_FLAG_UNSIGNED else 'int') + str(MYSQL_INT_BITS[type_code])
+            if null_ok:
+                dtype = _nullable_int_dtype(dtype)
+        elif type_code in MYSQL_FLOAT_DTYPES and policy.downcast_ints:
+            dtype = MYSQL_FLOAT_DTYPES[type_code]
+        elif type_code in MYSQL_DATETIME_TYPES and policy.datetime_unit is not None:
+            dtype = f'datetime64[{policy.datetime_unit}]'
+        elif type_code in MYSQL_STRING_TYPES and charset != MYSQL_CHARSET_BINARY and not flags & MYSQL_FLAG_SET:
+            dtype = policy.string_dtype
+        dtypes.append(dtype)
+    return dtypes
+
+def is_str_column(col: pd.Series) -> bool:
+    """Whether all non-null values of a column are strings"""
+    return all([isinstance(val, str) for val in col.dropna()])
+
+def get_frame_dtypes(df: pd.DataFrame,
+                     policy: DtypePolicy) \
+        -> Dict[str, Any]:
+    """Dtypes of the columns of a schemaless result (e.g. from MongoDB), inferred from a chunk of it"""
+    dtypes: Dict[str, Any] = {}
+    for name in df.columns:
+        col = df[name]
+        if name in policy.categories:
+            dtypes[name] = pd.CategoricalDtype(policy.categories[name])
+        elif pd.api.types.is_datetime64_any_dtype(col.dtype) and policy.datetime_unit is not None:
+            tz = getattr(col.dtype, 'tz', None)
+            dtypes[name] = f'datetime64[{policy.datetime_unit}' + (f', {tz}]' if tz is not None else ']')
+        elif col.dtype == object and policy.string_dtype is not None and col.notna().any() and is_str_column(col):
+            dtypes[name] = policy.string_dtype
+    return dtypes
+
+def apply_dtypes(df: pd.DataFrame,
+                 dtypes: Dict[str, Any]) \
+        -> pd.DataFrame:
+    """
+    Convert the columns of a chunk to their dtypes. Columns that don't convert (e.g. an integer column with nulls that
+    its metadata says it can't have) get the nullable version of their dtype, or are left as is.
+    """
+    dtypes = {name: dtype for name, dtype in dtypes.items() if dtype is not None and name in df.columns}
+    if not dtypes:
+        return df
+    try:
+        return df.astype(dtypes)
+    except (TypeError, ValueError, OverflowError):
+        pass
+    for name, dtype in dtypes.items():
+        try:
+            df[name] = df[name].astype(dtype)
+        except (TypeError, ValueError, OverflowError):
+            if isinstance(dtype, str) and dtype.startswith(('int', 'uint')):
+                df[name] = df[name].astype(_nullable_int_dtype(dtype))
+    return df
+
+def make_typed_df(records: List[tuple],
+                  cols: List[str],
+                  dtypes: Optional[List[Optional[Any]]]) \
+        -> pd.DataFrame:
+    """DataFrame from records (e.g. fetched from a MySQL cursor) with the dtypes of its columns, if specified"""
+    df = pd.DataFrame(records, columns=cols)
+    if dtypes is None:
+        return df
+    return apply_dtypes(df, dict(zip(cols, dtypes)))
+
+def categorize(df: pd.DataFrame,
+               policy: Optional[DtypePolicy]) \
+        -> pd.DataFrame:
+    """Encode the low-cardinality string columns of a whole result as categoricals (see DtypePolicy)"""
+    if policy is None or policy.categorical_max_ratio is None or len(df) < policy.categorical_min_rows:
+        return df
+    for name in df.columns:
+        col = df[name]
+        if name in policy.categories or isinstance(col.dtype, pd.CategoricalDtype):
+            continue
+        if not (pd.api.types.is_string_dtype(col.dtype) and
+                (col.dtype != object or is_str_column(col))):
+            continue
+        if col.nunique() <= policy.categorical_max_ratio * len(df):
+            df[name] = col.astype('category')
+    return df
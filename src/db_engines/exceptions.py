@@ -0,0 +1,37 @@
+"""Exceptions raised by the DB engines"""
+
+from typing import Optional
+
+
+
+class DBEngineError(Exception):
+    """Base class for errors raised by the DB engines"""
+    def __init__(self,
+                 message: str,
+                 code: Optional[int] = None,
+                 attempts: int = 1):
+        super().__init__(message)
+        self.code = code # backend error code (MySQL errno or MongoDB error code), if any
+        self.attempts = attempts # number of attempts made before giving up
+
+class MySQLEngineError(DBEngineError):
+    """Error during a MySQLEngine operation"""
+
+class SQLScriptError(MySQLEngineError):
+    """Error in a statement of a SQL script, with the file and line where the statement starts"""
+    def __init__(self,
+                 message: str,
+                 code: Optional[int] = None,
+                 filename: Optional[str] = None,
+                 line_no: Optional[int] = None,
+                 statement: Optional[str] = None):
+        super().__init__(message, code=code)
+        self.filename = filename
+        self.line_no = line_no
+        self.statement = statement
+
+class MongoDBEngineError(DBEngineError):
+    """Error during a MongoDBEngine operation"""
+
+class AdmissionError(DBEngineError):
+    """Operation not admitted by admission control, i.e. its host is saturated (see admission_utils)"""
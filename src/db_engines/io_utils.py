@@ -0,0 +1,295 @@
+"""
+Utils for streaming query results to and from files (Parquet, CSV, Feather/Arrow IPC).
+
+These require pyarrow, which is an optional dependency and is only imported when one of these utils is used.
+"""
+
+from __future__ import annotations
+
+from typing import Iterable, Optional, Dict, List, Generator
+import os
+import urllib.parse
+
+from .constants import FILE_READ_CHUNK_SIZE, FILE_READ_CSV_BLOCK_SIZE
+from .lazy_imports import LazyModule
+
+pd = LazyModule('pandas')
+
+FILE_FORMATS = ['parquet', 'csv', 'feather']
+FILE_EXTENSIONS = dict(parquet='parquet', csv='csv', feather='arrow')
+
+
+
+def _import_pyarrow():
+    """Import pyarrow on demand"""
+    try:
+        import pyarrow
+    except ImportError as e:
+        raise ImportError('Reading and writing files requires pyarrow. Install it with `pip install pyarrow`.') from e
+    return pyarrow
+
+def _is_objectid_col(col: pd.Series) -> bool:
+    """Check if a column holds ObjectIds"""
+    if col.dtype != object:
+        return False
+    idx = col.first_valid_index()
+    return idx is not None and type(col.loc[idx]).__name__ == 'ObjectId'
+
+def _prep_df_for_arrow(df: pd.DataFrame) -> pd.DataFrame:
+    """Convert column types that Arrow can't represent (e.g. ObjectId) to strings"""
+    cols_str = [col for col in df.columns if _is_objectid_col(df[col])]
+    if cols_str:
+        df = df.copy()
+        for col in cols_str:
+            df[col] = df[col].astype(str).where(df[col].notna(), None)
+    return df
+
+def infer_arrow_schema(df: pd.DataFrame):
+    """Arrow schema of a DataFrame chunk. Columns that are entirely null are typed as strings."""
+    pa = _import_pyarrow()
+    schema = pa.Table.from_pandas(_prep_df_for_arrow(df), preserve_index=False).schema
+    return pa.schema([pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f for f in schema])
+
+
+class ChunkFileWriter():
+    """
+    Writes DataFrame chunks to a single file as they arrive, so that only one chunk is held in memory at a time.
+
+    The file's schema is that of the first chunk unless one is provided. Columns that are entirely null in the first
+    chunk are stored as strings. Subsequent chunks are cast to the schema: missing columns are filled with nulls and new
+    columns either raise an error (on_new_columns='error') or are dropped (on_new_columns='drop'). A chunk whose values
+    don't fit the schema without loss (e.g. floats in an integer column) raises a ValueError naming the column, since
+    the rows already written can't be widened; provide a schema for results whose types vary across chunks.
+
+    Formats:
+        - 'parquet': one row group per chunk. compression is a Parquet codec (e.g. 'snappy', 'zstd').
+        - 'csv': compression is a stream codec (e.g. 'gzip', 'bz2', 'zstd').
+        - 'feather': Arrow IPC file, one record batch per chunk. compression is 'lz4', 'zstd' or None.
+    """
+    def __init__(self,
+                 path: str,
+                 format: str = 'parquet',
+                 compression: Optional[str] = None,
+                 schema=None,
+                 on_new_columns: str = 'error'):
+        assert format in FILE_FORMATS
+        assert on_new_columns in ['error', 'drop']
+        self._pa = _import_pyarrow()
+        self.path = path
+        self._format = format
+        self._compression = compression
+        self._schema = schema
+        self._on_new_columns = on_new_columns
+        self._writer = None
+        self._sink = None
+        self.num_records = 0
+        self.num_chunks = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, df: pd.DataFrame):
+        """Write a chunk"""
+        table = self._to_table(df)
+        if self._writer is None:
+            self._open()
+        if self._format == 'parquet':
+            self._writer.write_table(table, row_group_size=max(len(table), 1))
+        else:
+            self._writer.write_table(table)
+        self.num_records += len(table)
+        self.num_chunks += 1
+
+    def close(self):
+        """Finalize the file. A file is written even if there were no chunks, as long as a schema was provided."""
+        if self._writer is None and self._schema is not None:
+            self._open()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._sink is not None:
+            self._sink.close()
+            self._sink = None
+
+    def _to_table(self, df: pd.DataFrame):
+        pa = self._pa
+        if self._schema is None:
+            self._schema = infer_arrow_schema(df)
+        df = _prep_df_for_arrow(df)
+
+        names = self._schema.names
+        cols_new = [col for col in df.columns if col not in names]
+        if cols_new and self._on_new_columns == 'error':
+            raise ValueError(f'ChunkFileWriter: Chunk has columns that are not in the file schema: {cols_new}. '
+                             f'Provide a schema or set on_new_columns=\'drop\'.')
+        df = df.reindex(columns=names)
+        try:
+            return pa.Table.from_pandas(df, schema=self._schema, preserve_index=False, safe=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            raise ValueError(f'ChunkFileWriter: Chunk {self.num_chunks} doesn\'t fit the file schema: '
+                             f'{self._find_mismatch(df)}. Provide a schema that fits all chunks.') from e
+
+    def _find_mismatch(self, df: pd.DataFrame) -> str:
+        """Describe the first column of a chunk that can't be converted to the file schema"""
+        pa = self._pa
+        for field in self._schema:
+            try:
+                pa.Array.from_pandas(df[field.name], type=field.type, safe=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+                return f'column \'{field.name}\' ({df[field.name].dtype}) can\'t be stored as {field.type} ({e})'
+        return 'unknown column'
+
+    def _open(self):
+        pa = self._pa
+        dpath = os.path.dirname(self.path)
+        if dpath != '':
+            os.makedirs(dpath, exist_ok=True)
+        if self._format == 'parquet':
+            import pyarrow.parquet as pq
+            self._writer = pq.ParquetWriter(self.path, self._schema, compression=self._compression or 'snappy')
+        elif self._format == 'csv':
+            import pyarrow.csv as pcsv
+            if self._compression is not None:
+                self._sink = pa.CompressedOutputStream(self.path, self._compression)
+            else:
+                self._sink = pa.OSFile(self.path, 'wb')
+            self._writer = pcsv.CSVWriter(self._sink, self._schema)
+        else:
+            options = pa.ipc.IpcWriteOptions(compression=self._compression)
+            self._sink = pa.OSFile(self.path, 'wb')
+            self._writer = pa.ipc.new_file(self._sink, self._schema, options=options)
+
+
+def write_chunks_to_file(df_gen: Iterable[pd.DataFrame],
+                         path: str,
+                         format: str = 'parquet',
+                         compression: Optional[str] = None,
+                         partition_col: Optional[str] = None,
+                         schema=None,
+                         on_new_columns: str = 'error') \
+        -> dict:
+    """
+    Stream DataFrame chunks into a file (see ChunkFileWriter), so that peak memory is bounded by a single chunk.
+
+    If partition_col is specified, 'path' is a directory and records are split by the value of that column into
+    Hive-style partitions: <path>/<partition_col>=<value>/part-0.<ext>, with the value URL-encoded (e.g. 'a/b' becomes
+    'a%2Fb') and '__NULL__' for nulls. The partition column isn't stored in the files (nor in 'schema', if provided)
+    and all partitions share the same schema. Categories that don't occur get no partition.
+
+    Returns the number of records and chunks written and the list of files.
+    """
+    if partition_col is None:
+        with ChunkFileWriter(path, format=format, compression=compression, schema=schema,
+                             on_new_columns=on_new_columns) as writer:
+            for df in df_gen:
+                writer.write(df)
+        return dict(num_records=writer.num_records, num_chunks=writer.num_chunks, paths=[path])
+
+    writers: Dict[str, ChunkFileWriter] = {}
+    num_chunks = 0
+    try:
+        for df in df_gen:
+            num_chunks += 1
+            if schema is None: # shared by all partitions
+                schema = infer_arrow_schema(df.drop(columns=[partition_col]))
+            for val, df_ in df.groupby(partition_col, sort=False, dropna=False, observed=True):
+                key = '__NULL__' if pd.isna(val) else urllib.parse.quote(str(val), safe='')
+                if key not in writers:
+                    path_ = os.path.join(path, f'{partition_col}={key}', f'part-0.{FILE_EXTENSIONS[format]}')
+                    writers[key] = ChunkFileWriter(path_, format=format, compression=compression, schema=schema,
+                                                   on_new_columns=on_new_columns)
+                writers[key].write(df_.drop(columns=[partition_col]))
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return dict(num_records=sum([writer.num_records for writer in writers.values()]), num_chunks=num_chunks,
+                paths=[writer.path for writer in writers.values()])
+
+
+def infer_file_format(path: str) -> str:
+    """Infer a file's format from its extension, e.g. 'recs.parquet', 'recs.csv.gz' or 'recs.arrow'"""
+    name = os.path.basename(path).lower()
+    for format, exts in dict(parquet=['.parquet', '.pq'], feather=['.arrow', '.feather', '.ipc']).items():
+        if any([name.endswith(ext) for ext in exts]):
+            return format
+    if '.csv' in name:
+        return 'csv'
+    raise ValueError(f'Could not infer file format of {path}.')
+
+def read_file_chunks(path: str,
+                     format: Optional[str] = None,
+                     columns: Optional[List[str]] = None,
+                     chunk_size: int = FILE_READ_CHUNK_SIZE,
+                     csv_block_size: int = FILE_READ_CSV_BLOCK_SIZE) \
+        -> Generator[pd.DataFrame, None, None]:
+    """
+    Lazily read a Parquet, CSV or Feather file as a generator of DataFrame chunks, so that only one chunk is held in
+    memory at a time. The format is inferred from the file extension if not specified.
+
+    Parquet and Feather files are read in chunks of up to chunk_size records. CSV files (optionally compressed, e.g.
+    '.csv.gz') are read in blocks of csv_block_size bytes. Only 'columns' are read, if specified.
+    """
+    pa = _import_pyarrow()
+    if format is None:
+        format = infer_file_format(path)
+    assert format in FILE_FORMATS
+
+    if format == 'parquet':
+        import pyarrow.parquet as pq
+        with pq.ParquetFile(path) as f:
+            for batch in f.iter_batches(batch_size=chunk_size, columns=columns):
+                yield batch.to_pandas()
+    elif format == 'csv':
+        import pyarrow.csv as pcsv
+        with pa.input_stream(path, compression='detect') as f:
+            reader = pcsv.open_csv(f, read_options=pcsv.ReadOptions(block_size=csv_block_size),
+                                   convert_options=pcsv.ConvertOptions(include_columns=columns))
+            for batch in reader:
+                yield batch.to_pandas()
+    else:
+        with pa.memory_map(path, 'r') as f:
+            reader = pa.ipc.open_file(f)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                if columns is not None:
+                    batch = batch.select(columns)
+                for j in range(0, batch.num_rows, chunk_size):
+                    yield batch.slice(j, chunk_size).to_pandas()
+
+
+def open_spill_file(path: str,
+                    as_arrow: bool = False):
+    """
+    Open an uncompressed Arrow IPC file as a memory-mapped table. Record batches reference the mapped pages directly,
+    so nothing is read into memory until it's accessed and the OS can evict pages under memory pressure. The mapping
+    is released once the table (and everything derived from it) is garbage collected.
+
+    Returns a pyarrow.Table if as_arrow is True, otherwise a DataFrame with Arrow-backed columns (pd.ArrowDtype), which
+    is a zero-copy view of the table.
+    """
+    pa = _import_pyarrow()
+    table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    if as_arrow:
+        return table
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+def spill_chunks_to_file(df_gen: Iterable[pd.DataFrame],
+                         path: str,
+                         as_arrow: bool = False,
+                         schema=None,
+                         on_new_columns: str = 'error'):
+    """
+    Spill DataFrame chunks to a local uncompressed Arrow IPC file and return it memory-mapped (see open_spill_file()),
+    so that results larger than RAM can be used without holding them on the Python heap. Peak memory while spilling
+    is a single chunk. The file is overwritten if it exists and is left in place for the caller to delete.
+
+    ObjectIds are stored as strings. If there are no chunks and no schema, an empty DataFrame (or table) is returned.
+    """
+    res = write_chunks_to_file(df_gen, path, format='feather', schema=schema, on_new_columns=on_new_columns)
+    if res['num_chunks'] == 0 and schema is None:
+        pa = _import_pyarrow()
+        return pa.table({}) if as_arrow else pd.DataFrame()
+    return open_spill_file(path, as_arrow=as_arrow)
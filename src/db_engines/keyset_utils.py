@@ -0,0 +1,148 @@
+"""Utils for keyset (seek) pagination: opaque cursor tokens and 'after last key' conditions for both engines."""
+
+from typing import List, Tuple, Any, Sequence, Optional, Union, Callable, Generator
+import base64
+import datetime
+import decimal
+import json
+import os
+
+
+
+def _encode_val(val: Any) -> Any:
+    """Tag values that JSON can't represent so that they survive a round trip through a cursor token"""
+    if isinstance(val, datetime.datetime):
+        return {'$dt': val.isoformat()}
+    if isinstance(val, datetime.date):
+        return {'$d': val.isoformat()}
+    if isinstance(val, decimal.Decimal):
+        return {'$dec': str(val)}
+    if isinstance(val, bytes):
+        return {'$b': base64.b64encode(val).decode('ascii')}
+    if type(val).__name__ == 'ObjectId':
+        return {'$oid': str(val)}
+    return val
+
+def _decode_val(val: Any) -> Any:
+    """Inverse of _encode_val()"""
+    if not isinstance(val, dict):
+        return val
+    if '$dt' in val:
+        return datetime.datetime.fromisoformat(val['$dt'])
+    if '$d' in val:
+        return datetime.date.fromisoformat(val['$d'])
+    if '$dec' in val:
+        return decimal.Decimal(val['$dec'])
+    if '$b' in val:
+        return base64.b64decode(val['$b'])
+    if '$oid' in val:
+        from bson import ObjectId
+        return ObjectId(val['$oid'])
+    raise ValueError(f'Unrecognized value in cursor token: {val}.')
+
+def encode_cursor_token(key_vals: Sequence) -> str:
+    """Make an opaque, URL-safe cursor token from the sort-key values of the last record in a page"""
+    s = json.dumps([_encode_val(val) for val in key_vals], separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii')
+
+def decode_cursor_token(token: str) -> list:
+    """Get sort-key values back from a cursor token"""
+    try:
+        vals = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except Exception as e:
+        raise ValueError(f'Invalid cursor token: {token}.') from e
+    assert isinstance(vals, list)
+    return [_decode_val(val) for val in vals]
+
+
+def make_sql_keyset_clause(key_cols: List[str],
+                           key_vals: Sequence,
+                           descending: bool = False) \
+        -> Tuple[str, list]:
+    """
+    Make a parameterized condition selecting the records after key_vals in the (key_cols) sort order, e.g.
+        (a > %s) OR (a = %s AND b > %s)
+    The expanded form is used instead of a row comparison "(a, b) > (%s, %s)" so that MySQL can use the index on the
+    key columns for a range scan.
+    """
+    assert len(key_cols) == len(key_vals) > 0
+    op = '<' if descending else '>'
+    clauses: List[str] = []
+    params: list = []
+    for i, col in enumerate(key_cols):
+        conds = [f'{col_} = %s' for col_ in key_cols[:i]] + [f'{col} {op} %s']
+        clauses.append('(' + ' AND '.join(conds) + ')')
+        params += list(key_vals[:i + 1])
+    return '(' + ' OR '.join(clauses) + ')', params
+
+def make_mongodb_keyset_filter(sort_keys: List[str],
+                               key_vals: Sequence,
+                               descending: bool = False) \
+        -> dict:
+    """MongoDB equivalent of make_sql_keyset_clause()"""
+    assert len(sort_keys) == len(key_vals) > 0
+    op = '$lt' if descending else '$gt'
+    clauses: List[dict] = []
+    for i, key in enumerate(sort_keys):
+        clause = {key_: val_ for key_, val_ in zip(sort_keys[:i], key_vals[:i])}
+        clause[key] = {op: key_vals[i]}
+        clauses.append(clause)
+    return clauses[0] if len(clauses) == 1 else {'$or': clauses}
+
+def get_nested_field(rec: dict, key: str) -> Any:
+    """Get value of a (possibly dotted) field in a MongoDB record"""
+    for key_ in key.split('.'):
+        rec = rec[key_]
+    return rec
+
+
+def load_checkpoint(path: str) -> Optional[str]:
+    """Load the cursor token saved by save_checkpoint(), if any"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        token = f.read().strip()
+    return token if token != '' else None
+
+def save_checkpoint(path: str,
+                    token: str):
+    """Save a cursor token to a local file. The file is replaced atomically so that a crash never leaves it corrupt."""
+    path_tmp = path + '.tmp'
+    with open(path_tmp, 'w') as f:
+        f.write(token)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path_tmp, path)
+
+def keyset_scan_gen(fetch_page: Callable[[Optional[str]], Tuple[Any, Optional[str], int]],
+                    resume_token: Optional[str] = None,
+                    checkpoint: Optional[Union[str, Callable[[str], None]]] = None,
+                    with_tokens: bool = False) \
+        -> Generator:
+    """
+    Resumable scan over the pages returned by fetch_page(token) -> (page, token_of_last_record, num_records).
+
+    'checkpoint' is either the path of a local file or a callback. The token of a chunk is checkpointed once the
+    consumer asks for the following chunk (i.e. once it is done processing the chunk), and after the last chunk. A
+    scan restarted from the checkpoint therefore delivers each chunk exactly once as long as the consumer finishes
+    processing a chunk before requesting the next one. If a checkpoint file is given and resume_token is not, the scan
+    resumes from the token saved in the file.
+
+    If with_tokens is True, (chunk, token) tuples are yielded so that the consumer can store the token atomically with
+    its own output instead of relying on the checkpoint.
+    """
+    if isinstance(checkpoint, str):
+        path = checkpoint
+        if resume_token is None:
+            resume_token = load_checkpoint(path)
+        checkpoint = lambda token_: save_checkpoint(path, token_)
+
+    token = resume_token
+    while 1:
+        page, token_last, num_recs = fetch_page(token)
+        if num_recs == 0:
+            return
+        yield (page, token_last) if with_tokens else page
+        token = token_last
+        if checkpoint is not None:
+            checkpoint(token)
@@ -0,0 +1,32 @@
+"""Deferred imports of heavy dependencies (e.g. pandas), so that they are only loaded by the code paths that use them"""
+
+import importlib
+
+
+class LazyModule():
+    """
+    Stand-in for a module that imports it on first attribute access, e.g.
+
+        pd = LazyModule('pandas')
+        pd.DataFrame(...) # pandas is imported here
+
+    Modules that use one for names in type annotations must have `from __future__ import annotations`, otherwise the
+    annotations trigger the import when the module is loaded.
+    """
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name) # thread-safe, import lock is held by importlib
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        return f"<LazyModule '{self._name}' ({'loaded' if self._module is not None else 'not loaded'})>"
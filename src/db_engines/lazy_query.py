@@ -0,0 +1,281 @@
+"""
+Lazy, composable queries for the MySQL and MongoDB engines.
+
+A query records filter, projection, group/aggregate, sort and limit operations and is only executed when it is iterated
+over (chunks of records) or collected (one DataFrame). All operations are pushed down to the server: queries compile to
+a single parameterized SQL statement or aggregation pipeline. Operations return a new query, so a base query can be
+reused and extended, e.g.
+
+    q = MySQLQuery(engine, 'test_db', 'stats').filter(id_meta=['a', 'b']).select('id_meta', 'like_count')
+    df = q.sort('like_count', descending=True).limit(10).collect()
+    df = q.group_by('id_meta').agg(num=('like_count', 'count'), likes=('like_count', 'sum')).collect()
+
+Regardless of the order in which operations are chained, they apply in SQL clause order: filters, then grouping and
+aggregation, then sort, then limit. Filters added after agg() apply to the groups (like HAVING).
+"""
+
+from __future__ import annotations
+
+from typing import Optional, List, Dict, Tuple, Generator, TYPE_CHECKING
+from abc import ABC, abstractmethod
+import copy
+
+from .lazy_imports import LazyModule
+
+if TYPE_CHECKING: # the engines are only needed once a query is executed, by which point they are loaded
+    from .mysql_engine import MySQLEngine
+    from .mongodb_engine import MongoDBEngine
+
+pd = LazyModule('pandas')
+
+
+AGG_FUNCS_SQL = dict(count='COUNT', sum='SUM', mean='AVG', min='MIN', max='MAX')
+AGG_FUNCS_MONGODB = dict(count='$sum', sum='$sum', mean='$avg', min='$min', max='$max')
+COMPARISON_OPS_SQL = {'=': '=', '!=': '!=', '<': '<', '<=': '<=', '>': '>', '>=': '>='}
+COMPARISON_OPS_MONGODB = {'=': '$eq', '!=': '$ne', '<': '$lt', '<=': '$lte', '>': '$gt', '>=': '$gte'}
+
+
+
+class _LazyQuery(ABC):
+    """
+    Operations shared by the MySQL and MongoDB queries.
+
+    Filter values have the same options as the filters elsewhere in this package (see mysql_utils.make_sql_where_one()),
+    plus comparisons:
+        - equality: number=5
+        - set membership: username=['a', 'b']
+        - range (inclusive): timestamp=[[t0, t1]]
+        - comparison: number=('>=', 5), with operators '=', '!=', '<', '<=', '>', '>='
+    """
+    def __init__(self):
+        self._filters: List[Tuple[str, object]] = []
+        self._having: List[Tuple[str, object]] = []
+        self._cols: Optional[List[str]] = None
+        self._group_cols: Optional[List[str]] = None
+        self._aggs: Optional[Dict[str, Tuple[str, str]]] = None
+        self._sort: List[Tuple[str, bool]] = []
+        self._limit: Optional[int] = None
+
+    def _copy(self):
+        q = copy.copy(self)
+        q._filters = list(self._filters)
+        q._having = list(self._having)
+        q._sort = list(self._sort)
+        return q
+
+    def filter(self, **filters):
+        """Keep records matching all filters (see class docstring for the filter options)"""
+        q = self._copy()
+        for key, val in filters.items():
+            if isinstance(val, tuple):
+                assert len(val) == 2 and val[0] in COMPARISON_OPS_SQL
+            (q._having if q._aggs is not None else q._filters).append((key, val))
+        return q
+
+    def select(self, *cols: str):
+        """
+        Keep only these columns (or fields). After agg(), these are among the group columns and aggregates; before, they
+        are replaced by the group columns and aggregates once agg() is called.
+        """
+        assert len(cols) > 0
+        if self._aggs is not None:
+            cols_out = self._group_cols + list(self._aggs)
+            cols_unknown = [col for col in cols if col not in cols_out]
+            assert len(cols_unknown) == 0, f'Columns {cols_unknown} are not in the aggregated result {cols_out}.'
+        q = self._copy()
+        q._cols = list(cols)
+        return q
+
+    def group_by(self, *cols: str):
+        """Group records by these columns. Must be followed by agg()."""
+        assert len(cols) > 0 and self._aggs is None
+        q = self._copy()
+        q._group_cols = list(cols)
+        return q
+
+    def agg(self, **aggs: Tuple[str, str]):
+        """
+        Aggregate groups, e.g. agg(num=('like_count', 'count'), likes=('like_count', 'sum')). Functions are 'count'
+        (of non-null values), 'sum', 'mean', 'min' and 'max'. Without group_by(), all records form one group. The
+        result has the group columns followed by the aggregates.
+        """
+        assert len(aggs) > 0 and self._aggs is None
+        assert all([func in AGG_FUNCS_SQL for _, func in aggs.values()])
+        q = self._copy()
+        q._aggs = dict(aggs)
+        q._cols = None # the result has the group columns and aggregates, see select()
+        if q._group_cols is None:
+            q._group_cols = []
+        return q
+
+    def sort(self,
+             *cols: str,
+             descending: bool = False):
+        """Sort by these columns. Calling sort() again adds tie-breakers."""
+        q = self._copy()
+        q._sort += [(col, descending) for col in cols]
+        return q
+
+    def limit(self, n: int):
+        """Return at most n records"""
+        q = self._copy()
+        q._limit = int(n)
+        return q
+
+    def _check(self):
+        """Validate the query before compiling it"""
+        assert self._group_cols is None or self._aggs is not None, 'group_by() must be followed by agg().'
+
+    def _get_out_cols(self) -> Optional[List[str]]:
+        """Columns of the result, if known without querying the server"""
+        if self._cols is not None:
+            return self._cols
+        if self._aggs is not None:
+            return self._group_cols + list(self._aggs)
+        return None
+
+    def __iter__(self) -> Generator[pd.DataFrame, None, None]:
+        """Execute the query and iterate over chunks of records"""
+        return self.iter_chunks()
+
+    @abstractmethod
+    def iter_chunks(self, prefetch: int = 0) -> Generator[pd.DataFrame, None, None]:
+        """Execute the query and iterate over chunks of records"""
+
+    def collect(self) -> pd.DataFrame:
+        """Execute the query and return all records"""
+        dfs = [df for df in self.iter_chunks()]
+        if len(dfs) == 0:
+            return pd.DataFrame(columns=self._get_out_cols())
+        return pd.concat(dfs, ignore_index=True)
+
+
+
+class MySQLQuery(_LazyQuery):
+    """Lazy query on a MySQL table (see module docstring)"""
+    def __init__(self,
+                 engine: MySQLEngine,
+                 database: str,
+                 tablename: str):
+        super().__init__()
+        self._engine = engine
+        self._database = database
+        self._tablename = tablename
+
+    def to_sql(self) -> Tuple[str, list]:
+        """Compile the query to a parameterized SQL statement. Returns the statement and its parameters."""
+        self._check()
+        params: list = []
+
+        if self._aggs is not None:
+            exprs = {col: col for col in self._group_cols}
+            for name, (col, func) in self._aggs.items():
+                exprs[name] = f"{AGG_FUNCS_SQL[func]}({col})"
+        else:
+            exprs = {}
+        cols = self._get_out_cols()
+        if cols is None:
+            select = '*'
+        else:
+            select = ', '.join([col if exprs.get(col, col) == col else f'{exprs[col]} AS {col}' for col in cols])
+        query = f"SELECT {select} FROM {self._tablename}"
+
+        if len(self._filters) > 0:
+            clause, params_ = self._make_conditions(self._filters, self._tablename)
+            query += f" WHERE {clause}"
+            params += params_
+        if self._aggs is not None and len(self._group_cols) > 0:
+            query += f" GROUP BY {', '.join(self._group_cols)}"
+        if len(self._having) > 0: # on the select aliases
+            clause, params_ = self._make_conditions(self._having, None)
+            query += f" HAVING {clause}"
+            params += params_
+        if len(self._sort) > 0:
+            query += ' ORDER BY ' + ', '.join([col + (' DESC' if desc else ' ASC') for col, desc in self._sort])
+        if self._limit is not None:
+            query += f" LIMIT {self._limit}"
+
+        return query, params
+
+    @staticmethod
+    def _make_conditions(filters: List[Tuple[str, object]],
+                         tablename: Optional[str]) \
+            -> Tuple[str, list]:
+        from .mysql_utils import make_sql_where_one # imports the MySQL connector
+
+        clauses: List[str] = []
+        params: list = []
+        for key, val in filters:
+            if isinstance(val, tuple):
+                key_ = key if tablename is None else f'{tablename}.{key}'
+                clause, params_ = f"{key_} {COMPARISON_OPS_SQL[val[0]]} %s", [val[1]]
+            else:
+                clause, params_ = make_sql_where_one(tablename, key, val)
+            clauses.append(clause)
+            params += params_
+        return ' AND '.join(clauses), params
+
+    def iter_chunks(self, prefetch: int = 0) -> Generator[pd.DataFrame, None, None]:
+        """Execute the query and iterate over chunks of records. See MySQLEngine.select_records() for 'prefetch'."""
+        query, params = self.to_sql()
+        cols = self._get_out_cols()
+        return self._engine.select_records(self._database, query, mode='pandas', as_generator=True,
+                                           tablename=self._tablename if cols is None else None, cols=cols,
+                                           params=params or None, prefetch=prefetch)
+
+
+
+class MongoDBQuery(_LazyQuery):
+    """Lazy query on the engine's current MongoDB collection (see module docstring)"""
+    def __init__(self, engine: MongoDBEngine):
+        super().__init__()
+        self._engine = engine
+
+    def to_pipeline(self) -> List[dict]:
+        """Compile the query to an aggregation pipeline"""
+        self._check()
+        pipeline: List[dict] = []
+
+        if len(self._filters) > 0:
+            pipeline.append({'$match': self._make_match(self._filters)})
+        if self._aggs is not None:
+            group = {'_id': {col: f'${col}' for col in self._group_cols} if self._group_cols else None}
+            for name, (col, func) in self._aggs.items():
+                if func == 'count': # non-null, non-missing values
+                    group[name] = {'$sum': {'$cond': [{'$ne': [{'$ifNull': [f'${col}', None]}, None]}, 1, 0]}}
+                else:
+                    group[name] = {AGG_FUNCS_MONGODB[func]: f'${col}'}
+            pipeline.append({'$group': group})
+            project = {'_id': 0, **{col: f'$_id.{col}' for col in self._group_cols}, **{name: 1 for name in self._aggs}}
+            pipeline.append({'$project': project})
+        if len(self._having) > 0:
+            pipeline.append({'$match': self._make_match(self._having)})
+        if len(self._sort) > 0:
+            pipeline.append({'$sort': {col: -1 if desc else 1 for col, desc in self._sort}})
+        if self._limit is not None:
+            pipeline.append({'$limit': self._limit})
+        if self._cols is not None:
+            project = {col: 1 for col in self._cols}
+            if '_id' not in self._cols:
+                project['_id'] = 0
+            pipeline.append({'$project': project})
+
+        return pipeline
+
+    @staticmethod
+    def _make_match(filters: List[Tuple[str, object]]) -> dict:
+        conds: List[dict] = []
+        for key, val in filters:
+            if isinstance(val, tuple):
+                conds.append({key: {COMPARISON_OPS_MONGODB[val[0]]: val[1]}})
+            elif isinstance(val, list) and len(val) == 1 and isinstance(val[0], list):
+                conds.append({key: {'$gte': val[0][0], '$lte': val[0][1]}})
+            elif isinstance(val, list):
+                conds.append({key: {'$in': val}})
+            else:
+                conds.append({key: val})
+        return conds[0] if len(conds) == 1 else {'$and': conds}
+
+    def iter_chunks(self, prefetch: int = 0) -> Generator[pd.DataFrame, None, None]:
+        """Execute the query and iterate over chunks of records. See MongoDBEngine.find_many_gen() for 'prefetch'."""
+        return self._engine.aggregate_gen(self.to_pipeline(), prefetch=prefetch)
@@ -1,62 +1,314 @@
 """MongoDB Engine for CRUD and other ops"""
 
-from typing import Dict, Union, Optional, Callable, List, Generator
-import math
+from __future__ import annotations
 
-import pandas as pd
+from typing import Dict, Union, Optional, Callable, List, Generator, Tuple
+import math
+import os
+import copy
+import threading
+import time
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
-from pymongo import MongoClient
+from pymongo import MongoClient, IndexModel
 from pymongo.collection import Collection, ObjectId, Cursor
-from pymongo.errors import BulkWriteError
+from pymongo.change_stream import CollectionChangeStream
+from pymongo.errors import (BulkWriteError, PyMongoError, AutoReconnect, ServerSelectionTimeoutError,
+                            ExecutionTimeout)
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+
+from .constants import MONGODB_FIND_MANY_MAX_COUNT, MONGODB_CATALOG_TTL_S, MONGODB_DELETE_MANY_MAX_COUNT
+from .exceptions import DBEngineError, MongoDBEngineError
+from .retry_utils import RetryPolicy, call_with_retries
+from .deadline_utils import Deadline
+from .pipeline_utils import prefetch_gen
+from .cache_utils import LRUCache
+from .singleflight_utils import SingleFlight, make_single_flight
+from .admission_utils import AdmissionPolicy, get_admission_controller
+from .dtype_utils import DtypePolicy, get_frame_dtypes, apply_dtypes, categorize, is_str_column
+from .record_utils import RECORD_MODES, format_dicts
+from .io_utils import write_chunks_to_file, spill_chunks_to_file
+from .keyset_utils import (encode_cursor_token, decode_cursor_token, make_mongodb_keyset_filter, get_nested_field,
+                           keyset_scan_gen)
+from .lazy_imports import LazyModule
+
+pd = LazyModule('pandas')
+val_utils = LazyModule('ytpa_utils.val_utils')
+
+
+def is_mongodb_error_retryable(e: Exception,
+                               idempotent: bool,
+                               policy: RetryPolicy) \
+        -> bool:
+    """
+    Decide if a failed MongoDB operation can be retried. The client already retries supported reads and writes once
+    (retryReads/retryWrites), this covers failures that outlast that, e.g. a replica set election.
+    """
+    if not isinstance(e, PyMongoError):
+        return False
+    if e.has_error_label('TransientTransactionError'):
+        return True
+    if isinstance(e, ServerSelectionTimeoutError): # client already waited serverSelectionTimeoutMS
+        return False
+    return (isinstance(e, AutoReconnect) or e.has_error_label('RetryableWriteError')) and \
+        (idempotent or policy.retry_writes)
+
+def is_mongodb_overload_error(e: BaseException) -> bool:
+    """Decide if a failed MongoDB operation signals an overloaded server (see admission_utils)"""
+    return isinstance(e, (ExecutionTimeout, AutoReconnect)) # AutoReconnect includes network timeouts
+
+READ_PREFERENCES = dict(primary=Primary, primaryPreferred=PrimaryPreferred, secondary=Secondary,
+                        secondaryPreferred=SecondaryPreferred, nearest=Nearest)
+
+
+def make_read_preference(mode: str,
+                         max_staleness_s: Optional[int] = None):
+    """
+    PyMongo read preference for a mode (see READ_PREFERENCES). max_staleness_s bounds how far behind the primary a
+    secondary may be to serve the read (the server requires at least 90 s). It doesn't apply to 'primary'.
+    """
+    assert mode in READ_PREFERENCES
+    if mode == 'primary':
+        return Primary()
+    return READ_PREFERENCES[mode](max_staleness=-1 if max_staleness_s is None else max_staleness_s)
+
+def make_mongodb_client(db_config: Dict[str, Union[str, int]]) -> MongoClient:
+    """
+    Client for a db_config with 'host' and 'port'. Optional keys for replica sets:
+        - 'hosts': list of 'host:port' seeds, instead of 'host' and 'port'
+        - 'replica_set': name of the replica set
+        - 'read_preference', 'max_staleness_s': default read preference (see make_read_preference())
+        - 'local_threshold_ms': reads go to a random eligible member among those whose latency is within this of the
+          fastest one
+    The client monitors the health and latency of all members and only selects healthy ones.
+    """
+    kwargs = dict(retryReads=True, retryWrites=True)
+    if db_config.get('replica_set') is not None:
+        kwargs['replicaSet'] = db_config['replica_set']
+    if db_config.get('read_preference') is not None:
+        kwargs['readPreference'] = db_config['read_preference']
+    if db_config.get('max_staleness_s') is not None:
+        kwargs['maxStalenessSeconds'] = db_config['max_staleness_s']
+    if db_config.get('local_threshold_ms') is not None:
+        kwargs['localThresholdMS'] = db_config['local_threshold_ms']
+    if db_config.get('hosts') is not None:
+        return MongoClient(db_config['hosts'], **kwargs)
+    return MongoClient(db_config['host'], db_config['port'], **kwargs)
+
+class NamespaceCatalog():
+    """
+    Cached lists of the databases and collections on a server, shared by all engines that use the same client (see
+    acquire_mongodb_client()). Lists are fetched on first use and refetched once they're older than ttl_s or when
+    refresh=True.
+    """
+    def __init__(self,
+                 client: MongoClient,
+                 ttl_s: float = MONGODB_CATALOG_TTL_S):
+        self._client = client
+        self._ttl_s = ttl_s
+        self._lock = threading.Lock()
+        self._entries: Dict[Optional[str], Tuple[float, List[str]]] = {} # None (databases) or database -> lists
+
+    def _get(self,
+             key: Optional[str],
+             fetch: Callable[[], List[str]],
+             refresh: bool) \
+            -> List[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+        if refresh or entry is None or time.monotonic() - entry[0] > self._ttl_s:
+            entry = (time.monotonic(), fetch())
+            with self._lock:
+                self._entries[key] = entry
+        return list(entry[1])
+
+    def get_databases(self, refresh: bool = False) -> List[str]:
+        """Names of all databases"""
+        return self._get(None, self._client.list_database_names, refresh)
+
+    def get_collections(self,
+                        database: str,
+                        refresh: bool = False) \
+            -> List[str]:
+        """Names of all collections in a database"""
+        return self._get(database, self._client[database].list_collection_names, refresh)
+
+    def invalidate(self):
+        """Drop all cached lists"""
+        with self._lock:
+            self._entries.clear()
+
+
+_CLIENTS: Dict[Tuple[int, str], list] = {} # (pid, client key) -> [client, catalog, number of engines using it]
+_CLIENTS_LOCK = threading.Lock()
+
+def _get_client_key(db_config: Dict[str, Union[str, int]]) -> str:
+    """Key of a db_config. Engines compute it once, so that later changes to the caller's dict don't affect them."""
+    return repr(sorted(db_config.items()))
+
+def acquire_mongodb_client(db_config: Dict[str, Union[str, int]],
+                           client_key: Optional[str] = None) \
+        -> Tuple[MongoClient, NamespaceCatalog]:
+    """
+    Get the client (and namespace catalog) shared by all engines of this process with the same db_config (or
+    client_key, see _get_client_key()), creating it if needed. Clients aren't shared with forked child processes,
+    which get their own. Creating a client doesn't block on the network: it connects in the background. Each call must
+    be matched by a call to release_mongodb_client() with the same key.
+    """
+    key = (os.getpid(), client_key if client_key is not None else _get_client_key(db_config))
+    with _CLIENTS_LOCK:
+        if key not in _CLIENTS:
+            client = make_mongodb_client(db_config)
+            _CLIENTS[key] = [client, NamespaceCatalog(client), 0]
+        _CLIENTS[key][2] += 1
+        return _CLIENTS[key][0], _CLIENTS[key][1]
 
-from ytpa_utils.val_utils import is_list_of_instances
+def release_mongodb_client(client_key: str):
+    """
+    Release a client acquired with acquire_mongodb_client(). It's closed once no engine of this process uses it. A
+    client acquired before a fork isn't released by the child.
+    """
+    key = (os.getpid(), client_key)
+    with _CLIENTS_LOCK:
+        entry = _CLIENTS.get(key)
+        if entry is None:
+            return
+        entry[2] -= 1
+        if entry[2] > 0:
+            return
+        del _CLIENTS[key]
+    entry[0].close()
 
-from .constants import MONGODB_FIND_MANY_MAX_COUNT
+def make_mongodb_engine_error(e: Exception) -> DBEngineError:
+    """Convert a driver error to the engine's structured exception"""
+    if isinstance(e, DBEngineError): # already converted, or raised by the engine (e.g. AdmissionError)
+        return e
+    return MongoDBEngineError(f'MongoDBEngine: {e}', code=getattr(e, 'code', None),
+                              attempts=getattr(e, 'db_engine_attempts', 1))
 
 
 
 class MongoDBEngine():
-    """Convenience class for interactions with a MongoDB database"""
+    """
+    Convenience class for interactions with a MongoDB database.
+
+    Failed operations are retried according to retry_policy (see retry_utils.RetryPolicy). Errors that persist are
+    raised as MongoDBEngineError.
+
+    If cache_size > 0, find_one_by_id() and find_one() results are cached in-process (LRU, up to cache_size entries
+    that expire after cache_ttl_s, if specified). The engine's own writes drop the cached lookups on the collection
+    they write to, so a process always reads its own writes. To also see other processes' writes, run
+    start_cache_invalidation() (requires a replica set) or set a short cache_ttl_s.
+
+    For replica sets, see make_mongodb_client() for the db_config options. The find_* methods take a per-call
+    read_preference (e.g. 'secondaryPreferred' for scans that can tolerate staleness) and max_staleness_s (see
+    make_read_preference()); by default they use the client's read preference, i.e. the primary unless configured
+    otherwise. Point lookups with a non-primary read preference bypass the cache.
+
+    Thread safety: an engine can be shared by many threads, e.g. to run concurrent scans in a thread pool. The client
+    is thread-safe and pools connections, each generator owns its cursor, and every operation resolves the target
+    collection when it's called. Don't call set_db_info() while other threads use the engine; use one engine per
+    collection instead.
+
+    Reads can be bounded in time with query_timeout_s (for all find_* methods) or their timeout_s argument (per call,
+    overrides query_timeout_s). The timeout is a deadline for the whole call, retries included, and is passed to the
+    server as maxTimeMS, which stops the query once it passes (error code 50). Generators close their cursor as soon
+    as they are exhausted, closed or garbage-collected, which releases it on the server.
+
+    With single_flight='engine' or 'process', identical concurrent find_one_by_id(), find_one(), find_many_by_ids() and
+    find_many() (in-memory results) calls share one execution, e.g. when many threads miss the cache at once: see
+    singleflight_utils.make_single_flight() for the scopes and get_single_flight_stats() for the number of deduplicated
+    calls. A call that joins one in flight gets its result even if it asked for a different timeout.
+
+    With an admission_policy (see admission_utils.AdmissionPolicy), the number of concurrent operations on the
+    deployment (all engines of the process with the same db_config) is limited, with priority queueing (see
+    admission_utils.priority()) and optionally an adaptive limit. Generators hold a slot while they fetch a chunk.
+
+    With a dtype_policy (see dtype_utils.DtypePolicy), the DataFrames of the find_* methods get compact dtypes (e.g.
+    string[pyarrow] for string fields, datetime64[ms] for dates). Since collections have no schema, the dtypes of a
+    generator's fields are inferred from the first chunk they appear in and kept for the following chunks.
+
+    Construction is cheap and does no network I/O: engines with the same db_config share one client (see
+    acquire_mongodb_client()) and the target database and collection are only checked if validate=True (see
+    validate_namespace()). Call close() when done with an engine, or let it be garbage-collected.
+    """
     def __init__(self,
                  db_config: Dict[str, Union[str, int]],
                  database: Optional[str] = None,
                  collection: Optional[str] = None,
-                 verbose: bool = False):
+                 verbose: bool = False,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 cache_size: int = 0,
+                 cache_ttl_s: Optional[float] = None,
+                 validate: bool = False,
+                 query_timeout_s: Optional[float] = None,
+                 single_flight: Optional[str] = None,
+                 admission_policy: Optional[AdmissionPolicy] = None,
+                 dtype_policy: Optional[DtypePolicy] = None):
+        self._db_client = None
+        self._admission_policy = admission_policy
+        self._dtype_policy = dtype_policy
+        self._query_timeout_s = query_timeout_s
+        self._single_flight: Optional[SingleFlight] = make_single_flight(single_flight)
         self._db_config = db_config
+        self._client_key = _get_client_key(db_config) # fixed, even if the caller changes db_config later
         self._database = None
         self._collection = None
         self._verbose = verbose
+        self._retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self._cache = LRUCache(max_size=cache_size, ttl_s=cache_ttl_s) if cache_size > 0 else None
+        self._cache_invalidation_stop: Optional[threading.Event] = None
 
-        self._db_client = MongoClient(self._db_config['host'], self._db_config['port'])
+        self._db_client, self._catalog = acquire_mongodb_client(self._db_config, self._client_key)
 
-        self.set_db_info(database=database, collection=collection)
-
-        self._cursor = None # to ensure that client stays open in generators
+        self.set_db_info(database=database, collection=collection, validate=validate)
 
     def __del__(self):
-        self._db_client.close()
+        self.close()
+
+    def close(self):
+        """Release the engine's client, which is closed once no other engine uses it"""
+        if self._db_client is None:
+            return
+        self.stop_cache_invalidation()
+        self._db_client = None
+        release_mongodb_client(self._client_key)
 
     def set_db_info(self,
                     database: Optional[str] = None,
-                    collection: Optional[str] = None):
-        """Set database and collection to be used in db op calls"""
+                    collection: Optional[str] = None,
+                    validate: bool = False):
+        """Set database and collection to be used in db op calls. See validate_namespace() for 'validate'."""
         if database is not None:
-            if database not in self.get_all_databases():
-                if self._verbose:
-                    print(f"MongoDBEngine.set_bg_info() -> Database {database} does not exist.")
             self._database = database
         if collection is not None:
-            try:
-                collections = [cn for cns in self.get_all_collections(database=database).values() for cn in cns]
-                if collection not in collections:
-                    if self._verbose:
-                        print(f"MongoDBEngine.set_bg_info() -> Collection {collection} "
-                              f"does not exist in database {database}.")
-            except:
-                if self._verbose:
-                    print(f"MongoDBEngine.set_bg_info() -> Collection {collection} or database {database} "
-                          f"does not exist.")
             self._collection = collection
+        if validate:
+            self.validate_namespace()
+
+    def validate_namespace(self) -> bool:
+        """
+        Check that the targeted database and collection exist, using the catalog of databases and collections shared by
+        engines on the same client (see NamespaceCatalog). Missing names are checked again against a fresh catalog
+        before being reported, so newly created ones are found. Prints a warning if verbose.
+        """
+        def exists(refresh: bool) -> bool:
+            if self._database is not None and self._database not in self._catalog.get_databases(refresh=refresh):
+                return False
+            if self._collection is not None and self._database is not None and \
+                    self._collection not in self._catalog.get_collections(self._database, refresh=refresh):
+                return False
+            return True
+
+        try:
+            exists_ = exists(False) or exists(True)
+        except PyMongoError:
+            exists_ = False
+        if not exists_ and self._verbose:
+            print(f"MongoDBEngine.validate_namespace() -> Collection {self._collection} or database {self._database} "
+                  f"does not exist.")
+        return exists_
 
     def get_db_info(self):
         """Get currently targeted database and collection"""
@@ -67,26 +319,170 @@ class MongoDBEngine():
     def get_db_config(self) -> Dict[str, str]:
         return self._db_config
 
-    def _query_wrapper(self, func: Callable):
-        """Wrapper for exception handling during MongoDB queries"""
+    def _admit(self,
+               deadline: Optional[Deadline] = None,
+               measure: bool = True):
+        """Context in which an operation runs once admitted (see admission_utils)"""
+        if self._admission_policy is None:
+            return nullcontext()
+        controller = get_admission_controller(f'mongodb://{self._client_key}', self._admission_policy)
+        return controller.admit(deadline=deadline, measure=measure, is_overload_error=is_mongodb_overload_error)
+
+    def get_admission_stats(self) -> Optional[dict]:
+        """Admission control stats. None if admission control is disabled."""
+        if self._admission_policy is None:
+            return None
+        return get_admission_controller(f'mongodb://{self._client_key}',
+                                        self._admission_policy).get_stats()
+
+    def _query_wrapper(self,
+                       func: Callable,
+                       idempotent: bool = False,
+                       deadline: Optional[Deadline] = None,
+                       admit: bool = True):
+        """
+        Wrapper for exception handling during MongoDB queries. Retries stop at the deadline, if specified. Each attempt
+        waits for admission (see _admit()) unless admit is False, e.g. when func() only builds a generator, which is
+        admitted as it fetches.
+        """
+        def func_():
+            with self._admit(deadline=deadline) if admit else nullcontext():
+                return func()
+
         try:
+            return call_with_retries(func_, self._retry_policy,
+                                     lambda e: is_mongodb_error_retryable(e, idempotent, self._retry_policy),
+                                     deadline=deadline)
+        except PyMongoError as e: # programming errors (e.g. AssertionError) propagate as is
+            raise make_mongodb_engine_error(e) from e
+
+    def _write_wrapper(self,
+                       func: Callable,
+                       idempotent: bool = False,
+                       database: Optional[str] = None):
+        """
+        Wrapper for writes. Afterwards (even if the write failed partway), drops the cached lookups on the current
+        collection or on all collections of 'database', if specified, and stops later reads from joining in-flight ones
+        (see _coalesce()).
+        """
+        namespace = (self._database, self._collection) if database is None else (database,)
+        try:
+            return self._query_wrapper(func, idempotent=idempotent)
+        finally:
+            if self._cache is not None:
+                self._cache.invalidate_where(lambda key: key[:len(namespace)] == namespace)
+            if self._single_flight is not None:
+                prefix = (self._client_key,) + namespace
+                self._single_flight.invalidate_where(lambda key: key[:len(prefix)] == prefix)
+
+    def _coalesce(self,
+                  key: tuple,
+                  func: Callable):
+        """
+        Run func() through the single-flight layer (if enabled), sharing it with concurrent calls with the same key on
+        the current collection
+        """
+        if self._single_flight is None:
             return func()
-        except Exception as e:
-            print(e)
+        return self._single_flight.do((self._client_key, self._database, self._collection) + key, func)
+
+    def get_single_flight_stats(self) -> Optional[dict]:
+        """Calls, executions and deduplicated calls of the single-flight layer. None if it's disabled."""
+        if self._single_flight is None:
+            return None
+        return self._single_flight.get_stats()
+
+    def _cached_read(self,
+                     key: tuple,
+                     func: Callable,
+                     read_preference: Optional[str] = None,
+                     deadline: Optional[Deadline] = None,
+                     max_staleness_s: Optional[int] = None):
+        """
+        Read-through lookup in the cache (if enabled). Callers get their own copy of cached records. Concurrent
+        lookups of the same key are coalesced (see _coalesce()).
+        """
+        coalesce_key = key + (read_preference, max_staleness_s)
+        fetch = lambda: self._coalesce(coalesce_key,
+                                       lambda: self._query_wrapper(func, idempotent=True, deadline=deadline))
+        if self._cache is None or read_preference not in [None, 'primary']:
+            return fetch()
+        cache_key = (self._database, self._collection) + key
+        found, rec = self._cache.get(cache_key)
+        if not found:
+            version = self._cache.get_version()
+            rec = fetch()
+            self._cache.put(cache_key, rec, version=version)
+        return copy.deepcopy(rec)
+
+
+    ## cache ##
+    def get_cache_stats(self) -> Optional[dict]:
+        """Cache hits, misses and size. None if caching is disabled."""
+        if self._cache is None:
+            return None
+        return dict(num_hits=self._cache.num_hits, num_misses=self._cache.num_misses, size=len(self._cache))
+
+    def clear_cache(self):
+        """Drop all cached lookups"""
+        if self._cache is not None:
+            self._cache.clear()
+
+    def start_cache_invalidation(self, max_await_time_ms: int = 1000):
+        """
+        Keep the cache coherent with writes made by other processes by tailing the current collection's change stream on
+        a background thread. Any change drops the cached lookups on the collection. If the stream fails, the whole
+        cache is dropped and the stream is reopened. Requires a replica set. Stop with stop_cache_invalidation().
+        """
+        assert self._cache is not None and self._cache_invalidation_stop is None
+        stop = threading.Event()
+        self._cache_invalidation_stop = stop
+        namespace = (self._database, self._collection)
+        cn = self._get_collection()
+        cache = self._cache
+
+        stream = cn.watch(full_document=None, max_await_time_ms=max_await_time_ms) # fail here if not supported
+        cache.clear()
+
+        def invalidate():
+            nonlocal stream
+            while not stop.is_set():
+                try:
+                    if stream is None:
+                        stream = cn.watch(full_document=None, max_await_time_ms=max_await_time_ms)
+                        cache.clear()
+                    if stream.try_next() is not None:
+                        cache.invalidate_where(lambda key: key[:2] == namespace)
+                except PyMongoError:
+                    cache.clear()
+                    if stream is not None:
+                        stream.close()
+                    stream = None
+                    stop.wait(max_await_time_ms / 1000)
+            if stream is not None:
+                stream.close()
+
+        threading.Thread(target=invalidate, daemon=True).start()
+
+    def stop_cache_invalidation(self):
+        """Stop the background change-stream invalidation started by start_cache_invalidation()"""
+        if self._cache_invalidation_stop is not None:
+            self._cache_invalidation_stop.set()
+            self._cache_invalidation_stop = None
 
 
     ## DB inspection ##
     def get_all_databases(self) -> List[str]:
-        """Get all databases"""
-        return self._db_client.list_database_names()
+        """Get all databases (fetched from the server, which also refreshes the shared catalog)"""
+        return self._catalog.get_databases(refresh=True)
 
     def get_all_collections(self, database: Optional[str] = None) -> Dict[str, List[str]]:
-        """Get all collections by database or just those for a specified database"""
+        """Get all collections by database or just those for a specified database (also refreshes the shared catalog)"""
         if database is not None:
             databases = [database]
         else:
             databases = self.get_all_databases()
-        return {database: self._db_client[database].list_collection_names() for database in databases}
+        return {database: self._catalog.get_collections(database, refresh=True) for database in databases}
 
     def get_ids(self) -> List[str]:
         """Get all IDs for a collection"""
@@ -101,11 +497,28 @@ class MongoDBEngine():
             return ids
 
     ## DB operations ##
-    def _get_collection(self) -> Collection:
-        """Get collection object for queries"""
+    def _make_deadline(self, timeout_s: Optional[float] = None) -> Optional[Deadline]:
+        """Deadline for a call with a per-call timeout, defaulting to the engine's"""
+        return Deadline.from_timeout(timeout_s if timeout_s is not None else self._query_timeout_s)
+
+    @staticmethod
+    def _max_time_kwargs(deadline: Optional[Deadline],
+                         key: str = 'max_time_ms') \
+            -> dict:
+        """Server-side time limit for the rest of a deadline, as keyword args to find() or aggregate() ('maxTimeMS')"""
+        return {} if deadline is None else {key: deadline.remaining_ms()}
+
+    def _get_collection(self,
+                        read_preference: Optional[str] = None,
+                        max_staleness_s: Optional[int] = None) \
+            -> Collection:
+        """Get collection object for queries, optionally with a read preference (see make_read_preference())"""
         assert self._database is not None
         assert self._collection is not None
-        return self._db_client[self._database][self._collection]
+        cn = self._db_client[self._database][self._collection]
+        if read_preference is not None:
+            cn = cn.with_options(read_preference=make_read_preference(read_preference, max_staleness_s))
+        return cn
 
     def insert_one(self, record: dict):
         """Insert one record"""
@@ -113,8 +526,8 @@ class MongoDBEngine():
             cn = self._get_collection()
 
             if ('_id' in record) and (cn.find_one({"_id": record['_id']}) is not None):
-                raise Exception(f'MongoDBEngine: A record with id {record["_id"]} already exists in collection '
-                                f'{self._collection} of database {self._database}.')
+                raise MongoDBEngineError(f'MongoDBEngine: A record with id {record["_id"]} already exists in '
+                                         f'collection {self._collection} of database {self._database}.')
 
             res = cn.insert_one(record)
 
@@ -122,19 +535,20 @@ class MongoDBEngine():
                 print(f'MongoDBEngine: Inserted {1} record with id {res.inserted_id} in collection {self._collection} '
                       f'of database {self._database}.')
 
-        return self._query_wrapper(func)
+        return self._write_wrapper(func)
 
-    def insert_many(self, records: List[dict]):
-        """Insert many records"""
-        def func():
+    def insert_many(self, records: List[dict]) -> int:
+        """Insert many records. Returns the number of records inserted (failed ones, e.g. duplicates, are skipped)."""
+        def func() -> int:
             try:
                 cn = self._get_collection()
-                cn.insert_many(records, ordered=False)
+                return len(cn.insert_many(records, ordered=False).inserted_ids)
             except BulkWriteError as e:
                 if self._verbose:
                     writeErrors = e.details['writeErrors']
                     print(f"Failed to write {len(writeErrors)} out of {len(records)} records.")
-        return self._query_wrapper(func)
+                return e.details['nInserted']
+        return self._write_wrapper(func, idempotent=True) # ids are assigned client-side, duplicates are skipped
 
     def update_one(self,
                    filter: dict,
@@ -144,7 +558,7 @@ class MongoDBEngine():
         def func():
             cn = self._get_collection()
             cn.update_one(filter, update, upsert=upsert)
-        return self._query_wrapper(func)
+        return self._write_wrapper(func)
 
     def update_many(self,
                     filter: dict,
@@ -160,64 +574,85 @@ class MongoDBEngine():
                 if self._verbose:
                     print(f'Updating {len(update_i)} records.')
                 cn.update_many(filter, update_i, upsert=upsert)
-        return self._query_wrapper(func)
+        return self._write_wrapper(func)
+
+    def find_one_by_id(self,
+                       id: str,
+                       read_preference: Optional[str] = None,
+                       max_staleness_s: Optional[int] = None,
+                       timeout_s: Optional[float] = None) \
+            -> Optional[dict]:
+        """Find a single record. Returns None if there is no record with that id. Cached if caching is enabled."""
+        deadline = self._make_deadline(timeout_s)
 
-    def find_one_by_id(self, id: str) -> Optional[dict]:
-        """Find a single record"""
         def func():
-            cn = self._get_collection()
+            cn = self._get_collection(read_preference, max_staleness_s)
 
             # try provided id as-is
-            rec = cn.find_one({"_id": id})
+            rec = cn.find_one({"_id": id}, **self._max_time_kwargs(deadline))
             if rec is not None:
                 return rec
 
             # try converting to ObjectId
-            rec = cn.find_one({"_id": ObjectId(id)})
-            if rec is not None:
-                return rec
+            if isinstance(id, str) and ObjectId.is_valid(id):
+                return cn.find_one({"_id": ObjectId(id)}, **self._max_time_kwargs(deadline))
 
-            # fail
-            raise Exception(f'Could not find record with _id {id}.')
+            return None
 
-        return self._query_wrapper(func)
+        return self._cached_read(('id', id), func, read_preference, deadline=deadline, max_staleness_s=max_staleness_s)
 
     def find_one(self,
                  filter: Optional[dict] = None,
-                 projection: Optional[dict] = None) \
+                 projection: Optional[dict] = None,
+                 read_preference: Optional[str] = None,
+                 max_staleness_s: Optional[int] = None,
+                 timeout_s: Optional[float] = None) \
             -> dict:
-        """Same as self.find_many_gen() but for a single record."""
+        """Same as self.find_many_gen() but for a single record. Cached if caching is enabled."""
         if filter is None:
             filter = {}
+        deadline = self._make_deadline(timeout_s)
 
         def func():
-            cn = self._get_collection()
+            cn = self._get_collection(read_preference, max_staleness_s)
             if projection is None:
-                cursor = cn.find(filter, limit=1)
+                cursor = cn.find(filter, limit=1, **self._max_time_kwargs(deadline))
             else:
-                cursor = cn.find(filter, projection, limit=1)
+                cursor = cn.find(filter, projection, limit=1, **self._max_time_kwargs(deadline))
             return next(cursor, None)
-        return self._query_wrapper(func)
+        return self._cached_read(('one', repr(filter), repr(projection)), func, read_preference, deadline=deadline,
+                                 max_staleness_s=max_staleness_s)
 
     def find_many_by_ids(self,
                          ids: Optional[List[str]] = None,
                          limit: int = 0,
-                         filter_other: Optional[dict] = None) \
+                         filter_other: Optional[dict] = None,
+                         read_preference: Optional[str] = None,
+                         max_staleness_s: Optional[int] = None,
+                         timeout_s: Optional[float] = None) \
             -> List[dict]:
         """Find many records"""
+        deadline = self._make_deadline(timeout_s)
+
         def func():
-            cn = self._get_collection()
+            cn = self._get_collection(read_preference, max_staleness_s)
             filter = {} if ids is None else {"_id": {"$in": ids}}
             if filter_other is not None:
                 filter = {**filter, **filter_other}
-            cursor = cn.find(filter, limit=limit)
+            cursor = cn.find(filter, limit=limit, **self._max_time_kwargs(deadline))
             return [d for d in cursor]
-        return self._query_wrapper(func)
+        key = ('many_by_ids', repr(ids), limit, repr(filter_other), read_preference, max_staleness_s)
+        return self._coalesce(key, lambda: self._query_wrapper(func, idempotent=True, deadline=deadline))
 
     def find_many_gen(self,
                       filter: Optional[dict] = None,
-                      projection: Optional[dict] = None) \
-            -> Generator[pd.DataFrame, None, None]:
+                      projection: Optional[dict] = None,
+                      prefetch: int = 0,
+                      read_preference: Optional[str] = None,
+                      max_staleness_s: Optional[int] = None,
+                      timeout_s: Optional[float] = None,
+                      mode: str = 'pandas') \
+            -> Generator[Union[pd.DataFrame, list, dict], None, None]:
         """
         Generator of records given optional filter and projection arguments.
 
@@ -227,48 +662,214 @@ class MongoDBEngine():
         - 'projection' is a dict with fields to return, analogous to "SELECT item, status FROM ..."
           instead of "SELECT * FROM ..." in a SQL query:
             e.g. {"item": 1, "status": 1, "_id": 0} # this drops '_id' in the returned dict
+        - 'prefetch' is the number of chunks to fetch and convert ahead of the consumer on a background thread (see
+          pipeline_utils.prefetch_gen()). 0 disables prefetching.
+        - 'read_preference' and 'max_staleness_s' route the scan, e.g. to secondaries (see make_read_preference()).
+        - 'timeout_s' bounds the server time spent on the scan (see the class docstring).
+        - 'mode' is the format of the chunks: 'pandas' (DataFrames), or for small, latency-sensitive queries 'list'
+          (the records as dicts), 'records' (namedtuples) or 'columns' (dict of field -> list of values), see
+          record_utils.format_dicts().
         """
+        assert mode in ['pandas', 'list'] + RECORD_MODES
         if filter is None:
             filter = {}
+        deadline = self._make_deadline(timeout_s)
 
         def func():
-            cn = self._get_collection()
-            if projection is None:
-                self._cursor = cn.find(filter)
-            else:
-                self._cursor = cn.find(filter, projection)
-            return self._df_generator()
+            cn = self._get_collection(read_preference, max_staleness_s)
+            gen = self._df_generator(lambda skip: cn.find(filter, projection, skip=skip,
+                                                          **self._max_time_kwargs(deadline)),
+                                     deadline=deadline, mode=mode)
+            return prefetch_gen(gen, max_prefetch=prefetch) if prefetch > 0 else gen
 
-        return self._query_wrapper(func)
+        return self._query_wrapper(func, admit=False) # see _df_generator() for admission
 
     def find_with_group_gen(self,
                             group: dict,
-                            filter: Optional[dict] = None) \
-            -> Generator[pd.DataFrame, None, None]:
-        """Find records using an aggregation pipeline"""
+                            filter: Optional[dict] = None,
+                            prefetch: int = 0,
+                            read_preference: Optional[str] = None,
+                            max_staleness_s: Optional[int] = None,
+                            timeout_s: Optional[float] = None,
+                            mode: str = 'pandas') \
+            -> Generator[Union[pd.DataFrame, list, dict], None, None]:
+        """Find records using an aggregation pipeline. See find_many_gen() for the other options."""
+        deadline = self._make_deadline(timeout_s)
+
         def func():
-            cn = self._get_collection()
+            cn = self._get_collection(read_preference, max_staleness_s)
 
             pipeline = []
             if filter is not None:
                 pipeline += [filter]
             pipeline += [{"$group": group}]
 
-            self._cursor = cn.aggregate(pipeline)
-            return self._df_generator()
+            gen = self._df_generator(lambda skip: cn.aggregate(pipeline + ([{"$skip": skip}] if skip > 0 else []),
+                                                               **self._max_time_kwargs(deadline, 'maxTimeMS')),
+                                     deadline=deadline, mode=mode)
+            return prefetch_gen(gen, max_prefetch=prefetch) if prefetch > 0 else gen
+
+        return self._query_wrapper(func, admit=False) # see _df_generator() for admission
 
-        return self._query_wrapper(func)
+    def aggregate_gen(self,
+                      pipeline: List[dict],
+                      prefetch: int = 0,
+                      read_preference: Optional[str] = None,
+                      max_staleness_s: Optional[int] = None,
+                      timeout_s: Optional[float] = None,
+                      mode: str = 'pandas') \
+            -> Generator[Union[pd.DataFrame, list, dict], None, None]:
+        """Generator of records produced by an arbitrary aggregation pipeline. See find_many_gen() for the options."""
+        deadline = self._make_deadline(timeout_s)
+
+        def func():
+            cn = self._get_collection(read_preference, max_staleness_s)
+            gen = self._df_generator(lambda skip: cn.aggregate(pipeline + ([{"$skip": skip}] if skip > 0 else []),
+                                                               **self._max_time_kwargs(deadline, 'maxTimeMS')),
+                                     deadline=deadline, mode=mode)
+            return prefetch_gen(gen, max_prefetch=prefetch) if prefetch > 0 else gen
+
+        return self._query_wrapper(func, admit=False) # see _df_generator() for admission
 
     def find_many(self,
                   filter: Optional[dict] = None,
-                  projection: Optional[dict] = None) \
+                  projection: Optional[dict] = None,
+                  spill_path: Optional[str] = None,
+                  spill_as_arrow: bool = False,
+                  read_preference: Optional[str] = None,
+                  max_staleness_s: Optional[int] = None,
+                  timeout_s: Optional[float] = None) \
             -> pd.DataFrame:
-        """Batch version of find_many_gen. Careful with size of returned dataframe."""
-        return pd.concat([df for df in self.find_many_gen(filter=filter, projection=projection)], ignore_index=True)
+        """
+        Batch version of find_many_gen. Careful with size of returned dataframe.
+
+        For results that may not fit in memory, specify spill_path: records are streamed to a local Arrow IPC file at
+        that path and returned memory-mapped (see io_utils.spill_chunks_to_file()). Records must have the fields of
+        the first chunk (specify a projection otherwise). Requires pyarrow.
+        """
+        if spill_path is not None:
+            df_gen = self.find_many_gen(filter=filter, projection=projection, read_preference=read_preference,
+                                        max_staleness_s=max_staleness_s, timeout_s=timeout_s)
+            return spill_chunks_to_file(df_gen, spill_path, as_arrow=spill_as_arrow)
+
+        def func():
+            df_gen = self.find_many_gen(filter=filter, projection=projection, read_preference=read_preference,
+                                        max_staleness_s=max_staleness_s, timeout_s=timeout_s)
+            return categorize(pd.concat([df for df in df_gen], ignore_index=True), self._dtype_policy)
+        key = ('many', repr(filter), repr(projection), read_preference, max_staleness_s)
+        return self._coalesce(key, func)
+
+    def export_records(self,
+                       path: str,
+                       filter: Optional[dict] = None,
+                       projection: Optional[dict] = None,
+                       format: str = 'parquet',
+                       compression: Optional[str] = None,
+                       partition_col: Optional[str] = None,
+                       schema=None,
+                       on_new_columns: str = 'error',
+                       prefetch: int = 1,
+                       timeout_s: Optional[float] = None) \
+            -> dict:
+        """
+        Stream records (see find_many_gen() for filter and projection) into a Parquet, CSV or Feather file without
+        materializing them in memory. ObjectIds are stored as strings.
+
+        The file schema is taken from the first chunk. If records don't all have the same fields, specify a projection
+        or a schema. See io_utils.write_chunks_to_file() for the other options. Requires pyarrow.
+        """
+        df_gen = self.find_many_gen(filter=filter, projection=projection, prefetch=prefetch, timeout_s=timeout_s)
+        return write_chunks_to_file(df_gen, path, format=format, compression=compression,
+                                    partition_col=partition_col, schema=schema, on_new_columns=on_new_columns)
+
+    def find_page(self,
+                  sort_keys: Optional[List[str]] = None,
+                  filter: Optional[dict] = None,
+                  projection: Optional[dict] = None,
+                  page_size: int = MONGODB_FIND_MANY_MAX_COUNT,
+                  cursor_token: Optional[str] = None,
+                  descending: bool = False,
+                  read_preference: Optional[str] = None,
+                  max_staleness_s: Optional[int] = None,
+                  timeout_s: Optional[float] = None) \
+            -> Tuple[pd.DataFrame, Optional[str]]:
+        """
+        Keyset (seek) pagination over a collection.
+
+        Records are sorted by sort_keys (e.g. ['id_meta', 'timestamp_stats']) with '_id' appended as a tie-breaker
+        if it isn't already one of the keys, so that the sort order is total. Each page resumes after the last key
+        of the previous page instead of skipping over all previous records. Filter and projection are as in
+        find_many_gen().
+
+        Returns the page and an opaque token to pass as cursor_token to get the next page. The token is None once the
+        last page has been returned.
+        """
+        deadline = self._make_deadline(timeout_s)
+
+        def func():
+            df, token_last, num_recs = self._find_page(sort_keys, filter, projection, page_size, cursor_token,
+                                                       descending, read_preference, max_staleness_s, deadline=deadline)
+            return df, (token_last if num_recs == page_size else None)
+        return self._query_wrapper(func, idempotent=True, deadline=deadline)
+
+    def find_page_records(self,
+                          sort_keys: Optional[List[str]] = None,
+                          cursor_token: Optional[str] = None,
+                          page_size: int = MONGODB_FIND_MANY_MAX_COUNT,
+                          filter: Optional[dict] = None,
+                          projection: Optional[dict] = None,
+                          read_preference: Optional[str] = None,
+                          max_staleness_s: Optional[int] = None,
+                          timeout_s: Optional[float] = None) \
+            -> Tuple[List[dict], Optional[str]]:
+        """
+        Same as find_page() (ascending) but returns the records as dicts and the token of the last record, which is None
+        only if the page is empty. For callers that track a watermark, e.g. a sync that polls for new records.
+        """
+        deadline = self._make_deadline(timeout_s)
+
+        def func():
+            recs, token_last, keys_drop = self._find_page_recs(sort_keys, filter, projection, page_size, cursor_token,
+                                                               False, read_preference, max_staleness_s,
+                                                               deadline=deadline)
+            if keys_drop:
+                recs = [{key: val for key, val in rec.items() if key not in keys_drop} for rec in recs]
+            return recs, token_last
+        return self._query_wrapper(func, idempotent=True, deadline=deadline)
+
+    def find_many_resumable_gen(self,
+                                sort_keys: Optional[List[str]] = None,
+                                filter: Optional[dict] = None,
+                                projection: Optional[dict] = None,
+                                chunk_size: int = MONGODB_FIND_MANY_MAX_COUNT,
+                                resume_token: Optional[str] = None,
+                                checkpoint: Optional[Union[str, Callable[[str], None]]] = None,
+                                with_tokens: bool = False,
+                                read_preference: Optional[str] = None,
+                                max_staleness_s: Optional[int] = None,
+                                timeout_s: Optional[float] = None) \
+            -> Generator[Union[pd.DataFrame, tuple], None, None]:
+        """
+        Resumable version of find_many_gen(), ordered by sort_keys (see find_page()).
+
+        The last emitted key is checkpointed per chunk to a local file or a callback, and the scan can be restarted
+        from a checkpoint token. See keyset_utils.keyset_scan_gen() for the delivery semantics. timeout_s applies to
+        each page, and each page is admitted and retried like a find_page() call.
+        """
+        def fetch_page(token: Optional[str]):
+            deadline = self._make_deadline(timeout_s)
+            return self._query_wrapper(lambda: self._find_page(sort_keys, filter, projection, chunk_size, token, False,
+                                                               read_preference, max_staleness_s, deadline=deadline),
+                                       idempotent=True, deadline=deadline)
+        return keyset_scan_gen(fetch_page, resume_token=resume_token, checkpoint=checkpoint, with_tokens=with_tokens)
 
     def find_distinct_gen(self,
                           field: str,
-                          filter: Optional[dict] = None) \
+                          filter: Optional[dict] = None,
+                          prefetch: int = 0,
+                          read_preference: Optional[str] = None,
+                          max_staleness_s: Optional[int] = None,
+                          timeout_s: Optional[float] = None) \
             -> Generator[pd.DataFrame, None, None]:
         """
         Find all distinct values of a given field.
@@ -279,58 +880,298 @@ class MongoDBEngine():
         assert filter is None or (len(filter) == 1 and '$match' in filter)
         def func():
             group = {"_id": "$" + field}
-            for df in self.find_with_group_gen(group, filter=filter):
-                yield df.rename(columns={'_id': field})
-        return self._query_wrapper(func)
+            gen = self.find_with_group_gen(group, filter=filter, prefetch=prefetch, read_preference=read_preference,
+                                           max_staleness_s=max_staleness_s, timeout_s=timeout_s)
+            try:
+                for df in gen:
+                    yield df.rename(columns={'_id': field})
+            finally:
+                gen.close() # release the cursor now if the consumer stopped early
+        return self._query_wrapper(func, admit=False) # see _df_generator() for admission
 
-    def delete_many(self, ids: Union[List[str], dict]):
-        """Delete records by id"""
-        assert is_list_of_instances(ids, (str, ObjectId)) or ids == {}
+    def watch(self,
+              pipeline: Optional[List[dict]] = None,
+              resume_token: Optional[dict] = None,
+              full_document: Optional[str] = 'updateLookup',
+              max_await_time_ms: Optional[int] = None,
+              batch_size: Optional[int] = None) \
+            -> CollectionChangeStream:
+        """
+        Open a change stream on the collection. Requires a replica set or sharded cluster.
+
+        With full_document='updateLookup', update events carry the current version of the whole document. Pass the
+        stream's resume_token from a previous run to continue where it left off.
+        """
         def func():
             cn = self._get_collection()
-            filter = {"_id": {"$in": ids}} if isinstance(ids, list) else {}
-            cn.delete_many(filter)
-        return self._query_wrapper(func)
+            return cn.watch(pipeline, full_document=full_document, resume_after=resume_token,
+                            max_await_time_ms=max_await_time_ms, batch_size=batch_size)
+        return self._query_wrapper(func, idempotent=True)
+
+    def delete_many(self,
+                    ids: Union[List[str], dict],
+                    batch_size: int = MONGODB_DELETE_MANY_MAX_COUNT,
+                    max_workers: int = 1) \
+            -> int:
+        """
+        Delete records by id, or all records if ids == {}. Returns the number of records deleted.
 
-    def delete_all_records(self, confirm_delete: Optional[str] = None):
-        """Delete all records in a collection"""
+        Ids are deleted in batches of up to batch_size ("$in" lists), so that large lists stay under the command size
+        limit and each batch only holds locks briefly. Each batch is retried on its own, and if max_workers > 1 batches
+        are deleted concurrently.
+        """
+        assert val_utils.is_list_of_instances(ids, (str, ObjectId)) or ids == {}
+        assert batch_size >= 1 and max_workers >= 1
+        cn = self._get_collection()
+
+        def delete(filter: dict) -> int:
+            return self._write_wrapper(lambda: cn.delete_many(filter).deleted_count, idempotent=True)
+
+        if not isinstance(ids, list):
+            return delete({})
+        filters = [{"_id": {"$in": ids[i:i + batch_size]}} for i in range(0, len(ids), batch_size)]
+        if max_workers > 1 and len(filters) > 1:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(filters))) as executor:
+                return sum(executor.map(delete, filters))
+        return sum([delete(filter) for filter in filters])
+
+    def delete_all_records(self,
+                           confirm_delete: Optional[str] = None,
+                           truncate: bool = False):
+        """Delete all records in a collection. See truncate_collection() for 'truncate'."""
         if confirm_delete != 'yes':
             return
-        def func():
-            cn = self._get_collection()
-            cn.delete_many({})
-        return self._query_wrapper(func)
+        database, collection = self._database, self._collection
+        func = lambda: self._clear_collection(database, collection, truncate)
+        return self._write_wrapper(func, idempotent=not truncate)
 
-    def delete_all_records_in_database(self, database: str):
-        """Delete all records in a specified database"""
-        def func():
-            for collection in self.get_all_collections(database=database)[database]:
-                self.set_db_info(database=database, collection=collection)
-                cn = self._get_collection()
-                assert cn.database.name == database
-                assert cn.name == collection
-                cn.delete_many({})
-        return self._query_wrapper(func)
+    def delete_all_records_in_database(self,
+                                       database: str,
+                                       truncate: bool = False,
+                                       max_workers: int = 4):
+        """
+        Delete all records in a specified database. Collections are cleared concurrently, up to max_workers at a time.
+        See truncate_collection() for 'truncate'.
+        """
+        assert max_workers >= 1
+        def clear(collection: str):
+            func = lambda: self._clear_collection(database, collection, truncate)
+            return self._write_wrapper(func, idempotent=not truncate, database=database)
+
+        collections = self.get_all_collections(database=database)[database]
+        if max_workers > 1 and len(collections) > 1:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(collections))) as executor:
+                list(executor.map(clear, collections))
+        else:
+            for collection in collections:
+                clear(collection)
+
+    def truncate_collection(self,
+                            database: Optional[str] = None,
+                            collection: Optional[str] = None):
+        """
+        Delete all records of a collection (default: the current one) by dropping it and recreating it with the same
+        options (e.g. capped, validator, collation) and indexes. This takes constant time, whereas deleting records
+        takes time proportional to their number.
+
+        It isn't atomic: concurrent writes may fail or be lost while the collection is recreated, and change streams on
+        the collection (e.g. start_cache_invalidation()) are invalidated. Don't use it on sharded collections, whose
+        sharding isn't recreated. Views and system collections are left untouched.
+        """
+        database = self._database if database is None else database
+        collection = self._collection if collection is None else collection
+        func = lambda: self._clear_collection(database, collection, True)
+        return self._write_wrapper(func, database=database) # not retried: a retry after the drop would lose indexes
+
+    def _clear_collection(self,
+                          database: str,
+                          collection: str,
+                          truncate: bool):
+        """Delete all records of a collection, by deleting them or by truncating it (see truncate_collection())"""
+        cn = self._db_client[database][collection]
+        if not truncate:
+            cn.delete_many({})
+            return
+        options = cn.options()
+        if 'viewOn' in options or collection.startswith('system.'):
+            return
+        indexes = [IndexModel(list(index['key'].items()),
+                              **{key: val for key, val in index.items() if key not in ['key', 'v', 'ns']})
+                   for index in cn.list_indexes() if index['name'] != '_id_']
+        cn.drop()
+        self._db_client[database].create_collection(collection, **options)
+        if indexes:
+            self._db_client[database][collection].create_indexes(indexes)
 
 
     ## Helper methods ##
-    def _df_generator(self) -> Generator[pd.DataFrame, None, None]:
-        """
-        Generator of DataFrames from records produced by iterating on a PyMongo cursor.
-
-        Note: this method MUST be a member of the engine class. Otherwise an instance of the engine used as a generator
-        may be garbage-collected before the generator can be used, causing a "cannot use client after closing" error.
-        """
-        while 1:
-            recs: List[dict] = []
-            for _ in range(MONGODB_FIND_MANY_MAX_COUNT):
-                rec_ = next(self._cursor, None)
-                if rec_ is None:
-                    break
-                recs.append(rec_)
-            if recs:
-                yield pd.DataFrame(recs)
-            else:
-                return
+    def _find_page(self,
+                   sort_keys: Optional[List[str]],
+                   filter: Optional[dict],
+                   projection: Optional[dict],
+                   page_size: int,
+                   cursor_token: Optional[str],
+                   descending: bool,
+                   read_preference: Optional[str] = None,
+                   max_staleness_s: Optional[int] = None,
+                   deadline: Optional[Deadline] = None) \
+            -> Tuple[pd.DataFrame, Optional[str], int]:
+        """Get one page of a keyset iteration. Returns the page, the token of its last record and its size."""
+        recs, token_last, keys_drop = self._find_page_recs(sort_keys, filter, projection, page_size, cursor_token,
+                                                           descending, read_preference, max_staleness_s,
+                                                           deadline=deadline)
+        df = pd.DataFrame(recs)
+        if keys_drop:
+            df = df.drop(columns=[key for key in keys_drop if key in df.columns])
+        if self._dtype_policy is not None:
+            df = apply_dtypes(df, get_frame_dtypes(df, self._dtype_policy))
+        return df, token_last, len(recs)
+
+    def _find_page_recs(self,
+                        sort_keys: Optional[List[str]],
+                        filter: Optional[dict],
+                        projection: Optional[dict],
+                        page_size: int,
+                        cursor_token: Optional[str],
+                        descending: bool,
+                        read_preference: Optional[str] = None,
+                        max_staleness_s: Optional[int] = None,
+                        deadline: Optional[Deadline] = None) \
+            -> Tuple[List[dict], Optional[str], List[str]]:
+        """Same as _find_page() but returns the raw records and the sort keys that weren't requested"""
+        sort_keys = self._get_keyset_sort_keys(sort_keys)
+        assert page_size > 0
+
+        cn = self._get_collection(read_preference, max_staleness_s)
+        filter_, projection_, keys_drop = self._prep_keyset_query(sort_keys, filter, projection, cursor_token,
+                                                                  descending)
+        direction = -1 if descending else 1
+        cursor = cn.find(filter_, projection_, sort=[(key, direction) for key in sort_keys], limit=page_size,
+                         **self._max_time_kwargs(deadline))
+        recs = [rec for rec in cursor]
+
+        token_last = None
+        if len(recs) > 0:
+            token_last = encode_cursor_token([get_nested_field(recs[-1], key) for key in sort_keys])
+
+        return recs, token_last, keys_drop
+
+    @staticmethod
+    def _get_keyset_sort_keys(sort_keys: Optional[List[str]]) -> List[str]:
+        """Sort keys for keyset iteration, with '_id' appended as a tie-breaker"""
+        sort_keys = [] if sort_keys is None else list(sort_keys)
+        if '_id' not in sort_keys:
+            sort_keys.append('_id')
+        return sort_keys
+
+    @staticmethod
+    def _prep_keyset_query(sort_keys: List[str],
+                           filter: Optional[dict],
+                           projection: Optional[dict],
+                           cursor_token: Optional[str],
+                           descending: bool) \
+            -> Tuple[dict, Optional[dict], List[str]]:
+        """
+        Add the 'after last key' condition to a filter and make sure that the projection returns the sort keys.
+        Also returns the sort keys that were added to the projection and should be dropped from the results.
+        """
+        filter_ = {} if filter is None else filter
+        if cursor_token is not None:
+            keyset_filter = make_mongodb_keyset_filter(sort_keys, decode_cursor_token(cursor_token),
+                                                       descending=descending)
+            filter_ = keyset_filter if len(filter_) == 0 else {'$and': [filter_, keyset_filter]}
+
+        keys_drop: List[str] = []
+        projection_ = projection
+        if projection is not None:
+            projection_ = dict(projection)
+            is_inclusion = any([val for key, val in projection.items() if key != '_id'])
+            for key in sort_keys:
+                if is_inclusion and not projection_.get(key, key == '_id'):
+                    projection_[key] = 1
+                    keys_drop.append(key)
+                elif not is_inclusion and key in projection_ and not projection_[key]:
+                    del projection_[key]
+                    keys_drop.append(key)
 
+        return filter_, projection_, keys_drop
 
+    def _make_df(self,
+                 recs: List[dict],
+                 dtypes: Dict[str, object]) \
+            -> pd.DataFrame:
+        """
+        DataFrame of a chunk of records, with the dtypes of the previous chunks for the fields they had. Fields typed as
+        strings that have other values in this chunk are left as objects in it.
+        """
+        df = pd.DataFrame(recs)
+        if self._dtype_policy is None:
+            return df
+        cols_new = [col for col in df.columns if col not in dtypes]
+        if cols_new:
+            dtypes.update(get_frame_dtypes(df[cols_new], self._dtype_policy))
+            dtypes.update({col: None for col in cols_new if col not in dtypes}) # left to pandas from now on
+        string_dtype = self._dtype_policy.string_dtype
+        cols_mixed = [col for col, dtype in dtypes.items()
+                      if dtype == string_dtype and col in df.columns and not is_str_column(df[col])]
+        return apply_dtypes(df, {col: None if col in cols_mixed else dtype for col, dtype in dtypes.items()})
+
+    def _df_generator(self,
+                      make_cursor: Callable[[int], Cursor],
+                      deadline: Optional[Deadline] = None,
+                      mode: str = 'pandas') \
+            -> Generator[Union[pd.DataFrame, list, dict], None, None]:
+        """
+        Generator of DataFrames (or chunks in another mode, see find_many_gen()) from records produced by iterating on
+        a PyMongo cursor. make_cursor(skip) opens the cursor, skipping the first 'skip' records.
+
+        If opening the cursor or reading from it fails with a retryable error, a new cursor is opened that skips the
+        records that were already delivered, so the consumer sees each record once. This assumes that the cursor
+        returns records in a deterministic order (e.g. sorted on a unique key); prefer find_many_resumable_gen()
+        otherwise. Retries stop at the deadline, if specified. Errors are raised as MongoDBEngineError.
+
+        Each generator owns its cursor, so any number of them can be open on the same engine, in one or several threads.
+        The cursor is closed (releasing it on the server) when the generator is exhausted, closed or garbage-collected.
+
+        Note: this method MUST be a member of the engine class. The generator then holds a reference to the engine,
+        which keeps the engine (and its client) alive until the generator is done. Otherwise the engine may be
+        garbage-collected before the generator can be used, causing a "cannot use client after closing" error.
+        """
+        num_delivered = 0
+        attempt = 1
+        dtypes: Dict[str, object] = {} # fields' dtypes under the dtype policy, fixed by the first chunk they're in
+        cursor: Optional[Cursor] = None
+        try:
+            while 1:
+                recs: List[dict] = []
+                try:
+                    with self._admit(deadline=deadline): # one slot per chunk, not while the consumer holds it
+                        if cursor is None:
+                            cursor = make_cursor(num_delivered) # aggregate() runs the pipeline's first batch here
+                        for _ in range(MONGODB_FIND_MANY_MAX_COUNT):
+                            rec_ = next(cursor, None)
+                            if rec_ is None:
+                                break
+                            recs.append(rec_)
+                except PyMongoError as e:
+                    delay = self._retry_policy.get_backoff(attempt)
+                    if attempt >= self._retry_policy.max_attempts or \
+                            not is_mongodb_error_retryable(e, True, self._retry_policy) or \
+                            (deadline is not None and delay >= deadline.remaining_s()):
+                        e.db_engine_attempts = attempt
+                        raise make_mongodb_engine_error(e) from e
+                    time.sleep(delay)
+                    attempt += 1
+                    if cursor is not None:
+                        cursor.close()
+                        cursor = None
+                    continue
+                if recs:
+                    num_delivered += len(recs)
+                    attempt = 1
+                    yield self._make_df(recs, dtypes) if mode == 'pandas' else format_dicts(recs, mode)
+                else:
+                    return
+        finally:
+            if cursor is not None:
+                cursor.close()
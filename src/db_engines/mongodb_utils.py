@@ -1,11 +1,15 @@
 """Utils that use the MongoDB engine."""
 
-from typing import Optional, Generator, Tuple
+from __future__ import annotations
 
-import pandas as pd
-from ytpa_utils.val_utils import is_list_of_instances
+from typing import Optional, Generator, Tuple
 
 from .mongodb_engine import MongoDBEngine
+from .io_utils import spill_chunks_to_file
+from .lazy_imports import LazyModule
+
+pd = LazyModule('pandas')
+val_utils = LazyModule('ytpa_utils.val_utils')
 
 
 def get_mongodb_records_gen(database: str,
@@ -50,9 +54,9 @@ def get_mongodb_records_gen(database: str,
             for key, val in filter.items():
                 if isinstance(val, str): # equality
                     filter_for_req[key] = val
-                elif is_list_of_instances(val, (str, int)): # set membership
+                elif val_utils.is_list_of_instances(val, (str, int)): # set membership
                     filter_for_req[key] = {'$in': val}
-                elif is_list_of_instances(val, list) and len(val) == 1 and len(val[0]) == 2: # a single range
+                elif val_utils.is_list_of_instances(val, list) and len(val) == 1 and len(val[0]) == 2: # a single range
                     filter_for_req[key] = {'$gte': val[0][0], '$lte': val[0][1]}
                 elif isinstance(val, dict): # MongoDB-formatted
                     assert all(['$' in key_ for key_ in val])
@@ -69,9 +73,17 @@ def load_all_recs_with_distinct(database: str,
                                 collection: str,
                                 db_config: dict,
                                 group: str,
-                                filter: Optional[dict] = None) \
+                                filter: Optional[dict] = None,
+                                spill_path: Optional[str] = None) \
         -> pd.DataFrame:
-    """Load many distinct records (optional filter followed by distinct query)."""
+    """
+    Load many distinct records (optional filter followed by distinct query).
+
+    If spill_path is specified, records are spilled to a memory-mapped local file instead of being loaded into memory
+    (see io_utils.spill_chunks_to_file()).
+    """
     distinct_ = dict(group=group, filter=filter)  # filter is applied first
     df_gen = get_mongodb_records_gen(database, collection, db_config, distinct=distinct_)
+    if spill_path is not None:
+        return spill_chunks_to_file(df_gen, spill_path)
     return pd.concat([df for df in df_gen], axis=0, ignore_index=True)
@@ -3,21 +3,308 @@ Database utils for MySQL including basic CRUD operations and more
 complex functionality using the engine.
 """
 
-from typing import Dict, Optional, Callable, List, Union, Generator
+from __future__ import annotations
+
+from typing import Dict, Optional, Callable, List, Union, Generator, Tuple, Set
+import inspect
+import copy
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
 import mysql.connector
-import pandas as pd
 
-from .constants import MYSQL_FETCH_MANY_MAX_COUNT
+from .constants import MYSQL_FETCH_MANY_MAX_COUNT, MYSQL_IN_LIST_MAX_COUNT, MYSQL_KILL_QUERY_GRACE_S, \
+    MYSQL_SCRIPT_BATCH_MAX_BYTES
+from .exceptions import MySQLEngineError, SQLScriptError
+from .retry_utils import RetryPolicy, call_with_retries
+from .deadline_utils import Deadline
+from .pipeline_utils import prefetch_gen
+from .cache_utils import LRUCache
+from .singleflight_utils import SingleFlight, make_single_flight
+from .admission_utils import AdmissionPolicy, get_admission_controller
+from .dtype_utils import DtypePolicy, get_mysql_dtypes, make_typed_df, categorize
+from .record_utils import RECORD_MODES, format_rows
+from .routing_utils import HostSelector
+from .io_utils import write_chunks_to_file, spill_chunks_to_file
+from .sql_script_utils import SQLStatement, split_sql_statements, batch_sql_statements
+from .keyset_utils import encode_cursor_token, decode_cursor_token, make_sql_keyset_clause, keyset_scan_gen
+from .lazy_imports import LazyModule
+
+pd = LazyModule('pandas')
+np = LazyModule('numpy')
+
+
+# errors after which the whole transaction was rolled back by the server, so retrying is always safe
+MYSQL_ERRNOS_ROLLED_BACK = [
+    1213, # deadlock found when trying to get lock
+]
+
+# errors after which only the failed statement was rolled back (unless innodb_rollback_on_timeout is on), so earlier
+# statements of the transaction may still be applied
+MYSQL_ERRNOS_STATEMENT_ROLLED_BACK = [
+    1205, # lock wait timeout exceeded
+]
+
+# errors where the connection dropped, possibly after the query was applied
+MYSQL_ERRNOS_CONNECTION = [
+    2003, # can't connect to MySQL server (nothing was executed)
+    2006, # MySQL server has gone away
+    2013, # lost connection to MySQL server during query
+    2055, # lost connection to MySQL server at '...', system error
+]
+
+# errors that signal an overloaded server, which lower the adaptive concurrency limit (see admission_utils)
+MYSQL_ERRNOS_OVERLOAD = [
+    1040, # too many connections
+    1203, # user already has more than 'max_user_connections' active connections
+    1205, # lock wait timeout exceeded
+    1317, # query execution was interrupted (i.e. killed at its deadline)
+    3024, # maximum statement execution time exceeded
+    2013, # lost connection to MySQL server during query
+]
+
+
+def is_mysql_error_retryable(e: Exception,
+                             idempotent: bool,
+                             policy: RetryPolicy) \
+        -> bool:
+    """Decide if a failed MySQL operation can be retried"""
+    if not isinstance(e, mysql.connector.Error):
+        return False
+    if e.errno in MYSQL_ERRNOS_ROLLED_BACK or e.errno == 2003:
+        return True
+    return e.errno in MYSQL_ERRNOS_STATEMENT_ROLLED_BACK + MYSQL_ERRNOS_CONNECTION and \
+        (idempotent or policy.retry_writes)
+
+def is_mysql_overload_error(e: BaseException) -> bool:
+    """Decide if a failed MySQL operation signals an overloaded server"""
+    return isinstance(e, mysql.connector.Error) and e.errno in MYSQL_ERRNOS_OVERLOAD
+
+def normalize_key_val(val):
+    """Convert pandas/numpy scalars to the Python types returned by the connector, so keys can be compared"""
+    if isinstance(val, pd.Timestamp):
+        return val.to_pydatetime()
+    if isinstance(val, np.generic):
+        return val.item()
+    return val
+
+def make_mysql_engine_error(e: Exception) -> MySQLEngineError:
+    """Convert a connector error to the engine's structured exception"""
+    return MySQLEngineError(f'MySQLEngine: {e}', code=getattr(e, 'errno', None),
+                            attempts=getattr(e, 'db_engine_attempts', 1))
+
+def execute_multi_gen(cursor, operation: str) -> Generator[None, None, None]:
+    """
+    Run statements separated by ';' in one round trip, yielding once per statement as its result is read (and
+    fetched, if it has rows). The error of a failed statement is raised when its result is read.
+    """
+    if 'multi' in inspect.signature(cursor.execute).parameters: # connector < 9.2
+        for result in cursor.execute(operation, multi=True):
+            if result.with_rows:
+                result.fetchall()
+            yield
+        return
+    cursor.execute(operation)
+    while True:
+        if cursor.with_rows:
+            cursor.fetchall()
+        yield
+        if not cursor.nextset():
+            return
+
+def _read_lines_gen(filename: str,
+                    progress: dict) \
+        -> Generator[str, None, None]:
+    """Stream the lines of a text file, counting the bytes read in progress['num_bytes']"""
+    with open(filename, 'rb') as fd:
+        for line in fd:
+            progress['num_bytes'] += len(line)
+            yield line.decode('utf-8')
+
+
+
+class MySQLTransaction():
+    """
+    Unit of work on one connection, see MySQLEngine.transaction(). Engine calls made in the transaction's thread run
+    on its connection, and their commits are deferred to the end of the transaction or, if commit_every is specified,
+    done after every commit_every writes.
+    """
+    def __init__(self,
+                 connection,
+                 commit_every: Optional[int] = None):
+        assert commit_every is None or commit_every >= 1
+        self.connection = connection
+        self.commit_every = commit_every
+        self.num_commits = 0
+        self.databases_written: Set[Optional[str]] = set() # None if a write wasn't specific to a database
+        self._num_pending = 0 # writes since the last commit
+        self._num_savepoints = 0
+        self._proxy = _TransactionConnection(self)
+
+    def run(self,
+            func: Callable,
+            database: Optional[str] = None):
+        """Run a query function (see MySQLEngine._sql_query_wrapper()) on the transaction's connection"""
+        try:
+            if database is not None and database != self.connection.database:
+                self.connection.database = database # USE, doesn't end the transaction
+            with self.connection.cursor() as cursor:
+                return func(self._proxy, cursor)
+        except mysql.connector.Error as e:
+            raise make_mysql_engine_error(e) from e
+
+    def records_gen(self,
+                    database: str,
+                    query: str,
+                    mode: str,
+                    cols: Optional[List[str]],
+                    params: Optional[Union[tuple, list, dict]],
+                    deadline: Optional[Deadline] = None,
+                    dtype_policy: Optional[DtypePolicy] = None):
+        """Generator version of run() for select queries. Must be exhausted or closed before the next query."""
+        try:
+            if database is not None and database != self.connection.database:
+                self.connection.database = database
+            with self.connection.cursor() as cursor:
+                if deadline is not None:
+                    cursor.execute("SET SESSION max_execution_time = %s", (deadline.remaining_ms(),))
+                try:
+                    cursor.execute(query, params)
+                    dtypes = None if dtype_policy is None else get_mysql_dtypes(cursor.description, dtype_policy)
+                    names = cols if cols is not None else cursor.column_names
+                    while records := cursor.fetchmany(MYSQL_FETCH_MANY_MAX_COUNT):
+                        try:
+                            yield make_typed_df(records, cols, dtypes) if mode == 'pandas' else \
+                                format_rows(records, names, mode)
+                        except GeneratorExit: # consumer stopped early, drain the result so the connection can be reused
+                            cursor.fetchall()
+                            raise
+                finally: # also after an error or early close, so the transaction's later queries have no limit
+                    if deadline is not None:
+                        try:
+                            cursor.execute("SET SESSION max_execution_time = 0")
+                        except mysql.connector.Error:
+                            pass # connection is gone, or the result couldn't be drained
+        except mysql.connector.Error as e:
+            raise make_mysql_engine_error(e) from e
+
+    def on_write_committed(self):
+        """Called in place of connection.commit() by the queries run in the transaction"""
+        self._num_pending += 1
+        if self.commit_every is not None and self._num_pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        """Commit the writes made so far"""
+        try:
+            self.connection.commit()
+        except mysql.connector.Error as e:
+            raise make_mysql_engine_error(e) from e
+        self._num_pending = 0
+        self.num_commits += 1
+
+    def rollback(self):
+        """Roll back the writes made since the last commit"""
+        try:
+            self.connection.rollback()
+        except mysql.connector.Error as e:
+            raise make_mysql_engine_error(e) from e
+        self._num_pending = 0
+
+    @contextmanager
+    def savepoint(self):
+        """Context in which an exception only rolls back the writes made since entering it, then propagates"""
+        assert self.commit_every is None, 'Savepoints are not supported in batched-commit mode.'
+        self._num_savepoints += 1
+        name = f'db_engines_sp_{self._num_savepoints}'
+        self.run(lambda connection, cursor: cursor.execute(f"SAVEPOINT {name}"))
+        try:
+            yield self
+        except BaseException:
+            self.run(lambda connection, cursor: cursor.execute(f"ROLLBACK TO SAVEPOINT {name}"))
+            raise
+        self.run(lambda connection, cursor: cursor.execute(f"RELEASE SAVEPOINT {name}"))
+
+
+class _TransactionConnection():
+    """Connection handed to the queries run in a transaction, with commit() deferred to the transaction"""
+    def __init__(self, transaction: MySQLTransaction):
+        self._transaction = transaction
+
+    def commit(self):
+        self._transaction.on_write_committed()
 
+    def __getattr__(self, name: str):
+        return getattr(self._transaction.connection, name)
 
 
 
 class MySQLEngine():
-    """MySQL convenience class for CRUD and other operations on database records."""
-    def __init__(self, db_config: Dict[str, str]):
+    """
+    MySQL convenience class for CRUD and other operations on database records.
+
+    Failed operations are retried according to retry_policy (see retry_utils.RetryPolicy). Errors that persist are
+    raised as MySQLEngineError.
+
+    Reads can be load-balanced over read replicas listed in db_config['read_hosts'] ('host' or 'host:port'), while
+    writes always go to db_config['host']. Optional db_config keys:
+        - 'max_replica_lag_s': skip replicas that lag behind the primary by more than this (checked with SHOW REPLICA
+          STATUS, which needs the REPLICATION CLIENT privilege; replicas whose lag can't be measured are skipped)
+        - 'replica_cooldown_s': how long to skip a replica after a connection error (default: 30)
+    If no replica is usable, reads go to the primary. Replicas are eventually consistent: read a row that was just
+    written with use_replicas=False (see select_records()).
+
+    If cache_size > 0, select_one_by_key() results are cached in-process (LRU, up to cache_size entries that expire
+    after cache_ttl_s, if specified). Writes made through the engine drop the cached lookups on the database they write
+    to, so a process always reads its own writes. Writes by other processes are only seen once entries expire.
+
+    By default each call runs on its own connection and commits on its own. To make several calls atomic, run them in
+    a transaction (see transaction()).
+
+    Queries can be bounded in time with query_timeout_s (for all queries) or the timeout_s argument of the select and
+    execute methods (per call, overrides query_timeout_s). The timeout is a deadline for the whole call, retries
+    included: SELECTs are stopped by the server once it passes (max_execution_time, error 3024), and other statements
+    are stopped with KILL QUERY from a separate connection shortly after (error 1317). Generators that are closed
+    early also kill their query, so that the server stops producing rows that will never be read.
+
+    With single_flight='engine' or 'process', identical concurrent select_records() (in-memory results) and
+    select_one_by_key() calls share one execution, e.g. when many threads miss the cache at once: see
+    singleflight_utils.make_single_flight() for the scopes and get_single_flight_stats() for the number of deduplicated
+    calls. A call that joins one in flight gets its result even if it asked for a different timeout. Calls made inside
+    transactions aren't coalesced.
+
+    With an admission_policy (see admission_utils.AdmissionPolicy), the number of concurrent operations on each host
+    is limited across all engines of the process, with priority queueing (see admission_utils.priority()) and
+    optionally an adaptive limit. A query holds its slot while it runs, a generator or transaction for its lifetime.
+
+    With a dtype_policy (see dtype_utils.DtypePolicy), the DataFrames of select_records(mode='pandas'),
+    select_records_with_join() and select_by_keys() get compact dtypes derived from the result's column metadata
+    (e.g. uint16 for SMALLINT UNSIGNED, string[pyarrow] for VARCHAR, datetime64[ms] for TIMESTAMP), the same for every
+    chunk of a generator.
+    """
+    def __init__(self,
+                 db_config: Dict[str, str],
+                 retry_policy: Optional[RetryPolicy] = None,
+                 cache_size: int = 0,
+                 cache_ttl_s: Optional[float] = None,
+                 query_timeout_s: Optional[float] = None,
+                 single_flight: Optional[str] = None,
+                 admission_policy: Optional[AdmissionPolicy] = None,
+                 dtype_policy: Optional[DtypePolicy] = None):
         # members
         self._db_config = None
+        self._admission_policy = admission_policy
+        self._dtype_policy = dtype_policy
+        self._query_timeout_s = query_timeout_s
+        self._single_flight: Optional[SingleFlight] = make_single_flight(single_flight)
+        self._retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self._cache = LRUCache(max_size=cache_size, ttl_s=cache_ttl_s) if cache_size > 0 else None
+        self._primary_keys: Dict[Tuple[str, str], List[str]] = {} # (database, tablename) -> primary key columns
+        self._read_hosts: Optional[HostSelector] = None
+        self._local = threading.local() # per-thread state, i.e. the active transaction
 
         # setup
         self.set_db_config(db_config)
@@ -26,31 +313,281 @@ class MySQLEngine():
     ### connection config ###
     def set_db_config(self, db_config: Dict[str, str]):
         self._db_config = db_config
+        self._read_hosts = None
+        if db_config.get('read_hosts'):
+            self._read_hosts = HostSelector(db_config['read_hosts'], cooldown_s=db_config.get('replica_cooldown_s', 30),
+                                            max_lag_s=db_config.get('max_replica_lag_s'),
+                                            get_lag=self.get_replica_lag)
 
     def get_db_config(self) -> Dict[str, str]:
         return self._db_config
 
 
     ### connection and exception handling ###
-    def _get_connection(self, database: Optional[str] = None):
-        """Establish connection with a MySQL database"""
+    def _get_connection(self,
+                        database: Optional[str] = None,
+                        host: Optional[str] = None,
+                        **kwargs):
+        """Establish connection with a MySQL database on the primary or on another host ('host' or 'host:port')"""
+        if host is None:
+            host = self._db_config['host']
+        if ':' in host:
+            host, port = host.rsplit(':', 1)
+            kwargs['port'] = int(port)
         return mysql.connector.connect(
-            host=self._db_config['host'],
+            host=host,
             user=self._db_config['user'],
             password=self._db_config['password'],
-            database=database
+            database=database,
+            **kwargs
         )
 
+    def _choose_host(self, read_only: bool) -> Optional[str]:
+        """Replica to run a read on, or None for the primary"""
+        if not read_only or self._read_hosts is None:
+            return None
+        return self._read_hosts.choose()
+
+    def _on_host_error(self,
+                       host: Optional[str],
+                       e: Exception):
+        """Take a replica out of rotation after a connection error"""
+        if host is not None and isinstance(e, mysql.connector.Error) and e.errno in MYSQL_ERRNOS_CONNECTION:
+            self._read_hosts.mark_failed(host)
+
+    def get_replica_lag(self, host: str) -> Optional[float]:
+        """Replication lag of a replica in seconds. None if it isn't replicating."""
+        with self._get_connection(host=host, connection_timeout=5) as connection:
+            with connection.cursor(dictionary=True) as cursor:
+                try:
+                    cursor.execute("SHOW REPLICA STATUS")
+                except mysql.connector.Error: # before MySQL 8.0.22
+                    cursor.execute("SHOW SLAVE STATUS")
+                recs = cursor.fetchall()
+        if len(recs) == 0:
+            return None
+        lag = recs[0].get('Seconds_Behind_Source', recs[0].get('Seconds_Behind_Master'))
+        return None if lag is None else float(lag)
+
+    def _admit(self,
+               host: Optional[str] = None,
+               deadline: Optional[Deadline] = None,
+               measure: bool = True):
+        """Context in which an operation on a host (default: the primary) runs once admitted (see admission_utils)"""
+        if self._admission_policy is None:
+            return nullcontext()
+        controller = get_admission_controller(f"mysql://{host or self._db_config['host']}", self._admission_policy)
+        return controller.admit(deadline=deadline, measure=measure, is_overload_error=is_mysql_overload_error)
+
+    def get_admission_stats(self, host: Optional[str] = None) -> Optional[dict]:
+        """Admission control stats of a host (default: the primary). None if admission control is disabled."""
+        if self._admission_policy is None:
+            return None
+        controller = get_admission_controller(f"mysql://{host or self._db_config['host']}", self._admission_policy)
+        return controller.get_stats()
+
+    def _make_deadline(self, timeout_s: Optional[float] = None) -> Optional[Deadline]:
+        """Deadline for a call with a per-call timeout, defaulting to the engine's"""
+        return Deadline.from_timeout(timeout_s if timeout_s is not None else self._query_timeout_s)
+
+    def _kill_query(self,
+                    host: Optional[str],
+                    connection_id: int):
+        """Stop the statement running on a connection, from a separate connection. Best effort."""
+        try:
+            with self._get_connection(host=host, connection_timeout=5) as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute("KILL QUERY %s", (connection_id,))
+        except mysql.connector.Error:
+            pass
+
+    def _run_with_deadline(self,
+                           func: Callable,
+                           connection,
+                           cursor,
+                           deadline: Optional[Deadline],
+                           host: Optional[str] = None,
+                           reset: bool = False):
+        """
+        Run a query function so that it stops at the deadline: the server stops SELECTs by itself, and a timer kills
+        any other statement a little later. If reset is True, the connection's time limit is removed afterwards (for
+        connections that are reused, i.e. in transactions).
+        """
+        if deadline is None:
+            return func(connection, cursor)
+        cursor.execute("SET SESSION max_execution_time = %s", (deadline.remaining_ms(),))
+        timer = threading.Timer(deadline.remaining_s() + MYSQL_KILL_QUERY_GRACE_S, self._kill_query,
+                                args=(host, connection.connection_id))
+        timer.daemon = True
+        timer.start()
+        try:
+            return func(connection, cursor)
+        finally:
+            timer.cancel()
+            if reset:
+                cursor.execute("SET SESSION max_execution_time = 0")
+
     def _sql_query_wrapper(self,
                            func: Callable,
-                           database: Optional[str] = None):
-        """Wrapper for exception handling during MySQL queries"""
+                           database: Optional[str] = None,
+                           idempotent: bool = False,
+                           read_only: bool = False,
+                           deadline: Optional[Deadline] = None):
+        """
+        Wrapper for exception handling during MySQL queries. Each attempt runs on a fresh connection, so any
+        uncommitted work of a failed attempt is rolled back before the retry. If read_only is True, the query may run
+        on a read replica, and a retry after a connection error goes to another one.
+
+        The query and its retries are bounded by 'deadline' (default: the engine's query_timeout_s, if specified).
+
+        Inside a transaction (see transaction()), the query runs once on the transaction's connection instead.
+        """
+        if deadline is None:
+            deadline = self._make_deadline()
+
+        transaction = self.get_transaction()
+        if transaction is not None:
+            return transaction.run(lambda connection, cursor: self._run_with_deadline(func, connection, cursor,
+                                                                                      deadline, reset=True),
+                                   database=database)
+
+        def func_():
+            host = self._choose_host(read_only)
+            try:
+                with self._admit(host, deadline=deadline), \
+                        self._get_connection(database=database, host=host) as connection:
+                    with connection.cursor() as cursor:
+                        return self._run_with_deadline(func, connection, cursor, deadline, host=host)
+            except mysql.connector.Error as e:
+                self._on_host_error(host, e)
+                raise
+
         try:
-            with self._get_connection(database=database) as connection:
-                with connection.cursor() as cursor:
-                    return func(connection, cursor)
+            return call_with_retries(func_, self._retry_policy,
+                                     lambda e: is_mysql_error_retryable(e, idempotent, self._retry_policy),
+                                     deadline=deadline)
         except mysql.connector.Error as e:
-            print(e)
+            raise make_mysql_engine_error(e) from e
+
+    def _sql_write_wrapper(self,
+                           func: Callable,
+                           database: Optional[str] = None,
+                           idempotent: bool = False,
+                           deadline: Optional[Deadline] = None):
+        """
+        Wrapper for writes. Afterwards (even if the write failed), drops the cached lookups and primary keys of
+        'database', or of all databases if not specified, and stops later reads from joining in-flight ones.
+        """
+        transaction = self.get_transaction()
+        if transaction is not None:
+            transaction.databases_written.add(database)
+        try:
+            return self._sql_query_wrapper(func, database=database, idempotent=idempotent, deadline=deadline)
+        finally:
+            self._invalidate(database)
+
+    def _invalidate(self, database: Optional[str]):
+        """
+        Drop the cached lookups and primary keys of a database, or of all databases if None, and make in-flight reads
+        of it unjoinable (see _coalesce()), so later reads see the write
+        """
+        pred = lambda key: database is None or key[0] == database
+        for key in [key for key in self._primary_keys if pred(key)]:
+            self._primary_keys.pop(key, None)
+        if self._cache is not None:
+            self._cache.invalidate_where(pred)
+        if self._single_flight is not None:
+            server = self._get_single_flight_server()
+            self._single_flight.invalidate_where(lambda key: key[:2] == server and pred(key[3:]))
+
+    def _get_dtypes(self, description: Optional[list]) -> Optional[list]:
+        """Dtypes of the columns of a result under the engine's dtype policy, None if there is no policy"""
+        if self._dtype_policy is None or description is None:
+            return None
+        return get_mysql_dtypes(description, self._dtype_policy)
+
+    def _coalesce(self,
+                  key: tuple,
+                  func: Callable):
+        """
+        Run func() through the single-flight layer (if enabled), shared with concurrent calls with the same key. Keys
+        are (operation, database, ...).
+        """
+        if self._single_flight is None or self.get_transaction() is not None:
+            return func()
+        return self._single_flight.do(self._get_single_flight_server() + key, func)
+
+    def _get_single_flight_server(self) -> tuple:
+        """Prefix of the engine's single-flight keys, which identifies the server (and user) for scope='process'"""
+        return self._db_config['host'], self._db_config['user']
+
+    def get_single_flight_stats(self) -> Optional[dict]:
+        """Calls, executions and deduplicated calls of the single-flight layer. None if it's disabled."""
+        if self._single_flight is None:
+            return None
+        return self._single_flight.get_stats()
+
+
+    ### transactions ###
+    def get_transaction(self) -> Optional[MySQLTransaction]:
+        """Active transaction of the calling thread, if any"""
+        return getattr(self._local, 'transaction', None)
+
+    @contextmanager
+    def transaction(self,
+                    database: Optional[str] = None,
+                    commit_every: Optional[int] = None) \
+            -> Generator[MySQLTransaction, None, None]:
+        """
+        Run engine calls as one unit of work, e.g.
+
+            with engine.transaction():
+                engine.insert_records_to_table(database, query_usernames, recs_usernames)
+                engine.insert_records_to_table(database, query_meta, recs_meta)
+
+        Calls made by the same thread inside the context share one connection to the primary and are committed
+        together when it exits, or rolled back if it raises. Reads in the context see the transaction's own writes (they
+        bypass replicas, the cache and prefetching; generators must be exhausted or closed before the next call). The
+        transaction isn't retried: on a deadlock or lost connection, the error is raised and the work is rolled back.
+        Other threads (e.g. select_by_keys() workers) don't take part in it.
+
+        Nesting the context creates a savepoint: an exception inside it only rolls back the writes made since entering
+        it. If commit_every is specified (batched-commit mode for bulk pipelines), writes are committed every
+        commit_every calls instead of at the end, so an error only rolls back the current batch and savepoints aren't
+        supported. database and commit_every only apply to the outermost context.
+
+        Note that MySQL commits implicitly before DDL statements (e.g. CREATE TABLE, DROP DATABASE).
+        """
+        transaction = self.get_transaction()
+        if transaction is not None:
+            assert database is None and commit_every is None, \
+                'database and commit_every can only be specified for the outermost transaction.'
+            with transaction.savepoint():
+                yield transaction
+            return
+
+        with self._admit(measure=False): # the transaction holds a slot on the primary for its lifetime
+            try:
+                connection = call_with_retries(lambda: self._get_connection(database=database), self._retry_policy,
+                                               lambda e: is_mysql_error_retryable(e, True, self._retry_policy))
+            except mysql.connector.Error as e:
+                raise make_mysql_engine_error(e) from e
+            transaction = MySQLTransaction(connection, commit_every=commit_every)
+            self._local.transaction = transaction
+            try:
+                yield transaction
+                transaction.commit()
+            except BaseException:
+                try:
+                    transaction.rollback()
+                except MySQLEngineError:
+                    pass # connection is gone, the server rolls back
+                raise
+            finally:
+                self._local.transaction = None
+                connection.close()
+                for database_ in transaction.databases_written: # reads by other threads may have cached pre-commit rows
+                    self._invalidate(database_)
 
 
     ### get database and table info ###
@@ -59,7 +596,7 @@ class MySQLEngine():
         def func(connection, cursor):
             cursor.execute("SHOW DATABASES")
             return [db_name[0] for db_name in cursor]
-        return self._sql_query_wrapper(func)
+        return self._sql_query_wrapper(func, idempotent=True, read_only=True)
 
     def describe_table(self,
                        database: str,
@@ -69,19 +606,31 @@ class MySQLEngine():
         def func(connection, cursor):
             cursor.execute(f"DESCRIBE {tablename}")
             return cursor.fetchall()
-        return self._sql_query_wrapper(func, database=database)
+        return self._sql_query_wrapper(func, database=database, idempotent=True, read_only=True)
+
+    def get_primary_keys(self,
+                         database: str,
+                         tablename: str) \
+            -> List[str]:
+        """Primary key columns of a table, in schema order. Memoized until the next write to the database."""
+        if (database, tablename) not in self._primary_keys:
+            pk_cols = [e[0] for e in self.describe_table(database, tablename) if e[3] == 'PRI']
+            assert len(pk_cols) > 0, f'Table {tablename} of database {database} has no primary key.'
+            self._primary_keys[(database, tablename)] = pk_cols
+        return self._primary_keys[(database, tablename)]
 
 
 
     ### pure SQL ###
     def execute_pure_sql(self,
                          database: str,
-                         query: str):
+                         query: str,
+                         timeout_s: Optional[float] = None):
         def func(connection, cursor):
             cursor.execute(query)
             connection.commit()
 
-        self._sql_query_wrapper(func, database=database)
+        self._sql_write_wrapper(func, database=database, deadline=self._make_deadline(timeout_s))
 
 
 
@@ -91,29 +640,73 @@ class MySQLEngine():
         def func(connection, cursor):
             cursor.execute(f"CREATE DATABASE {db_name}")
             connection.commit()
-        return self._sql_query_wrapper(func)
+        return self._sql_write_wrapper(func)
 
-    def create_db_from_sql_file(self, filename: str):
+    def create_db_from_sql_file(self,
+                                filename: str,
+                                progress: Optional[Callable[[int, int, int], None]] = None,
+                                max_batch_bytes: int = MYSQL_SCRIPT_BATCH_MAX_BYTES):
         """Create a database from a .sql file with 'CREATE TABLE IF NOT EXISTS ...' statements"""
         assert '.sql' in filename
+        return self.execute_sql_script(filename, progress=progress, max_batch_bytes=max_batch_bytes)
+
+    def execute_sql_script(self,
+                           filename: str,
+                           database: Optional[str] = None,
+                           progress: Optional[Callable[[int, int, int], None]] = None,
+                           max_batch_bytes: int = MYSQL_SCRIPT_BATCH_MAX_BYTES,
+                           timeout_s: Optional[float] = None) \
+            -> int:
+        """
+        Run a SQL script (e.g. a schema or seed data dump) and commit it. Returns the number of statements run.
+
+        The script is streamed from disk and split into statements (see split_sql_statements()), which are sent in
+        batches of up to max_batch_bytes, one round trip per batch. After each batch, progress() is called with the
+        number of statements run, the number of bytes of the file read and the size of the file.
+        If a statement fails, SQLScriptError reports the line it starts on. The script is then rolled back, except for
+        the statements that MySQL commits implicitly (e.g. CREATE/DROP/ALTER). Scripts aren't retried once they've
+        started (e.g. on a deadlock), since that would run the implicitly committed statements again.
+        """
+        num_bytes_total = os.path.getsize(filename)
+
         def func(connection, cursor):
-            with open(filename, 'r') as fd:
-                sqlFile = fd.read()
-            sqlCommands = sqlFile.split(';')
-            for command in sqlCommands:
-                if command.strip() != '':
-                    cursor.execute(command)
-            # with open(filename, 'r') as f:
-            #     cursor.execute(f.read(), multi=True) # doesn't work...?
-            connection.commit()
-        return self._sql_query_wrapper(func)
+            counts = dict(num_bytes=0)
+            num_statements = 0
+            statements = split_sql_statements(_read_lines_gen(filename, counts))
+            for batch in batch_sql_statements(statements, max_batch_bytes=max_batch_bytes):
+                num_done = 0
+                try:
+                    for _ in execute_multi_gen(cursor, ';\n'.join([statement.text for statement in batch])):
+                        num_done += 1
+                except mysql.connector.Error as e:
+                    raise self._make_script_error(e, filename, batch[num_done])
+                num_statements += num_done
+                if progress is not None:
+                    progress(num_statements, counts['num_bytes'], num_bytes_total)
+            try:
+                connection.commit()
+            except mysql.connector.Error as e: # converted so that it isn't retried, see docstring
+                raise make_mysql_engine_error(e) from e
+            return num_statements
+
+        return self._sql_write_wrapper(func, database=database, deadline=self._make_deadline(timeout_s))
+
+    @staticmethod
+    def _make_script_error(e: mysql.connector.Error,
+                           filename: str,
+                           statement: SQLStatement) \
+            -> SQLScriptError:
+        """Error of a failed script statement, located in the script"""
+        return SQLScriptError(f'MySQLEngine: {filename}, line {statement.line_no}: {e}',
+                              code=getattr(e, 'errno', None), filename=filename, line_no=statement.line_no,
+                              statement=statement.text)
 
     def drop_db(self, db_name: str):
         """Delete a database"""
         def func(connection, cursor):
             cursor.execute(f"DROP DATABASE {db_name}")
             connection.commit()
-        return self._sql_query_wrapper(func)
+        return self._sql_write_wrapper(func)
 
 
     ### operations on tables ###
@@ -122,14 +715,10 @@ class MySQLEngine():
                       queries: Union[str, List[str]]):
         """Create one or more tables in a specified database"""
         def func(connection, cursor):
-            if isinstance(queries, str):
-                cursor.execute(queries)
-                connection.commit()
-            else:
-                for query in queries:
-                    cursor.execute(query)
-                    connection.commit()
-        return self._sql_query_wrapper(func, database=database)
+            for query in ([queries] if isinstance(queries, str) else queries):
+                cursor.execute(query)
+            connection.commit()
+        return self._sql_write_wrapper(func, database=database)
 
     def insert_records_to_table(self,
                                 database: str,
@@ -142,7 +731,155 @@ class MySQLEngine():
             else:
                 cursor.executemany(query, records)
             connection.commit()
-        return self._sql_query_wrapper(func, database=database)
+        return self._sql_write_wrapper(func, database=database)
+
+    def select_one_by_key(self,
+                          database: str,
+                          tablename: str,
+                          key,
+                          cols: Optional[List[str]] = None,
+                          use_replicas: bool = True,
+                          timeout_s: Optional[float] = None) \
+            -> Optional[dict]:
+        """
+        Find a single record by primary key. Returns None if there is no record with that key. Cached if caching is
+        enabled.
+
+        'key' is a dict of primary key column values, or the values in schema order (a tuple, or a single value for a
+        single-column key). See get_primary_keys(). With caching enabled, lookups always go to the primary so that
+        replication lag can't leak stale rows into the cache.
+        """
+        pk_cols = self.get_primary_keys(database, tablename)
+        if isinstance(key, dict):
+            key_vals = tuple([key[col] for col in pk_cols])
+        else:
+            key_vals = tuple(key) if isinstance(key, (tuple, list)) else (key,)
+        assert len(key_vals) == len(pk_cols)
+
+        query = f"SELECT {'*' if cols is None else ', '.join(cols)} FROM {tablename} WHERE " + \
+                ' AND '.join([f'{col} = %s' for col in pk_cols])
+
+        def func(connection, cursor):
+            cursor.execute(query, key_vals)
+            rec = cursor.fetchone()
+            return None if rec is None else dict(zip(cursor.column_names, rec))
+
+        deadline = self._make_deadline(timeout_s)
+        cache_key = (database, tablename, key_vals, None if cols is None else tuple(cols))
+        if self._cache is None or self.get_transaction() is not None:
+            return self._coalesce(('select_one_by_key',) + cache_key + (use_replicas,),
+                                  lambda: self._sql_query_wrapper(func, database=database, idempotent=True,
+                                                                  read_only=use_replicas, deadline=deadline))
+        found, rec = self._cache.get(cache_key)
+        if not found:
+            version = self._cache.get_version()
+            rec = self._coalesce(('select_one_by_key',) + cache_key + (False,),
+                                 lambda: self._sql_query_wrapper(func, database=database, idempotent=True,
+                                                                 deadline=deadline))
+            self._cache.put(cache_key, rec, version=version)
+        return copy.deepcopy(rec)
+
+    def get_cache_stats(self) -> Optional[dict]:
+        """Cache hits, misses and size. None if caching is disabled."""
+        if self._cache is None:
+            return None
+        return dict(num_hits=self._cache.num_hits, num_misses=self._cache.num_misses, size=len(self._cache))
+
+    def clear_cache(self):
+        """Drop all cached lookups"""
+        if self._cache is not None:
+            self._cache.clear()
+
+    def select_by_keys(self,
+                       database: str,
+                       tablename: str,
+                       keys: Union[List, pd.DataFrame],
+                       cols: Optional[List[str]] = None,
+                       batch_size: int = MYSQL_IN_LIST_MAX_COUNT,
+                       max_workers: int = 1,
+                       found_col: str = 'found',
+                       use_replicas: bool = True,
+                       timeout_s: Optional[float] = None) \
+            -> pd.DataFrame:
+        """
+        Fetch many records by primary key (see get_primary_keys()).
+
+        'keys' is a list of keys (each a dict of primary key column values, or the values in schema order as a tuple or
+        a single value) or a DataFrame with the primary key columns. Keys are deduplicated and fetched in parameterized
+        batches of up to batch_size keys ("WHERE (k1, k2) IN ((%s, %s), ...)"). Batches all have the same statement
+        text, and if max_workers > 1 they are fetched concurrently, each on its own connection.
+
+        Returns one row per input key, in input order, with the primary key columns followed by 'cols' (default: all
+        columns). Rows of keys that don't exist have nulls outside of the primary key columns and False in found_col.
+
+        timeout_s bounds the whole call, all batches included.
+        """
+        assert batch_size >= 1 and max_workers >= 1
+        deadline = self._make_deadline(timeout_s)
+        pk_cols = self.get_primary_keys(database, tablename)
+        if isinstance(keys, pd.DataFrame):
+            keys = list(keys[pk_cols].itertuples(index=False, name=None))
+        key_tuples: List[tuple] = []
+        for key in keys:
+            if isinstance(key, dict):
+                key = [key[col] for col in pk_cols]
+            elif not isinstance(key, (tuple, list)):
+                key = [key]
+            assert len(key) == len(pk_cols)
+            key_tuples.append(tuple([normalize_key_val(val) for val in key]))
+
+        if cols is None:
+            select = '*'
+        else:
+            select = ', '.join(pk_cols + [col for col in cols if col not in pk_cols])
+        keys_unique = list(dict.fromkeys(key_tuples))
+        batches = [keys_unique[i:i + batch_size] for i in range(0, len(keys_unique), batch_size)]
+        if len(batches) > 1: # pad so that all batches have the same statement text
+            batches[-1] = batches[-1] + [batches[-1][-1]] * (batch_size - len(batches[-1]))
+
+        def fetch(batch: List[tuple]) -> Tuple[List[str], List[tuple]]:
+            placeholder = '%s' if len(pk_cols) == 1 else '(' + ', '.join(['%s'] * len(pk_cols)) + ')'
+            lhs = pk_cols[0] if len(pk_cols) == 1 else '(' + ', '.join(pk_cols) + ')'
+            query = f"SELECT {select} FROM {tablename} WHERE {lhs} IN ({', '.join([placeholder] * len(batch))})"
+            params = [val for key in batch for val in key]
+
+            def func(connection, cursor):
+                cursor.execute(query, params)
+                return cursor.description, cursor.fetchall()
+            return self._sql_query_wrapper(func, database=database, idempotent=True, read_only=use_replicas,
+                                           deadline=deadline)
+
+        if max_workers > 1 and len(batches) > 1 and self.get_transaction() is None:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as executor:
+                results = list(executor.map(fetch, batches))
+        else:
+            results = [fetch(batch) for batch in batches]
+
+        dtypes = None
+        if len(results) > 0:
+            colnames = [col[0] for col in results[0][0]]
+            dtypes = self._get_dtypes(results[0][0])
+        elif cols is None:
+            colnames = [e[0] for e in self.describe_table(database, tablename)]
+        else:
+            colnames = select.split(', ')
+        idxs_pk = [colnames.index(col) for col in pk_cols]
+        recs_by_key = {tuple([rec[i] for i in idxs_pk]): rec for _, recs in results for rec in recs}
+
+        rows: List[tuple] = []
+        found: List[bool] = []
+        for key in key_tuples:
+            rec = recs_by_key.get(key)
+            if rec is None:
+                rec = [None] * len(colnames)
+                for i, val in zip(idxs_pk, key):
+                    rec[i] = val
+            rows.append(tuple(rec))
+            found.append(key in recs_by_key)
+
+        df = make_typed_df(rows, colnames, dtypes)
+        df[found_col] = found
+        return df
 
     def select_records(self,
                        database: str,
@@ -150,7 +887,13 @@ class MySQLEngine():
                        mode: str = 'list',
                        tablename: Optional[str] = None,
                        cols: Optional[List[str]] = None,
-                       as_generator: bool = False) \
+                       as_generator: bool = False,
+                       params: Optional[Union[tuple, list, dict]] = None,
+                       prefetch: int = 0,
+                       spill_path: Optional[str] = None,
+                       spill_as_arrow: bool = False,
+                       use_replicas: bool = True,
+                       timeout_s: Optional[float] = None) \
             -> Union[Generator[pd.DataFrame, None, None], Generator[List[tuple], None, None], pd.DataFrame, List[tuple]]:
         """
         Retrieve records from a table.
@@ -158,59 +901,177 @@ class MySQLEngine():
         If mode == 'pandas', you must specify either the tablename (to infer all of that table's column names) or
         cols, which is the list of columns that the query will return. Either way, these column names will be used
         as the column names in the returned pandas dataframe.
+
+        For small, latency-sensitive queries, the lightweight modes skip pandas: mode == 'list' returns tuples,
+        mode == 'records' namedtuples and mode == 'columns' a dict of column name -> list of values (see
+        record_utils). Their column names are cols if specified, otherwise those of the result.
+
+        If 'params' is specified, the query is treated as parameterized (e.g. "... WHERE id_meta = %s") and the values
+        are bound by the connector instead of being inlined in the query string.
+
+        If as_generator is True and prefetch > 0, up to 'prefetch' chunks are fetched and converted ahead of the
+        consumer on a background thread (see pipeline_utils.prefetch_gen()).
+
+        If spill_path is specified (mode='pandas', as_generator=False), the records are streamed to a local Arrow IPC
+        file at that path and returned memory-mapped instead of being loaded into memory (see
+        io_utils.spill_chunks_to_file()). Requires pyarrow.
+
+        If read replicas are configured, the query runs on one of them unless use_replicas is False (e.g. to read rows
+        that were just written).
+
+        If timeout_s is specified, the query is stopped by the server after that many seconds (see the class docstring).
+        For generators, this includes the time the consumer takes to process the chunks.
         """
-        assert mode in ['list', 'pandas']
+        assert mode in ['list', 'pandas'] + RECORD_MODES
+        assert spill_path is None or (mode == 'pandas' and not as_generator)
         if mode == 'pandas':
             assert (tablename is None and cols is not None) or (tablename is not None and cols is None)
             if cols is None:
                 cols = [e[0] for e in self.describe_table(database, tablename)]
-        if mode == 'list':
+        else:
             assert tablename is None
 
+        deadline = self._make_deadline(timeout_s)
+        if spill_path is not None:
+            df_gen = self._select_records_gen(database, query, mode, cols=cols, params=params,
+                                              use_replicas=use_replicas, deadline=deadline)
+            return spill_chunks_to_file(df_gen, spill_path, as_arrow=spill_as_arrow)
+
         if not as_generator:
             def func(connection, cursor):
-                cursor.execute(query)
+                cursor.execute(query, params)
                 records = cursor.fetchall() # if table empty, "1241 (21000): Operand should contain 1 column(s)"
                 if mode == 'pandas':
-                    return pd.DataFrame(records, columns=cols)
-                return records
+                    df = make_typed_df(records, cols, self._get_dtypes(cursor.description))
+                    return categorize(df, self._dtype_policy)
+                return format_rows(records, cols if cols is not None else cursor.column_names, mode)
 
-            return self._sql_query_wrapper(func, database=database)
+            key = ('select_records', database, query, repr(params), mode, None if cols is None else tuple(cols),
+                   use_replicas)
+            return self._coalesce(key, lambda: self._sql_query_wrapper(func, database=database, idempotent=True,
+                                                                       read_only=use_replicas, deadline=deadline))
         else:
-            return self._select_records_gen(database, query, mode, cols=cols)
+            gen = self._select_records_gen(database, query, mode, cols=cols, params=params, use_replicas=use_replicas,
+                                           deadline=deadline)
+            if prefetch > 0 and self.get_transaction() is None:
+                return prefetch_gen(gen, max_prefetch=prefetch)
+            return gen
 
     def _select_records_gen(self,
                             database: str,
                             query: str,
                             mode: str = 'list',
-                            cols: Optional[List[str]] = None):
+                            cols: Optional[List[str]] = None,
+                            params: Optional[Union[tuple, list, dict]] = None,
+                            use_replicas: bool = True,
+                            deadline: Optional[Deadline] = None):
+        """Generator version of select_records(). Inside a transaction, runs on the transaction's connection."""
+        if deadline is None:
+            deadline = self._make_deadline()
+        transaction = self.get_transaction()
+        if transaction is not None:
+            return transaction.records_gen(database, query, mode, cols, params, deadline=deadline,
+                                           dtype_policy=self._dtype_policy)
+        return self._select_records_retry_gen(database, query, mode, cols, params, use_replicas, deadline)
+
+    def _select_records_retry_gen(self,
+                                  database: str,
+                                  query: str,
+                                  mode: str,
+                                  cols: Optional[List[str]],
+                                  params: Optional[Union[tuple, list, dict]],
+                                  use_replicas: bool,
+                                  deadline: Optional[Deadline]):
+        """
+        Generator version of select_records() outside of transactions.
+
+        If the connection fails mid-stream, the query is re-executed and the records that were already delivered are
+        skipped, so the consumer sees each record once. This assumes that the query returns records in a deterministic
+        order (i.e. it has an ORDER BY clause on a unique key); prefer select_records_resumable_gen() otherwise.
+
+        If the generator is closed before the end of the result (e.g. the consumer breaks out of a loop), the query is
+        killed so that the server stops producing rows.
+        """
         # sql_query_wrapper() doesn't work with yield...
         # Throws `mysql.connector.errors.ProgrammingError: 2055: Cursor is not connected`
-        try:
-            with self._get_connection(database=database) as connection:
-                with connection.cursor() as cursor:
-                    cursor.execute(query)
-                    while (records := cursor.fetchmany(MYSQL_FETCH_MANY_MAX_COUNT)) is not None:
-                        if not records:
-                            return
-                        if mode == 'pandas':
-                            yield pd.DataFrame(records, columns=cols)
-                        else:
-                            yield records
-        except mysql.connector.Error as e:
-            print(e)
+        num_delivered = 0
+        attempt = 1
+        closing = False
+        host = self._choose_host(use_replicas) # same host for the whole scan unless it fails
+        while 1:
+            try:
+                with self._admit(host, deadline=deadline, measure=False), \
+                        self._get_connection(database=database, host=host) as connection:
+                    with connection.cursor() as cursor:
+                        if deadline is not None:
+                            cursor.execute("SET SESSION max_execution_time = %s", (deadline.remaining_ms(),))
+                        cursor.execute(query, params)
+                        dtypes = self._get_dtypes(cursor.description) # same dtypes for all chunks
+                        names = cols if cols is not None else cursor.column_names
 
-        # def func(connection, cursor):
-        #     cursor.execute(query)
-        #     while (records := cursor.fetchmany(100)) is not None:
-        #         if mode == 'pandas':
-        #             yield pd.DataFrame(records, columns=cols)
-        #         else:
-        #             yield records
-        # return self._sql_query_wrapper(func, database=database)
+                        # skip records delivered before a failure
+                        num_skip = num_delivered
+                        while num_skip > 0:
+                            records = cursor.fetchmany(min(num_skip, MYSQL_FETCH_MANY_MAX_COUNT))
+                            if not records:
+                                return
+                            num_skip -= len(records)
 
+                        while (records := cursor.fetchmany(MYSQL_FETCH_MANY_MAX_COUNT)) is not None:
+                            if not records:
+                                return
+                            num_delivered += len(records)
+                            attempt = 1
+                            try:
+                                if mode == 'pandas':
+                                    yield make_typed_df(records, cols, dtypes)
+                                else:
+                                    yield format_rows(records, names, mode)
+                            except GeneratorExit:
+                                closing = True
+                                self._kill_query(host, connection.connection_id)
+                                raise
+            except mysql.connector.Error as e:
+                if closing: # consumer stopped early, errors while releasing the connection are irrelevant
+                    return
+                self._on_host_error(host, e)
+                delay = self._retry_policy.get_backoff(attempt)
+                if attempt >= self._retry_policy.max_attempts or \
+                        not is_mysql_error_retryable(e, True, self._retry_policy) or \
+                        (deadline is not None and delay >= deadline.remaining_s()):
+                    e.db_engine_attempts = attempt
+                    raise make_mysql_engine_error(e) from e
+                time.sleep(delay)
+                attempt += 1
+                host = self._choose_host(use_replicas)
 
 
+
+    def export_records(self,
+                       database: str,
+                       query: str,
+                       path: str,
+                       format: str = 'parquet',
+                       tablename: Optional[str] = None,
+                       cols: Optional[List[str]] = None,
+                       params: Optional[Union[tuple, list, dict]] = None,
+                       compression: Optional[str] = None,
+                       partition_col: Optional[str] = None,
+                       schema=None,
+                       prefetch: int = 1,
+                       timeout_s: Optional[float] = None) \
+            -> dict:
+        """
+        Stream the results of a query into a Parquet, CSV or Feather file without materializing them in memory.
+        Columns are specified through tablename or cols as in select_records(mode='pandas').
+
+        See io_utils.write_chunks_to_file() for the other options. Requires pyarrow.
+        """
+        df_gen = self.select_records(database, query, mode='pandas', tablename=tablename, cols=cols, as_generator=True,
+                                     params=params, prefetch=prefetch, timeout_s=timeout_s)
+        return write_chunks_to_file(df_gen, path, format=format, compression=compression,
+                                    partition_col=partition_col, schema=schema)
+
     def select_records_with_join(self,
                                  database: str,
                                  tablename_primary: str,
@@ -222,9 +1083,19 @@ class MySQLEngine():
                                  where_clause: Optional[str] = None,
                                  limit: Optional[int] = None,
                                  cols_for_df: Optional[List[str]] = None,
-                                 as_generator: bool = False) \
-            -> Union[Generator[pd.DataFrame, None, None], pd.DataFrame]:
-        """Select query on one table joined on second table"""
+                                 as_generator: bool = False,
+                                 where_params: Optional[Union[tuple, list]] = None,
+                                 prefetch: int = 0,
+                                 timeout_s: Optional[float] = None,
+                                 mode: str = 'pandas') \
+            -> Union[Generator[pd.DataFrame, None, None], pd.DataFrame, list, dict]:
+        """
+        Select query on one table joined on second table.
+
+        The where clause may contain %s placeholders whose values are passed in 'where_params' (see
+        mysql_utils.make_sql_where_clause()). The result is in 'mode' as in select_records(), with cols_for_df as the
+        column names.
+        """
         if table_pseudoname_primary is None:
             table_pseudoname_primary = tablename_primary
         if table_pseudoname_secondary is None:
@@ -236,6 +1107,110 @@ class MySQLEngine():
         if where_clause is not None:
             query += f" WHERE {where_clause}"
         if limit is not None:
-            query += f" LIMIT {limit}"
+            query += f" LIMIT {int(limit)}"
+
+        return self.select_records(database, query, mode=mode, cols=cols_for_df, as_generator=as_generator,
+                                   params=where_params, prefetch=prefetch, timeout_s=timeout_s)
+
+    def select_page(self,
+                    database: str,
+                    tablename: str,
+                    key_cols: List[str],
+                    cols: Optional[List[str]] = None,
+                    where_clause: Optional[str] = None,
+                    where_params: Optional[Union[tuple, list]] = None,
+                    page_size: int = MYSQL_FETCH_MANY_MAX_COUNT,
+                    cursor_token: Optional[str] = None,
+                    descending: bool = False,
+                    mode: str = 'pandas') \
+            -> Tuple[Union[pd.DataFrame, List[tuple]], Optional[str]]:
+        """
+        Keyset (seek) pagination over a table.
+
+        Records are ordered by key_cols, which must uniquely identify a record (e.g. the primary key, such as
+        ['id_meta', 'timestamp_stats']). Each page resumes after the last key of the previous one instead of using an
+        OFFSET, so fetching a deep page costs the same as fetching the first one.
+
+        Returns the page and an opaque token to pass as cursor_token to get the next page. The token is None once the
+        last page has been returned.
+        """
+        page, token_last, num_recs = self._select_page(database, tablename, key_cols, cols, where_clause,
+                                                       where_params, page_size, cursor_token, descending, mode)
+        return page, (token_last if num_recs == page_size else None)
+
+    def select_records_resumable_gen(self,
+                                     database: str,
+                                     tablename: str,
+                                     key_cols: List[str],
+                                     cols: Optional[List[str]] = None,
+                                     where_clause: Optional[str] = None,
+                                     where_params: Optional[Union[tuple, list]] = None,
+                                     chunk_size: int = MYSQL_FETCH_MANY_MAX_COUNT,
+                                     resume_token: Optional[str] = None,
+                                     checkpoint: Optional[Union[str, Callable[[str], None]]] = None,
+                                     with_tokens: bool = False,
+                                     mode: str = 'pandas') \
+            -> Generator[Union[pd.DataFrame, List[tuple], tuple], None, None]:
+        """
+        Resumable version of select_records(as_generator=True) over a table, ordered by key_cols (see select_page()).
+
+        The last emitted key is checkpointed per chunk to a local file or a callback, and the scan can be restarted
+        from a checkpoint token. See keyset_utils.keyset_scan_gen() for the delivery semantics.
+        """
+        def fetch_page(token: Optional[str]):
+            return self._select_page(database, tablename, key_cols, cols, where_clause, where_params, chunk_size,
+                                     token, False, mode)
+        return keyset_scan_gen(fetch_page, resume_token=resume_token, checkpoint=checkpoint, with_tokens=with_tokens)
 
-        return self.select_records(database, query, mode='pandas', cols=cols_for_df, as_generator=as_generator)
+    def _select_page(self,
+                     database: str,
+                     tablename: str,
+                     key_cols: List[str],
+                     cols: Optional[List[str]],
+                     where_clause: Optional[str],
+                     where_params: Optional[Union[tuple, list]],
+                     page_size: int,
+                     cursor_token: Optional[str],
+                     descending: bool,
+                     mode: str) \
+            -> Tuple[Union[pd.DataFrame, List[tuple]], Optional[str], int]:
+        """Get one page of a keyset iteration. Returns the page, the token of its last record and its size."""
+        assert mode in ['list', 'pandas']
+        assert len(key_cols) > 0 and page_size > 0
+        if cols is None:
+            cols = [e[0] for e in self.describe_table(database, tablename)]
+        cols_for_query = cols + [col for col in key_cols if col not in cols]
+        idxs_key = [cols_for_query.index(col) for col in key_cols]
+
+        # conditions
+        where_clauses: List[str] = []
+        params: list = []
+        if where_clause is not None:
+            where_clauses.append(f'({where_clause})')
+            params += list(where_params or [])
+        if cursor_token is not None:
+            keyset_clause, keyset_params = make_sql_keyset_clause(key_cols, decode_cursor_token(cursor_token),
+                                                                  descending=descending)
+            where_clauses.append(keyset_clause)
+            params += keyset_params
+
+        # query
+        direction = 'DESC' if descending else 'ASC'
+        query = f"SELECT {', '.join(cols_for_query)} FROM {tablename}"
+        if where_clauses:
+            query += ' WHERE ' + ' AND '.join(where_clauses)
+        query += f" ORDER BY {', '.join([f'{col} {direction}' for col in key_cols])} LIMIT {int(page_size)}"
+
+        records = self.select_records(database, query, params=params or None)
+
+        # token of last record
+        token_last = None
+        if len(records) > 0:
+            token_last = encode_cursor_token([records[-1][i] for i in idxs_key])
+
+        # drop key columns that weren't requested
+        if len(cols_for_query) > len(cols):
+            records = [rec[:len(cols)] for rec in records]
+        if mode == 'pandas':
+            return pd.DataFrame(records, columns=cols), token_last, len(records)
+        return records, token_last, len(records)
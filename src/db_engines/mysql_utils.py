@@ -1,12 +1,15 @@
 """Utils implementing useful ops over MySQL engine."""
 
-from typing import List, Optional, Dict, Tuple, Generator
+from __future__ import annotations
 
-import pandas as pd
-from ytpa_utils.sql_utils import make_sql_query_where_one
-from ytpa_utils.val_utils import is_subset
+from typing import List, Optional, Dict, Tuple, Generator, Union
 
 from .mysql_engine import MySQLEngine
+from .constants import MYSQL_IN_LIST_MAX_COUNT
+from .lazy_imports import LazyModule
+
+pd = LazyModule('pandas')
+val_utils = LazyModule('ytpa_utils.val_utils')
 
 
 
@@ -47,7 +50,7 @@ def prep_keys_for_insert_or_update(database: str,
     assert len(keys) > 0
 
     # keys is a subset of dict keys
-    is_subset(keys, data)
+    val_utils.is_subset(keys, data)
 
     # if multiple records, must have same number of records for all keys
     if isinstance(data[keys[0]], list):
@@ -89,6 +92,28 @@ def insert_records_from_dict(database: str,
 
 
 
+def make_upsert_query(tablename: str,
+                      keys: List[str],
+                      update_keys: Optional[List[str]] = None) \
+        -> str:
+    """
+    Make a parameterized insert query that updates the existing record on duplicate key:
+
+    INSERT INTO table_name (column1, column2, ...)
+    VALUES (%s, %s, ...)
+    ON DUPLICATE KEY UPDATE column2=VALUES(column2), ...;
+
+    'update_keys' are the columns overwritten on duplicate key (defaults to all keys).
+    """
+    if update_keys is None:
+        update_keys = keys
+    if len(update_keys) == 0: # nothing to update, do nothing on duplicate key
+        update_keys = keys[:1]
+    query = f"INSERT INTO {tablename} ({','.join(keys)}) VALUES (" + ','.join(['%s'] * len(keys)) + ")"
+    query += " ON DUPLICATE KEY UPDATE " + ', '.join([f'{key}=VALUES({key})' for key in update_keys])
+    return query
+
+
 def update_records_from_dict(database: str,
                              tablename: str,
                              data: dict,
@@ -111,7 +136,7 @@ def update_records_from_dict(database: str,
     if condition_keys is None:
         condition_keys = get_table_primary_keys(database, tablename, db_config)
     assert len(condition_keys) > 0
-    is_subset(condition_keys, data)
+    val_utils.is_subset(condition_keys, data)
     # assert len(set(condition_keys) - set(raw_data.keys())) == 0
 
     query = f"UPDATE {tablename} SET " + ', '.join([key + ' = %s' for key in keys])
@@ -133,6 +158,90 @@ def update_records_from_dict(database: str,
     engine.insert_records_to_table(database, query, records)
 
 
+def make_sql_where_one(tablename: Optional[str],
+                       key: str,
+                       val) \
+        -> Tuple[str, list]:
+    """
+    Create a single parameterized where clause entry. Returns the clause (with %s placeholders) and the values to be
+    bound to it. If tablename is None, the column isn't qualified (e.g. for a select alias in a HAVING clause).
+
+    Options for 'val' are the same as for make_sql_query_where_one() in ytpa_utils:
+        - equality: val = 'a' (or any other non-list value, e.g. int or datetime)
+        - set membership: val = ['a', 'b', 'c']
+        - range: val = [['a', 'b']]
+    """
+    if tablename is not None:
+        key = f"{tablename}.{key}"
+    if isinstance(val, list):
+        if len(val) == 1 and isinstance(val[0], list):  # range
+            assert len(val[0]) == 2
+            return f"{key} BETWEEN %s AND %s", list(val[0])
+        if len(val) == 0:  # empty set never matches
+            return "FALSE", []
+        return f"{key} IN ({','.join(['%s'] * len(val))})", list(val)  # subset
+    return f"{key} = %s", [val]  # equality
+
+
+def make_sql_where_clause(filters: dict,
+                          cols_all: Dict[str, List[str]]) \
+        -> Tuple[Optional[str], list]:
+    """
+    Create a parameterized WHERE clause (without the 'WHERE' keyword) from a filters dict. All sub-clauses are
+    AND'd together. See make_sql_where_one() for the filter options.
+
+    Each filter key is assigned to the table (pseudoname) in cols_all that has a column with that name.
+    """
+    if filters is None or len(filters) == 0:
+        return None, []
+
+    where_clauses: List[str] = []
+    params: list = []
+    for key, val in filters.items():
+        # identify table that this condition applies to
+        tablename_ = [tname for tname, colnames_ in cols_all.items() if key in colnames_]
+        assert len(tablename_) == 1
+        tablename_ = tablename_[0]
+
+        # add where clause
+        clause, params_ = make_sql_where_one(tablename_, key, val)
+        where_clauses.append(clause)
+        params += params_
+
+    return ' AND '.join(where_clauses), params
+
+
+def split_filters_for_in_lists(filters: Optional[dict],
+                               max_in_list_len: int = MYSQL_IN_LIST_MAX_COUNT) \
+        -> List[Optional[dict]]:
+    """
+    Split a filters dict into several filters dicts such that no set-membership filter exceeds max_in_list_len
+    values. Only the largest IN-list is split; the other filters are repeated in each of the returned dicts.
+
+    Duplicate values are dropped so that the chunks are disjoint (no record is returned twice) and the last chunk is
+    padded with its final value so that all chunked queries have the same statement text.
+    """
+    if filters is None:
+        return [filters]
+
+    in_list_keys = [key for key, val in filters.items()
+                    if isinstance(val, list) and not (len(val) == 1 and isinstance(val[0], list))]
+    if len(in_list_keys) == 0:
+        return [filters]
+
+    key = max(in_list_keys, key=lambda k: len(filters[k]))
+    vals = list(dict.fromkeys(filters[key]))
+    if len(vals) <= max_in_list_len:
+        return [filters]
+
+    filters_split = []
+    for i in range(0, len(vals), max_in_list_len):
+        vals_ = vals[i: i + max_in_list_len]
+        vals_ += [vals_[-1]] * (max_in_list_len - len(vals_))
+        filters_split.append({**filters, key: vals_})
+    return filters_split
+
+
 def perform_join_mysql_query(db_config: dict,
                              database: str,
                              tablename_primary: str,
@@ -143,11 +252,16 @@ def perform_join_mysql_query(db_config: dict,
                              cols_all: Dict[str, List[str]],
                              filters: Optional[dict] = None,
                              limit: Optional[int] = None,
-                             as_generator: bool = False) \
-        -> Tuple[Generator[pd.DataFrame, None, None], MySQLEngine]:
+                             as_generator: bool = False,
+                             max_in_list_len: int = MYSQL_IN_LIST_MAX_COUNT) \
+        -> Tuple[Union[Generator[pd.DataFrame, None, None], pd.DataFrame], MySQLEngine]:
     """
     Perform join query with specified options.
 
+    Filter values are bound as query parameters rather than inlined in the query string. A set-membership filter
+    with more than max_in_list_len values is split over several queries whose results are streamed one after the
+    other (or concatenated if as_generator is False).
+
     Args:
         database: name of database to perform query on
         tablename_primary: first table in join
@@ -158,45 +272,57 @@ def perform_join_mysql_query(db_config: dict,
         cols_all: dict with columns from the two tables to return (keys are table
                   pseudonames and keys are lists of corresponding column names)
         filters: dict with conditions for WHERE clause, e.g. filters = dict(username=['uname1', 'uname2']). See all
-                 options for specifying sub-clauses. All sub-clauses are AND'd together.
+                 options for specifying sub-clauses in make_sql_where_one(). All sub-clauses are AND'd together.
         limit: max number of records to return
+        max_in_list_len: max number of values in a single IN-list
     """
     # column info for query
     cols_for_query = ([f'{table_pseudoname_primary}.{colname}' for colname in cols_all[table_pseudoname_primary]] +
                       [f'{table_pseudoname_secondary}.{colname}' for colname in cols_all[table_pseudoname_secondary]])
     cols_for_df = cols_all[table_pseudoname_primary] + cols_all[table_pseudoname_secondary]
 
-    # where clause
-    where_clause = None
-
-    if filter is not None and len(filters) > 0:
-        where_clauses = []
-        for key, val in filters.items():
-            # identify table that this condition applies to
-            tablename_ = [tname for tname, colnames_ in cols_all.items() if key in colnames_]
-            assert len(tablename_) == 1
-            tablename_ = tablename_[0]
-
-            # add where clause
-            where_clauses.append(make_sql_query_where_one(tablename_, key, val))
-
-        # join sub-clauses
-        where_clause = ' AND '.join(where_clauses)
+    # where clauses (one per chunk of a large IN-list)
+    filters_split = split_filters_for_in_lists(filters, max_in_list_len=max_in_list_len)
+    where_clauses = [make_sql_where_clause(filters_, cols_all) for filters_ in filters_split]
 
     # issue request
     engine = MySQLEngine(db_config)
-    df = engine.select_records_with_join(
-        database,
-        tablename_primary,
-        tablename_secondary,
-        join_condition,
-        cols_for_query,
-        table_pseudoname_primary=table_pseudoname_primary,
-        table_pseudoname_secondary=table_pseudoname_secondary,
-        where_clause=where_clause,
-        limit=limit,
-        cols_for_df=cols_for_df,
-        as_generator=as_generator
-    )
-
-    return df, engine
+
+    def select_chunk(where_clause: Optional[str],
+                     where_params: list,
+                     limit_: Optional[int],
+                     as_generator_: bool):
+        return engine.select_records_with_join(
+            database,
+            tablename_primary,
+            tablename_secondary,
+            join_condition,
+            cols_for_query,
+            table_pseudoname_primary=table_pseudoname_primary,
+            table_pseudoname_secondary=table_pseudoname_secondary,
+            where_clause=where_clause,
+            limit=limit_,
+            cols_for_df=cols_for_df,
+            as_generator=as_generator_,
+            where_params=where_params or None
+        )
+
+    if len(where_clauses) == 1:
+        df = select_chunk(*where_clauses[0], limit, as_generator)
+        return df, engine
+
+    def df_gen() -> Generator[pd.DataFrame, None, None]:
+        num_remaining = limit
+        for where_clause, where_params in where_clauses:
+            for df_ in select_chunk(where_clause, where_params, num_remaining, True):
+                if num_remaining is not None:
+                    df_ = df_.iloc[:num_remaining]
+                    num_remaining -= len(df_)
+                yield df_
+                if num_remaining == 0:
+                    return
+
+    if as_generator:
+        return df_gen(), engine
+    dfs = [df_ for df_ in df_gen()]
+    return pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame(columns=cols_for_df), engine
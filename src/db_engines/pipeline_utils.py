@@ -0,0 +1,76 @@
+"""Utils for overlapping I/O with processing: background prefetching of chunks into a bounded queue."""
+
+from typing import Iterable, Generator, TypeVar
+import queue
+import threading
+
+
+T = TypeVar('T')
+
+PREFETCH_PUT_POLL_INTERVAL_S = 0.1 # how often a blocked producer checks for cancellation
+
+
+class _PrefetchEnd():
+    """Marks the end of the prefetched iterable"""
+
+class _PrefetchError():
+    """Carries an exception raised by the prefetched iterable"""
+    def __init__(self, e: BaseException):
+        self.e = e
+
+
+def prefetch_gen(items: Iterable[T],
+                 max_prefetch: int = 2) \
+        -> Generator[T, None, None]:
+    """
+    Iterate over 'items' on a background thread, keeping up to max_prefetch items ready in a bounded queue.
+
+    - Backpressure: the background thread blocks once the queue is full, so at most max_prefetch + 1 items are held
+      in memory at a time.
+    - Exceptions raised while producing an item are re-raised in the consumer when it gets to that item.
+    - Cancellation: if the consumer stops early (e.g. breaks out of a for loop or closes this generator), the
+      background thread stops after its in-flight item and closes 'items' if it is a generator, which releases its
+      connections and cursors.
+
+    'items' should not have been started yet if it holds resources tied to a thread (e.g. a MySQL connection opened by
+    a generator), so that they are created and released on the background thread.
+    """
+    assert max_prefetch >= 1
+    q = queue.Queue(maxsize=max_prefetch)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        """Put an item in the queue, giving up if the consumer stopped. Returns False if it did."""
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=PREFETCH_PUT_POLL_INTERVAL_S)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(item):
+                    break
+        except BaseException as e:
+            put(_PrefetchError(e))
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
+            put(_PrefetchEnd())
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while 1:
+            item = q.get()
+            if isinstance(item, _PrefetchEnd):
+                return
+            if isinstance(item, _PrefetchError):
+                raise item.e
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,72 @@
+"""
+Lightweight result formats for small, latency-sensitive queries: rows as namedtuples or results as column lists,
+without building a DataFrame.
+"""
+
+from typing import Sequence, List, Dict, Tuple, Type
+from collections import namedtuple
+from functools import lru_cache
+
+
+RECORD_MODES = ['records', 'columns'] # lightweight modes, in addition to each engine's 'list' and 'pandas'
+
+
+
+@lru_cache(maxsize=256)
+def get_record_type(cols: Tuple[str, ...]) -> Type[tuple]:
+    """
+    Namedtuple type for rows with these columns, created once per set of columns. Leading underscores are dropped
+    (e.g. MongoDB's '_id' becomes 'id') unless that clashes with another column, and names that still aren't valid
+    field names (e.g. 'COUNT(*)') become the column's position ('_0', '_1', ...). Rows can always be indexed.
+    """
+    names = [col.lstrip('_') if col.startswith('_') and col.lstrip('_') not in cols else col for col in cols]
+    return namedtuple('Record', names, rename=True)
+
+def rows_to_records(rows: Sequence[tuple],
+                    cols: Sequence[str]) \
+        -> List[tuple]:
+    """Rows (tuples in column order) as namedtuples"""
+    return list(map(get_record_type(tuple(cols))._make, rows))
+
+def rows_to_columns(rows: Sequence[tuple],
+                    cols: Sequence[str]) \
+        -> Dict[str, list]:
+    """
+    Rows (tuples in column order) as a dict of column name -> list of values. Repeated names (e.g. 'id' of both tables
+    of a join) become the column's position ('_1', ...), as in get_record_type().
+    """
+    names = [col if col not in cols[:i] else f'_{i}' for i, col in enumerate(cols)]
+    if len(rows) == 0:
+        return {name: [] for name in names}
+    return dict(zip(names, map(list, zip(*rows))))
+
+def format_rows(rows: List[tuple],
+                cols: Sequence[str],
+                mode: str):
+    """Rows in a lightweight mode ('records' or 'columns'), or as is for any other mode"""
+    if mode == 'records':
+        return rows_to_records(rows, cols)
+    if mode == 'columns':
+        return rows_to_columns(rows, cols)
+    return rows
+
+def get_dict_fields(recs: Sequence[dict]) -> List[str]:
+    """Fields of schemaless records (e.g. MongoDB documents), in order of first appearance"""
+    fields: Dict[str, None] = {}
+    for rec in recs:
+        for key in rec:
+            if key not in fields:
+                fields[key] = None
+    return list(fields)
+
+def format_dicts(recs: List[dict],
+                 mode: str):
+    """
+    Schemaless records in a lightweight mode ('records' or 'columns'), or as is for any other mode. Fields that a
+    record doesn't have are None.
+    """
+    if mode not in RECORD_MODES:
+        return recs
+    fields = get_dict_fields(recs)
+    rows = [tuple([rec.get(field) for field in fields]) for rec in recs]
+    return format_rows(rows, fields, mode)
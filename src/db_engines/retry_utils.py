@@ -0,0 +1,65 @@
+"""Retry policy with exponential backoff for the engines' query wrappers"""
+
+from typing import Callable, Optional
+import random
+import time
+
+from .deadline_utils import Deadline
+
+
+
+class RetryPolicy():
+    """
+    Configuration for retrying failed database operations.
+
+    Failed attempts are retried up to max_attempts in total, waiting an exponentially growing delay between attempts
+    (backoff_base_s * 2 ** (attempt - 1) after failed attempt number 'attempt', capped at backoff_max_s). With jitter,
+    the delay is drawn uniformly between 0 and that value so that many clients failing at once don't retry in
+    lock-step.
+
+    Which errors are retryable is decided by each engine. Errors that may have happened after a write was applied
+    (e.g. a lost connection) are only retried for idempotent operations, unless retry_writes is True.
+    """
+    def __init__(self,
+                 max_attempts: int = 3,
+                 backoff_base_s: float = 0.1,
+                 backoff_max_s: float = 5.0,
+                 jitter: bool = True,
+                 retry_writes: bool = False):
+        assert max_attempts >= 1
+        self.max_attempts = max_attempts
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+        self.jitter = jitter
+        self.retry_writes = retry_writes
+
+    def get_backoff(self, attempt: int) -> float:
+        """Delay (in seconds) before the retry following failed attempt number 'attempt' (starting at 1)"""
+        delay = min(self.backoff_max_s, self.backoff_base_s * 2 ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+
+def call_with_retries(func: Callable,
+                      policy: RetryPolicy,
+                      is_retryable: Callable[[Exception], bool],
+                      deadline: Optional[Deadline] = None):
+    """
+    Call func() until it succeeds, the error isn't retryable or the policy's max number of attempts is reached. In
+    the latter two cases the last error is re-raised, with the number of attempts made stored in its
+    'db_engine_attempts' attribute. If a deadline is specified, the last error is also re-raised once the backoff
+    before the next attempt would reach it.
+    """
+    attempt = 1
+    while 1:
+        try:
+            return func()
+        except Exception as e:
+            delay = policy.get_backoff(attempt)
+            if attempt >= policy.max_attempts or not is_retryable(e) or \
+                    (deadline is not None and delay >= deadline.remaining_s()):
+                e.db_engine_attempts = attempt
+                raise
+            time.sleep(delay)
+            attempt += 1
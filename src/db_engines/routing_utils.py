@@ -0,0 +1,76 @@
+"""Utils for routing reads to replicas: health- and staleness-aware host selection"""
+
+from typing import Optional, List, Callable, Dict
+import threading
+import time
+
+
+class HostSelector():
+    """
+    Picks a host for each read, round-robin over the hosts that are currently usable.
+
+    A host is skipped for cooldown_s after it fails (mark_failed()). If max_lag_s is specified, each host's replication
+    lag is measured with get_lag(host) at most every lag_check_interval_s, and hosts that lag by more than max_lag_s (or
+    whose lag can't be measured, i.e. get_lag() returns None or raises) are skipped until the next check. Lag checks run
+    inline in choose(), so a slow host only delays the read that triggers its check.
+
+    choose() returns None if no host is usable, in which case the caller should fall back to the primary.
+    """
+    def __init__(self,
+                 hosts: List[str],
+                 cooldown_s: float = 30.0,
+                 max_lag_s: Optional[float] = None,
+                 get_lag: Optional[Callable[[str], Optional[float]]] = None,
+                 lag_check_interval_s: float = 10.0):
+        assert len(hosts) > 0
+        assert max_lag_s is None or get_lag is not None
+        self._hosts = list(hosts)
+        self._cooldown_s = cooldown_s
+        self._max_lag_s = max_lag_s
+        self._get_lag = get_lag
+        self._lag_check_interval_s = lag_check_interval_s
+        self._lock = threading.Lock()
+        self._idx_next = 0
+        self._failed_until: Dict[str, float] = {}
+        self._lags: Dict[str, Optional[float]] = {}
+        self._lags_checked_at: Dict[str, float] = {}
+
+    def get_hosts(self) -> List[str]:
+        return list(self._hosts)
+
+    def mark_failed(self, host: str):
+        """Skip a host for the cooldown period, e.g. after a connection error"""
+        with self._lock:
+            self._failed_until[host] = time.monotonic() + self._cooldown_s
+
+    def get_lag(self, host: str) -> Optional[float]:
+        """Last measured replication lag of a host (in seconds), if known"""
+        return self._lags.get(host)
+
+    def choose(self) -> Optional[str]:
+        """Next usable host, or None if there isn't one"""
+        with self._lock:
+            idx_start = self._idx_next
+            self._idx_next = (self._idx_next + 1) % len(self._hosts)
+        for i in range(len(self._hosts)):
+            host = self._hosts[(idx_start + i) % len(self._hosts)]
+            if self._is_usable(host):
+                return host
+        return None
+
+    def _is_usable(self, host: str) -> bool:
+        now = time.monotonic()
+        if self._failed_until.get(host, 0.0) > now:
+            return False
+        if self._max_lag_s is None:
+            return True
+        if now - self._lags_checked_at.get(host, -float('inf')) >= self._lag_check_interval_s:
+            try:
+                lag = self._get_lag(host)
+            except Exception:
+                lag = None
+            with self._lock:
+                self._lags[host] = lag
+                self._lags_checked_at[host] = now
+        lag = self._lags.get(host)
+        return lag is not None and lag <= self._max_lag_s
@@ -0,0 +1,98 @@
+"""Request coalescing (single-flight): identical concurrent calls share one execution"""
+
+from typing import Optional, Callable, Hashable, Dict, Any
+import copy
+import threading
+
+
+SINGLE_FLIGHT_SCOPES = ['engine', 'process'] # scope of deduplication, see make_single_flight()
+
+
+class _Call():
+    """An in-flight execution and the callers waiting on it"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.num_followers = 0
+
+
+class SingleFlight():
+    """
+    Thread-safe coalescing of identical concurrent calls: while do(key, func) runs for a key, other calls with the same
+    key wait for it and get its result (or its exception) instead of running func themselves. Calls made after it
+    completes run func again, i.e. results aren't cached. After a write, invalidate_where() stops calls from joining
+    executions that started before it (and may have read the data it changed).
+
+    Every caller gets its own copy of the result when the execution was shared, so callers can mutate what they get.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self.num_calls = 0
+        self.num_executions = 0
+
+    def do(self,
+           key: Hashable,
+           func: Callable[[], Any],
+           copy_result: Callable[[Any], Any] = copy.deepcopy):
+        """Run func(), or wait for the in-flight call with the same key"""
+        with self._lock:
+            self.num_calls += 1
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+                self.num_executions += 1
+            else:
+                call.num_followers += 1
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy_result(call.result)
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call: # later calls run again
+                    del self._calls[key]
+                num_followers = call.num_followers
+            call.done.set()
+        return copy_result(call.result) if num_followers > 0 else call.result
+
+    def invalidate_where(self, pred: Callable[[Hashable], bool]):
+        """
+        Make the in-flight executions of all keys for which pred(key) is True unjoinable: their callers still get their
+        result, but later calls with these keys run func again
+        """
+        with self._lock:
+            for key in [key for key in self._calls if pred(key)]:
+                del self._calls[key]
+
+    def get_stats(self) -> dict:
+        """Number of calls, of executions and of calls that were deduplicated (shared an execution)"""
+        with self._lock:
+            return dict(num_calls=self.num_calls, num_executions=self.num_executions,
+                        num_deduplicated=self.num_calls - self.num_executions, num_in_flight=len(self._calls))
+
+
+_PROCESS_SINGLE_FLIGHT = SingleFlight()
+
+def make_single_flight(scope: Optional[str]) -> Optional[SingleFlight]:
+    """
+    Single-flight layer for an engine: None (disabled), a new one for scope='engine' (calls are only deduplicated with
+    calls on the same engine) or the one shared by the whole process for scope='process' (calls are deduplicated
+    across all engines, whose keys then identify the server they query).
+    """
+    assert scope is None or scope in SINGLE_FLIGHT_SCOPES
+    if scope is None:
+        return None
+    if scope == 'engine':
+        return SingleFlight()
+    return _PROCESS_SINGLE_FLIGHT
@@ -0,0 +1,134 @@
+"""Utils for running SQL scripts: splitting a script into statements and grouping them into batches"""
+
+from typing import Iterable, Generator, List, Optional, Dict
+import re
+
+from .constants import MYSQL_SCRIPT_BATCH_MAX_BYTES
+
+
+DEFAULT_DELIMITER = ';'
+
+_QUOTE_PATTERNS: Dict[str, re.Pattern] = {
+    "'": re.compile(r"\\.|'", re.S),
+    '"': re.compile(r'\\.|"', re.S),
+    '`': re.compile('`'), # no escapes in identifiers, a doubled backtick closes and reopens
+}
+
+
+
+class SQLStatement():
+    """A statement of a SQL script, with the line it starts on and the delimiter that ended it"""
+    def __init__(self,
+                 text: str,
+                 line_no: int,
+                 delimiter: str = DEFAULT_DELIMITER):
+        self.text = text
+        self.line_no = line_no
+        self.delimiter = delimiter
+
+    def __repr__(self) -> str:
+        return f'SQLStatement(line {self.line_no}: {self.text[:50]!r})'
+
+
+def _make_code_pattern(delimiter: str) -> re.Pattern:
+    """Tokens that change the state of the splitter outside of strings and comments"""
+    return re.compile(re.escape(delimiter) + r"""|['"`#]|--|/\*""")
+
+def split_sql_statements(lines: Iterable[str]) -> Generator[SQLStatement, None, None]:
+    """
+    Split a SQL script into statements, reading it line by line so that scripts of any size can be streamed from disk.
+
+    Statements end at the delimiter (';' by default) unless it's inside a string ('...', "..." with backslash
+    escapes), a quoted identifier (`...`) or a comment (-- ..., # ..., /* ... */). Line comments are dropped, block
+    comments are kept since they may be executable (/*! ... */). As in the mysql client, a line 'DELIMITER <delim>'
+    between statements changes the delimiter, e.g. for stored procedures whose bodies contain ';'.
+    """
+    delimiter = DEFAULT_DELIMITER
+    code_pattern = _make_code_pattern(delimiter)
+    buf: List[str] = []
+    line_start: Optional[int] = None # line of the current statement's first code, None while there is none
+    state: Optional[str] = None # None (code), '/*' (block comment) or the opening quote
+
+    for line_no, line in enumerate(lines, start=1):
+        if state is None and line_start is None:
+            parts = line.split()
+            if len(parts) > 0 and parts[0].upper() == 'DELIMITER':
+                if len(parts) != 2:
+                    raise ValueError(f'Invalid DELIMITER command on line {line_no}: {line.strip()}')
+                delimiter = parts[1]
+                code_pattern = _make_code_pattern(delimiter)
+                buf.clear()
+                continue
+
+        pos = 0
+        while pos < len(line):
+            if state is None:
+                m = code_pattern.search(line, pos)
+                end = len(line) if m is None else m.start()
+                if line_start is None and line[pos:end].strip():
+                    line_start = line_no
+                    buf.clear() # drop the comments before the statement
+                buf.append(line[pos:end])
+                if m is None:
+                    break
+                tok = m.group()
+                pos = m.end()
+                if tok == delimiter:
+                    if line_start is not None:
+                        yield SQLStatement(''.join(buf).strip(), line_start, delimiter)
+                    buf.clear()
+                    line_start = None
+                elif tok == '#' or (tok == '--' and line[pos:pos + 1] in ['', ' ', '\t', '\r', '\n']):
+                    buf.append('\n')
+                    break
+                elif tok == '--': # e.g. 'x--1'
+                    buf.append(tok)
+                else:
+                    if line_start is None and (tok != '/*' or line[pos:pos + 1] in ['!', '+']):
+                        line_start = line_no # strings and executable comments are code
+                        buf.clear()
+                    buf.append(tok)
+                    state = tok
+            elif state == '/*':
+                end = line.find('*/', pos)
+                if end < 0:
+                    buf.append(line[pos:])
+                    break
+                buf.append(line[pos:end + 2])
+                pos = end + 2
+                state = None
+            else:
+                m = _QUOTE_PATTERNS[state].search(line, pos)
+                if m is None:
+                    buf.append(line[pos:])
+                    break
+                buf.append(line[pos:m.end()])
+                pos = m.end()
+                if m.group() == state:
+                    state = None
+
+    if line_start is not None: # last statement without a delimiter
+        yield SQLStatement(''.join(buf).strip(), line_start, delimiter)
+
+def batch_sql_statements(statements: Iterable[SQLStatement],
+                         max_batch_bytes: int = MYSQL_SCRIPT_BATCH_MAX_BYTES) \
+        -> Generator[List[SQLStatement], None, None]:
+    """
+    Group consecutive statements into batches of up to max_batch_bytes of text, to be sent in one round trip each.
+    Statements that ended with a custom delimiter (e.g. stored procedure definitions) are sent on their own.
+    """
+    batch: List[SQLStatement] = []
+    num_bytes = 0
+    for statement in statements:
+        size = len(statement.text.encode('utf-8'))
+        alone = statement.delimiter != DEFAULT_DELIMITER
+        if batch and (alone or num_bytes + size > max_batch_bytes):
+            yield batch
+            batch, num_bytes = [], 0
+        batch.append(statement)
+        num_bytes += size
+        if alone:
+            yield batch
+            batch, num_bytes = [], 0
+    if batch:
+        yield batch
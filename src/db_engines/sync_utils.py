@@ -0,0 +1,219 @@
+"""Incremental sync of MongoDB collections into derived MySQL tables."""
+
+from typing import Dict, List, Optional, Union, Callable, Any, Tuple
+import time
+
+from bson import ObjectId
+
+from .mongodb_engine import MongoDBEngine
+from .mysql_engine import MySQLEngine
+from .mysql_utils import make_upsert_query
+from .keyset_utils import (encode_cursor_token, decode_cursor_token, load_checkpoint, save_checkpoint,
+                           get_nested_field)
+from .exceptions import MongoDBEngineError
+from .constants import MYSQL_FETCH_MANY_MAX_COUNT
+
+
+MONGODB_ERROR_CODE_CHANGE_STREAM_NOT_SUPPORTED = 40573
+
+ColumnMap = Dict[str, Union[str, Callable[[dict], Any]]]
+
+
+
+def map_record_to_row(rec: dict,
+                      column_map: ColumnMap,
+                      cols: List[str]) \
+        -> tuple:
+    """
+    Map a MongoDB record to a MySQL row. column_map has MySQL column names as keys and either a (possibly dotted)
+    record field or a function of the record as values. Missing fields map to NULL and ObjectIds to strings.
+    """
+    row = []
+    for col in cols:
+        src = column_map[col]
+        if callable(src):
+            val = src(rec)
+        else:
+            try:
+                val = get_nested_field(rec, src)
+            except (KeyError, TypeError):
+                val = None
+        if isinstance(val, ObjectId):
+            val = str(val)
+        row.append(val)
+    return tuple(row)
+
+
+class _SyncBatch():
+    """Pending changes, keeping only the last change per record"""
+    def __init__(self):
+        self.changes: Dict[Any, Optional[dict]] = {} # _id -> full record (upsert) or None (delete)
+        self.num_events = 0
+
+    def add(self,
+            id_: Any,
+            rec: Optional[dict]):
+        self.changes.pop(id_, None) # keep order of last change
+        self.changes[id_] = rec
+        self.num_events += 1
+
+    def __len__(self) -> int:
+        return self.num_events
+
+
+def sync_mongodb_to_mysql(mongo_engine: MongoDBEngine,
+                          mysql_engine: MySQLEngine,
+                          database: str,
+                          tablename: str,
+                          column_map: ColumnMap,
+                          key_cols: List[str],
+                          checkpoint: Optional[Union[str, Callable[[str], None]]] = None,
+                          resume_token: Optional[str] = None,
+                          mode: str = 'auto',
+                          watermark_field: str = '_id',
+                          batch_size: int = MYSQL_FETCH_MANY_MAX_COUNT,
+                          max_await_time_ms: int = 1000,
+                          stop_when_idle: bool = True,
+                          verbose: bool = False) \
+        -> dict:
+    """
+    Incrementally sync the engine's current MongoDB collection into a MySQL table.
+
+    Records are mapped to rows via column_map (see map_record_to_row()) and applied in batches of upserts
+    (INSERT ... ON DUPLICATE KEY UPDATE) on key_cols, which must be the table's primary or a unique key. After each
+    batch is applied, a token is checkpointed to a local file or a callback; pass it back as resume_token (or reuse the
+    same checkpoint file) to continue from there. Re-applying a batch after a crash is harmless since upserts and
+    deletes are idempotent.
+
+    Modes:
+        - 'change_stream': tail the collection's change stream (requires a replica set). Deleted records are deleted
+          from the table if a key column is mapped from '_id'. Without a resume token, the stream is opened first and
+          the whole collection is copied before tailing it, so no change is missed.
+        - 'watermark': copy records whose watermark_field is above the last one synced (e.g. '_id' for insert-only
+          collections or an 'updated_at' timestamp). Deletes are not propagated.
+        - 'auto': change stream if supported by the server, otherwise watermark.
+
+    If stop_when_idle is True, returns once there are no more pending changes. Otherwise keeps tailing. Returns sync
+    stats.
+    """
+    assert mode in ['auto', 'change_stream', 'watermark']
+    assert len(key_cols) > 0 and all([col in column_map for col in key_cols])
+
+    cols = list(column_map)
+    cols_delete = [col for col in key_cols if column_map[col] == '_id']
+    query_upsert = make_upsert_query(tablename, cols, update_keys=[col for col in cols if col not in key_cols])
+    query_delete = None
+    if cols_delete == key_cols:
+        query_delete = f"DELETE FROM {tablename} WHERE {key_cols[0]} = %s"
+
+    # checkpointing
+    if isinstance(checkpoint, str):
+        path = checkpoint
+        if resume_token is None:
+            resume_token = load_checkpoint(path)
+        checkpoint = lambda token_: save_checkpoint(path, token_)
+
+    stats = dict(mode=None, num_upserted=0, num_deleted=0, num_batches=0, token=resume_token)
+
+    def flush(batch: _SyncBatch,
+              token: Optional[str]):
+        rows_upsert = [map_record_to_row(rec, column_map, cols) for rec in batch.changes.values() if rec is not None]
+        ids_delete = [(str(id_) if isinstance(id_, ObjectId) else id_,)
+                      for id_, rec in batch.changes.items() if rec is None]
+        if rows_upsert:
+            mysql_engine.insert_records_to_table(database, query_upsert, rows_upsert)
+        if ids_delete and query_delete is not None:
+            mysql_engine.insert_records_to_table(database, query_delete, ids_delete)
+        if token is not None:
+            stats['token'] = token
+            if checkpoint is not None:
+                checkpoint(token)
+        if len(batch) == 0:
+            return
+        stats['num_upserted'] += len(rows_upsert)
+        stats['num_deleted'] += len(ids_delete) if query_delete is not None else 0
+        stats['num_batches'] += 1
+        if verbose:
+            print(f"sync_mongodb_to_mysql() -> Applied {len(rows_upsert)} upserts and {len(ids_delete)} deletes to "
+                  f"table {tablename} of database {database}.")
+
+    # pick mode
+    token_mode, token_val = (None, None) if resume_token is None else decode_cursor_token(resume_token)
+    if mode == 'auto' and token_mode is not None:
+        mode = 'change_stream' if token_mode == 'cs' else 'watermark'
+    assert token_mode is None or token_mode == ('cs' if mode == 'change_stream' else 'wm')
+
+    if mode in ['auto', 'change_stream']:
+        try:
+            stream = mongo_engine.watch(resume_token=None if token_val is None else {'_data': token_val},
+                                        max_await_time_ms=max_await_time_ms, batch_size=batch_size)
+            mode = 'change_stream'
+        except MongoDBEngineError as e:
+            if mode == 'change_stream' or e.code != MONGODB_ERROR_CODE_CHANGE_STREAM_NOT_SUPPORTED:
+                raise
+            mode = 'watermark'
+    stats['mode'] = mode
+
+    if mode == 'change_stream':
+        with stream:
+            if token_val is None: # initial copy, changes made during it are replayed from the stream afterwards
+                _sync_by_watermark(mongo_engine, '_id', None, batch_size, lambda batch, _: flush(batch, None))
+                flush(_SyncBatch(), encode_cursor_token(['cs', stream.resume_token['_data']]))
+            _sync_by_change_stream(stream, batch_size, stop_when_idle, flush)
+    else:
+        while 1:
+            token_val = _sync_by_watermark(mongo_engine, watermark_field, token_val, batch_size, flush)
+            if stop_when_idle:
+                break
+            time.sleep(max_await_time_ms / 1000)
+
+    return stats
+
+
+def _sync_by_change_stream(stream,
+                           batch_size: int,
+                           stop_when_idle: bool,
+                           flush: Callable[[_SyncBatch, Optional[str]], None]):
+    """Apply change-stream events in batches"""
+    batch = _SyncBatch()
+    while stream.alive:
+        change = stream.try_next()
+        if change is not None:
+            op = change['operationType']
+            if op in ['insert', 'update', 'replace']:
+                if change.get('fullDocument') is not None: # None if deleted since, delete event follows
+                    batch.add(change['documentKey']['_id'], change['fullDocument'])
+            elif op == 'delete':
+                batch.add(change['documentKey']['_id'], None)
+            elif op in ['drop', 'rename', 'dropDatabase', 'invalidate']:
+                raise MongoDBEngineError(f"sync_mongodb_to_mysql() -> Collection was invalidated by a '{op}' event.")
+        if len(batch) >= batch_size or (change is None and len(batch) > 0):
+            flush(batch, encode_cursor_token(['cs', stream.resume_token['_data']]))
+            batch = _SyncBatch()
+        if change is None and stop_when_idle:
+            return
+
+def _sync_by_watermark(mongo_engine: MongoDBEngine,
+                       watermark_field: str,
+                       token_val: Optional[str],
+                       batch_size: int,
+                       flush: Callable[[_SyncBatch, Optional[str]], None]) \
+        -> Optional[str]:
+    """Apply records above the watermark in batches. Returns the new watermark (as a keyset cursor token)."""
+    while 1:
+        recs, token_last = _find_recs_after(mongo_engine, watermark_field, token_val, batch_size)
+        if len(recs) == 0:
+            return token_val
+        batch = _SyncBatch()
+        for rec in recs:
+            batch.add(rec['_id'], rec)
+        token_val = token_last
+        flush(batch, encode_cursor_token(['wm', token_val]))
+
+def _find_recs_after(mongo_engine: MongoDBEngine,
+                     watermark_field: str,
+                     token_val: Optional[str],
+                     batch_size: int) \
+        -> Tuple[List[dict], Optional[str]]:
+    """Get the next batch of full records in watermark order"""
+    return mongo_engine.find_page_records([watermark_field], cursor_token=token_val, page_size=batch_size)
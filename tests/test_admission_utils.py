@@ -0,0 +1,132 @@
+"""Tests for admission control utils"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.db_engines.admission_utils import AdmissionPolicy, AdmissionController, priority
+from src.db_engines.exceptions import AdmissionError
+from src.db_engines.deadline_utils import Deadline
+
+
+
+
+def test_concurrency_limit():
+    controller = AdmissionController(AdmissionPolicy(max_concurrency=2))
+    num_running = []
+    lock = threading.Lock()
+    max_running = [0]
+
+    def op():
+        with controller.admit():
+            with lock:
+                num_running.append(1)
+                max_running[0] = max(max_running[0], len(num_running))
+            time.sleep(0.05)
+            with lock:
+                num_running.pop()
+
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        list(executor.map(lambda _: op(), range(6)))
+    assert max_running[0] == 2
+    stats = controller.get_stats()
+    assert stats['num_admitted'] == 6 and stats['num_in_flight'] == 0 and stats['num_queued'] >= 4
+
+def test_priorities():
+    controller = AdmissionController(AdmissionPolicy(max_concurrency=1))
+    order = []
+    release = threading.Event()
+
+    def holder():
+        with controller.admit():
+            release.wait()
+
+    def op(name: str, priority_: str):
+        with priority(priority_):
+            with controller.admit():
+                order.append(name)
+
+    threads = [threading.Thread(target=holder)]
+    threads[0].start()
+    time.sleep(0.05)
+    for name, priority_ in [('batch1', 'batch'), ('interactive1', 'interactive'), ('batch2', 'batch')]:
+        threads.append(threading.Thread(target=op, args=(name, priority_)))
+        threads[-1].start()
+        time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert order == ['interactive1', 'batch1', 'batch2']
+
+def test_queue_timeout():
+    controller = AdmissionController(AdmissionPolicy(max_concurrency=1, max_queue_len=1))
+    release = threading.Event()
+
+    def holder():
+        with controller.admit():
+            release.wait()
+
+    thread = threading.Thread(target=holder)
+    thread.start()
+    time.sleep(0.05)
+
+    # deadline while waiting
+    try:
+        with controller.admit(deadline=Deadline(0.1)):
+            assert False
+    except AdmissionError:
+        pass
+    assert controller.get_stats()['num_waiting'] == 0
+
+    release.set()
+    thread.join()
+
+def test_reentrant_admission():
+    controller = AdmissionController(AdmissionPolicy(max_concurrency=1, queue_timeout_s=0.1))
+    assert AdmissionPolicy().queue_timeout_s is not None
+
+    # a thread holding a slot (e.g. consuming a scan) is admitted again instead of waiting on itself
+    with controller.admit(measure=False):
+        with controller.admit():
+            assert controller.get_stats()['num_in_flight'] == 2
+
+        # other threads still wait
+        errors = []
+        def other():
+            try:
+                with controller.admit():
+                    pass
+            except AdmissionError as e:
+                errors.append(e)
+        thread = threading.Thread(target=other)
+        thread.start()
+        thread.join()
+        assert len(errors) == 1
+    assert controller.get_stats()['num_in_flight'] == 0
+    assert controller._holders == {}
+
+def test_adaptive_limit():
+    controller = AdmissionController(AdmissionPolicy(max_concurrency=10, min_concurrency=2, adaptive=True,
+                                                     target_latency_s=0.01))
+    controller._limit = 4.0
+
+    # slow operations shrink the limit down to min_concurrency
+    for _ in range(20):
+        controller._acquire(None, None)
+        controller._release(0.1, False)
+    assert controller.get_limit() == 2
+
+    # fast operations grow it again
+    for _ in range(50):
+        controller._acquire(None, None)
+        controller._release(0.001, False)
+    assert controller.get_limit() > 2
+
+    # overload errors shrink it
+    limit = controller._limit
+    try:
+        with controller.admit(is_overload_error=lambda e: isinstance(e, TimeoutError)):
+            raise TimeoutError
+    except TimeoutError:
+        pass
+    assert controller._limit < limit
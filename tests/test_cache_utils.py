@@ -0,0 +1,38 @@
+"""Tests for cache utils"""
+
+import time
+
+from src.db_engines.cache_utils import LRUCache
+
+
+
+
+def test_lru_cache():
+    cache = LRUCache(max_size=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == (True, 1)
+    cache.put('c', 3) # evicts 'b', the least recently used
+    assert cache.get('b') == (False, None)
+    assert cache.get('c') == (True, 3)
+    assert cache.num_hits == 2 and cache.num_misses == 1
+
+    cache.invalidate_where(lambda key: key == 'a')
+    assert cache.get('a') == (False, None) and len(cache) == 1
+
+def test_lru_cache_version():
+    cache = LRUCache()
+    version = cache.get_version()
+    cache.invalidate('a') # e.g. a write that raced with a read
+    cache.put('a', 'stale', version=version)
+    assert cache.get('a') == (False, None)
+
+    cache.put('a', 'fresh', version=cache.get_version())
+    assert cache.get('a') == (True, 'fresh')
+
+def test_lru_cache_ttl():
+    cache = LRUCache(ttl_s=0.05)
+    cache.put('a', 1)
+    assert cache.get('a') == (True, 1)
+    time.sleep(0.1)
+    assert cache.get('a') == (False, None)
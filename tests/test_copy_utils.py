@@ -0,0 +1,88 @@
+"""Tests for bulk copy between MySQL and MongoDB"""
+
+import datetime
+import decimal
+
+import pandas as pd
+from bson import ObjectId
+
+from src.db_engines.mongodb_engine import MongoDBEngine
+from src.db_engines.mysql_engine import MySQLEngine
+from src.db_engines.copy_utils import (copy_mysql_to_mongodb, copy_mongodb_to_mysql, convert_df_for_mongodb,
+                                       convert_df_for_mysql, import_file_to_mysql, import_file_to_mongodb)
+from tests.constants_tests import DB_MONGO_CONFIG, DB_MYSQL_CONFIG, DATABASES_MYSQL, DATA_INSERT_MYSQL
+from tests.test_mongodb import reset_mongodb, setup_db_and_insert_records
+from tests.test_mysql import setup_test_db
+
+
+DB_TEST = DATABASES_MYSQL['test']
+
+
+
+
+def test_convert_df():
+    df = pd.DataFrame(dict(
+        dec=[decimal.Decimal('1.5'), None],
+        date=[datetime.date(2020, 2, 2), None],
+        dt=[datetime.datetime(2020, 2, 2, 10, 5, 3, 123456), None]
+    ))
+    recs = convert_df_for_mongodb(df).to_dict('records')
+    assert recs == [
+        dict(dec=1.5, date=datetime.datetime(2020, 2, 2), dt=datetime.datetime(2020, 2, 2, 10, 5, 3, 123000)),
+        dict(dec=None, date=None, dt=None)
+    ]
+
+    id_ = ObjectId()
+    df = pd.DataFrame(dict(_id=[id_, None], dt=pd.to_datetime([datetime.datetime(2020, 2, 2, 10, 5, 3, 123456), None])))
+    recs = list(convert_df_for_mysql(df).itertuples(index=False, name=None))
+    assert recs == [(str(id_), datetime.datetime(2020, 2, 2, 10, 5, 3, 123000)), (None, None)]
+
+def test_copy_mysql_to_mongodb():
+    mysql_engine = MySQLEngine(DB_MYSQL_CONFIG)
+    setup_test_db(mysql_engine, inject_data=True)
+
+    mongo_engine, _ = setup_db_and_insert_records()
+    reset_mongodb(mongo_engine)
+
+    stats = copy_mysql_to_mongodb(mysql_engine, DB_TEST, mongo_engine, tablename='meta')
+    assert stats['num_records'] == len(DATA_INSERT_MYSQL['meta'])
+
+    df = mongo_engine.find_many(projection={'_id': 0})
+    assert set(df['id_meta']) == set([rec[0] for rec in DATA_INSERT_MYSQL['meta']])
+    assert set(df['date_meta']) == set([pd.Timestamp(rec[2]) for rec in DATA_INSERT_MYSQL['meta']])
+
+def test_copy_mongodb_to_mysql():
+    mysql_engine = MySQLEngine(DB_MYSQL_CONFIG)
+    setup_test_db(mysql_engine)
+
+    mongo_engine, data = setup_db_and_insert_records()
+    for i, rec in enumerate(data):
+        rec['username'] = 'user' + str(i)
+    reset_mongodb(mongo_engine)
+    mongo_engine.insert_many([dict(username=rec['username'], number=rec['number']) for rec in data])
+
+    stats = copy_mongodb_to_mysql(mongo_engine, mysql_engine, DB_TEST, 'usernames', projection={'username': 1},
+                                  column_map={'username': 'username'}, max_prefetch=1)
+    assert stats['num_records'] == len(data)
+
+    recs = mysql_engine.select_records(DB_TEST, 'SELECT username FROM usernames')
+    assert set([rec[0] for rec in recs]) == set([rec['username'] for rec in data])
+
+def test_import_file(tmp_path):
+    path = str(tmp_path / 'recs.csv')
+    pd.DataFrame(dict(name=['user' + str(i) for i in range(10)], number=list(range(10)))).to_csv(path, index=False)
+
+    mysql_engine = MySQLEngine(DB_MYSQL_CONFIG)
+    setup_test_db(mysql_engine)
+    stats = import_file_to_mysql(path, mysql_engine, DB_TEST, 'usernames', column_map={'name': 'username'},
+                                 csv_block_size=64)
+    assert stats['num_records'] == 10 and stats['num_chunks'] > 1
+    recs = mysql_engine.select_records(DB_TEST, 'SELECT username FROM usernames')
+    assert set([rec[0] for rec in recs]) == set(['user' + str(i) for i in range(10)])
+
+    mongo_engine, _ = setup_db_and_insert_records()
+    reset_mongodb(mongo_engine)
+    stats = import_file_to_mongodb(path, mongo_engine, column_map={'name': 'username', 'number': 'number'})
+    assert stats['num_records'] == 10
+    df = mongo_engine.find_many(projection={'_id': 0})
+    assert set(df['username']) == set(['user' + str(i) for i in range(10)])
@@ -0,0 +1,77 @@
+"""Tests for dtype utils"""
+
+import datetime
+
+import pandas as pd
+
+from src.db_engines.dtype_utils import (DtypePolicy, get_mysql_dtypes, get_frame_dtypes, apply_dtypes, make_typed_df,
+                                        categorize)
+
+
+# (name, type_code, display_size, internal_size, precision, scale, null_ok, flags, charset) as in cursor.description
+DESCRIPTION = [
+    ('id_meta', 253, None, None, None, None, 0, 4099, 255), # VARCHAR NOT NULL
+    ('username', 253, None, None, None, None, 1, 0, 255), # VARCHAR
+    ('timestamp_meta', 7, None, None, None, None, 1, 128, 63), # TIMESTAMP
+    ('score', 2, None, None, None, None, 0, 32, 63), # SMALLINT UNSIGNED NOT NULL
+    ('count', 3, None, None, None, None, 1, 0, 63), # INT
+    ('data', 252, None, None, None, None, 1, 144, 63), # BLOB
+    ('tags', 254, None, None, None, None, 1, 2048, 255), # SET
+]
+RECORDS = [
+    ('a', 'user1', datetime.datetime(2024, 1, 1, 12, 0, 0, 123456), 3, 10, b'x', {'x', 'y'}),
+    ('b', 'user1', None, 65535, None, None, set()),
+]
+
+
+
+
+def test_get_mysql_dtypes():
+    dtypes = get_mysql_dtypes(DESCRIPTION, DtypePolicy())
+    assert dtypes == ['string[pyarrow]', 'string[pyarrow]', 'datetime64[ms]', 'uint16', 'Int32', None, None]
+
+    dtypes = get_mysql_dtypes(DESCRIPTION, DtypePolicy(downcast_ints=False, string_dtype=None, datetime_unit=None,
+                                                       categories=dict(username=['user1', 'user2'])))
+    assert dtypes[:5] == [None, pd.CategoricalDtype(['user1', 'user2']), None, None, None]
+
+def test_string_dtype_fallback(monkeypatch):
+    # the default string dtype needs pyarrow, which is optional
+    monkeypatch.setattr('src.db_engines.dtype_utils.is_pyarrow_installed', lambda: False)
+    assert DtypePolicy().string_dtype == 'string'
+    assert DtypePolicy(string_dtype=None).string_dtype is None
+
+def test_make_typed_df():
+    cols = [col[0] for col in DESCRIPTION]
+    dtypes = get_mysql_dtypes(DESCRIPTION, DtypePolicy(string_dtype='string'))
+    df = make_typed_df(RECORDS, cols, dtypes)
+    assert [str(dtype) for dtype in df.dtypes] == ['string', 'string', 'datetime64[ms]', 'uint16', 'Int32', 'object',
+                                                   'object']
+    assert df['tags'][0] == {'x', 'y'}
+    assert df['timestamp_meta'][0] == pd.Timestamp('2024-01-01 12:00:00.123')
+
+    # chunks have the same dtypes, so concatenation keeps them
+    df2 = make_typed_df(RECORDS[:1], cols, dtypes)
+    assert (pd.concat([df, df2]).dtypes == df.dtypes).all()
+
+    # nulls in a column declared NOT NULL (e.g. outer join) fall back to the nullable dtype
+    df = apply_dtypes(pd.DataFrame(dict(score=[1, None])), dict(score='uint16'))
+    assert str(df['score'].dtype) == 'UInt16'
+
+def test_get_frame_dtypes():
+    df = pd.DataFrame([dict(_id=1, name='a', ts=datetime.datetime(2024, 1, 1), mixed='a'),
+                       dict(_id=2, name=None, ts=datetime.datetime(2024, 1, 2), mixed=1)])
+    dtypes = get_frame_dtypes(df, DtypePolicy(string_dtype='string'))
+    assert dtypes == dict(name='string', ts='datetime64[ms]')
+    df = apply_dtypes(df, dtypes)
+    assert str(df['name'].dtype) == 'string' and str(df['ts'].dtype) == 'datetime64[ms]'
+    assert df['_id'].dtype == 'int64' and df['mixed'].dtype == object
+
+def test_categorize():
+    policy = DtypePolicy(string_dtype='string', categorical_max_ratio=0.5, categorical_min_rows=4)
+    df = pd.DataFrame(dict(low=['a', 'b'] * 3, high=[str(i) for i in range(6)], num=range(6)))
+    df = categorize(df, policy)
+    assert isinstance(df['low'].dtype, pd.CategoricalDtype)
+    assert df['high'].dtype == object and df['num'].dtype == 'int64'
+
+    # small frames are left as is
+    assert categorize(pd.DataFrame(dict(low=['a'] * 3)), policy)['low'].dtype == object
@@ -0,0 +1,59 @@
+"""Tests for import times and lazy loading of heavy dependencies"""
+
+import json
+import subprocess
+import sys
+
+
+HEAVY_MODULES = ['pandas', 'numpy', 'pymongo', 'mysql.connector', 'ytpa_utils', 'pyarrow']
+
+IMPORT_TIME_MAX_S = 0.5 # generous bound for the package alone, pandas takes about as long by itself
+
+
+
+
+def get_modules_loaded_by(code: str) -> dict:
+    """Run code in a fresh interpreter. Returns which heavy modules it imported and the time it took."""
+    script = f"""
+import json, sys, time
+t_start = time.perf_counter()
+{code}
+dur = time.perf_counter() - t_start
+print(json.dumps(dict(loaded=[name for name in {HEAVY_MODULES} if name in sys.modules], dur=dur)))
+"""
+    out = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().split('\n')[-1])
+
+def test_import_package():
+    res = get_modules_loaded_by('import src.db_engines')
+    assert res['loaded'] == []
+    assert res['dur'] < IMPORT_TIME_MAX_S
+
+def test_import_mysql_engine():
+    res = get_modules_loaded_by('from src.db_engines import MySQLEngine')
+    assert res['loaded'] == ['mysql.connector']
+
+    res = get_modules_loaded_by('from src.db_engines.mysql_utils import get_table_colnames')
+    assert res['loaded'] == ['mysql.connector']
+
+def test_import_mongodb_engine():
+    res = get_modules_loaded_by('from src.db_engines import MongoDBEngine')
+    assert res['loaded'] == ['pymongo']
+
+def test_pandas_loaded_on_use():
+    res = get_modules_loaded_by('from src.db_engines.io_utils import infer_arrow_schema\n'
+                                'from src.db_engines.mysql_engine import MySQLEngine\n'
+                                'MySQLEngine(dict(host="", user="", password="")).get_cache_stats()')
+    assert 'pandas' not in res['loaded']
+
+    res = get_modules_loaded_by('from src.db_engines.io_utils import pd\n'
+                                'pd.DataFrame()')
+    assert 'pandas' in res['loaded']
+
+def test_import_lazy_query_and_copy_utils():
+    res = get_modules_loaded_by('from src.db_engines import MySQLQuery, MongoDBQuery\n'
+                                'MongoDBQuery(None).filter(number=[1, 2]).to_pipeline()')
+    assert res['loaded'] == []
+
+    res = get_modules_loaded_by('from src.db_engines import copy_utils')
+    assert res['loaded'] == ['mysql.connector']
@@ -0,0 +1,117 @@
+"""Tests for streaming file I/O utils"""
+
+import os
+
+import pandas as pd
+import pyarrow.parquet as pq
+from bson import ObjectId
+
+from src.db_engines.io_utils import write_chunks_to_file, read_file_chunks, spill_chunks_to_file
+
+
+
+
+IDS = [ObjectId() for _ in range(3)]
+
+def make_chunks():
+    yield pd.DataFrame(dict(_id=IDS[:2], number=[1, 2], text=[None, None], group=['a', 'b']))
+    yield pd.DataFrame(dict(_id=IDS[2:], number=[3], text=['c'], group=['a']))
+
+def test_write_chunks_to_file(tmp_path):
+    df_exp = pd.concat([df_ for df_ in make_chunks()], ignore_index=True)
+    df_exp['_id'] = df_exp['_id'].astype(str)
+
+    # parquet, one row group per chunk
+    path = str(tmp_path / 'recs.parquet')
+    res = write_chunks_to_file(make_chunks(), path)
+    assert res['num_records'] == 3 and res['num_chunks'] == 2
+    assert pq.ParquetFile(path).num_row_groups == 2
+    assert pd.read_parquet(path).equals(df_exp)
+
+    # compressed csv
+    path = str(tmp_path / 'recs.csv.gz')
+    write_chunks_to_file(make_chunks(), path, format='csv', compression='gzip')
+    df = pd.read_csv(path, compression='gzip')
+    assert df['_id'].tolist() == df_exp['_id'].tolist() and df['number'].tolist() == [1, 2, 3]
+
+    # feather
+    path = str(tmp_path / 'recs.arrow')
+    write_chunks_to_file(make_chunks(), path, format='feather', compression='zstd')
+    assert pd.read_feather(path).equals(df_exp)
+
+    # partitioned
+    path = str(tmp_path / 'recs_partitioned')
+    res = write_chunks_to_file(make_chunks(), path, partition_col='group')
+    assert len(res['paths']) == 2
+    df = pd.read_parquet(path)
+    assert set(df['number']) == {1, 2, 3}
+    assert df.loc[df['number'] == 3, 'group'].tolist() == ['a']
+
+    # partition values are escaped, unobserved categories get no partition
+    chunk = pd.DataFrame(dict(number=[1, 2], group=pd.Categorical(['a/..', 'b'], categories=['a/..', 'b', 'c'])))
+    res = write_chunks_to_file([chunk], str(tmp_path / 'recs_escaped'), partition_col='group')
+    assert sorted([os.path.relpath(path_, tmp_path) for path_ in res['paths']]) == \
+        [os.path.join('recs_escaped', 'group=a%2F..', 'part-0.parquet'),
+         os.path.join('recs_escaped', 'group=b', 'part-0.parquet')]
+
+def test_write_chunks_to_file_new_columns(tmp_path):
+    def make_chunks_():
+        yield pd.DataFrame(dict(number=[1]))
+        yield pd.DataFrame(dict(number=[2], text=['b']))
+
+    path = str(tmp_path / 'recs.parquet')
+    try:
+        write_chunks_to_file(make_chunks_(), path)
+        assert False
+    except ValueError:
+        pass
+
+    write_chunks_to_file(make_chunks_(), path, on_new_columns='drop')
+    assert pd.read_parquet(path)['number'].tolist() == [1, 2]
+
+def test_write_chunks_to_file_mismatch(tmp_path):
+    # values that don't fit the schema of the first chunk raise instead of being truncated
+    for chunk in [pd.DataFrame(dict(number=[2.7], text=['c'])), pd.DataFrame(dict(number=[3], text=[5]))]:
+        chunks = [pd.DataFrame(dict(number=[1, 2], text=[None, None])), chunk]
+        try:
+            write_chunks_to_file(chunks, str(tmp_path / 'recs.parquet'))
+            assert False
+        except ValueError as e:
+            assert f"column '{'number' if chunk['number'].dtype == float else 'text'}'" in str(e)
+
+    # integral floats (e.g. ints with nulls) fit
+    chunks = [pd.DataFrame(dict(number=[1, 2])), pd.DataFrame(dict(number=[3, None]))]
+    write_chunks_to_file(chunks, str(tmp_path / 'recs.parquet'))
+    assert pq.read_table(str(tmp_path / 'recs.parquet')).column('number').to_pylist() == [1, 2, 3, None]
+
+def test_read_file_chunks(tmp_path):
+    df_exp = pd.DataFrame(dict(number=list(range(10)), text=[str(i) for i in range(10)]))
+
+    for name, format in [('recs.parquet', 'parquet'), ('recs.arrow', 'feather')]:
+        path = str(tmp_path / name)
+        write_chunks_to_file([df_exp.iloc[:6], df_exp.iloc[6:]], path, format=format)
+        dfs = list(read_file_chunks(path, chunk_size=4))
+        assert max([len(df) for df in dfs]) <= 4
+        assert pd.concat(dfs, ignore_index=True).equals(df_exp)
+        dfs = list(read_file_chunks(path, columns=['text']))
+        assert pd.concat(dfs, ignore_index=True).equals(df_exp[['text']])
+
+    path = str(tmp_path / 'recs.csv.gz')
+    df_exp.to_csv(path, index=False)
+    dfs = list(read_file_chunks(path, csv_block_size=32))
+    assert len(dfs) > 1
+    df = pd.concat(dfs, ignore_index=True)
+    assert df['number'].tolist() == df_exp['number'].tolist()
+
+def test_spill_chunks_to_file(tmp_path):
+    path = str(tmp_path / 'spill.arrow')
+    df = spill_chunks_to_file(make_chunks(), path)
+    assert df['number'].tolist() == [1, 2, 3]
+    assert df['_id'].tolist() == [str(id_) for id_ in IDS]
+    assert isinstance(df['number'].dtype, pd.ArrowDtype)
+
+    table = spill_chunks_to_file(make_chunks(), path, as_arrow=True)
+    assert table.num_rows == 3 and table.column('text').to_pylist() == [None, None, 'c']
+
+    df = spill_chunks_to_file(iter([]), path)
+    assert len(df) == 0
@@ -0,0 +1,62 @@
+"""Tests for keyset pagination utils"""
+
+import datetime
+import decimal
+
+from bson import ObjectId
+
+from src.db_engines.keyset_utils import (encode_cursor_token, decode_cursor_token, make_sql_keyset_clause,
+                                         make_mongodb_keyset_filter, keyset_scan_gen)
+
+
+
+
+def test_cursor_token_round_trip():
+    key_vals = ['123', 5, 2.5, None, datetime.datetime(2020, 3, 1, 13, 5, 3, 123000), datetime.date(2020, 2, 2),
+                decimal.Decimal('1.10'), b'\x00\x01', ObjectId()]
+    token = encode_cursor_token(key_vals)
+    assert isinstance(token, str)
+    assert decode_cursor_token(token) == key_vals
+
+def test_make_sql_keyset_clause():
+    clause, params = make_sql_keyset_clause(['id_meta'], ['123'])
+    assert clause == '((id_meta > %s))'
+    assert params == ['123']
+
+    clause, params = make_sql_keyset_clause(['id_meta', 'timestamp_stats'], ['123', 5], descending=True)
+    assert clause == '((id_meta < %s) OR (id_meta = %s AND timestamp_stats < %s))'
+    assert params == ['123', '123', 5]
+
+def test_make_mongodb_keyset_filter():
+    assert make_mongodb_keyset_filter(['_id'], [5]) == {'_id': {'$gt': 5}}
+    assert (make_mongodb_keyset_filter(['number', '_id'], [3, 5], descending=True) ==
+            {'$or': [{'number': {'$lt': 3}}, {'number': 3, '_id': {'$lt': 5}}]})
+
+def test_keyset_scan_gen(tmp_path):
+    recs = list(range(10))
+
+    def fetch_page(token):
+        start = 0 if token is None else decode_cursor_token(token)[0] + 1
+        page = recs[start: start + 3]
+        return page, (encode_cursor_token([page[-1]]) if page else None), len(page)
+
+    # interrupted scan: the chunk being processed is not checkpointed
+    checkpoint = str(tmp_path / 'checkpoint.txt')
+    pages = []
+    for page in keyset_scan_gen(fetch_page, checkpoint=checkpoint):
+        if len(pages) == 2:
+            break
+        pages.append(page)
+    assert pages == [[0, 1, 2], [3, 4, 5]]
+
+    # resume from checkpoint file
+    pages += [page for page in keyset_scan_gen(fetch_page, checkpoint=checkpoint)]
+    assert pages == [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+
+    # finished scan has nothing left to deliver
+    assert [page for page in keyset_scan_gen(fetch_page, checkpoint=checkpoint)] == []
+
+    # callback checkpoint and tokens
+    tokens = []
+    res = [(page, token) for page, token in keyset_scan_gen(fetch_page, checkpoint=tokens.append, with_tokens=True)]
+    assert [token for _, token in res] == tokens
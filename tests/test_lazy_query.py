@@ -0,0 +1,91 @@
+"""Tests for lazy queries"""
+
+from src.db_engines.lazy_query import MySQLQuery, MongoDBQuery
+from src.db_engines.mysql_engine import MySQLEngine
+from tests.constants_tests import DB_MYSQL_CONFIG, DATABASES_MYSQL, DATA_INSERT_MYSQL
+from tests.test_mongodb import setup_db_and_insert_records
+from tests.test_mysql import setup_test_db
+
+
+DB_TEST = DATABASES_MYSQL['test']
+
+
+
+
+def test_mysql_query_to_sql():
+    q = MySQLQuery(None, 'db', 'stats').filter(id_meta=['a', 'b'], like_count=('>=', 5))
+    assert q.to_sql() == ("SELECT * FROM stats WHERE stats.id_meta IN (%s,%s) AND stats.like_count >= %s",
+                          ['a', 'b', 5])
+
+    # base query is unchanged by later operations
+    q2 = q.select('id_meta', 'like_count').sort('like_count', descending=True).limit(10)
+    assert q2.to_sql()[0] == ("SELECT id_meta, like_count FROM stats WHERE stats.id_meta IN (%s,%s) AND "
+                              "stats.like_count >= %s ORDER BY like_count DESC LIMIT 10")
+    assert q.to_sql()[0].startswith('SELECT * FROM stats')
+
+    q3 = q.group_by('id_meta').agg(num=('like_count', 'count'), likes=('like_count', 'sum')).filter(num=('>', 1))
+    assert q3.to_sql() == ("SELECT id_meta, COUNT(like_count) AS num, SUM(like_count) AS likes FROM stats WHERE "
+                           "stats.id_meta IN (%s,%s) AND stats.like_count >= %s GROUP BY id_meta HAVING num > %s",
+                           ['a', 'b', 5, 1])
+
+    # columns selected before agg() are replaced by the aggregated result, after agg() they select among it
+    q4 = q2.group_by('id_meta').agg(num=('like_count', 'count'))
+    assert q4.to_sql()[0].startswith("SELECT id_meta, COUNT(like_count) AS num FROM stats")
+    assert q4.select('num').to_sql()[0].startswith("SELECT COUNT(like_count) AS num FROM stats")
+    try:
+        q4.select('like_count')
+        assert False
+    except AssertionError as e:
+        assert 'like_count' in str(e)
+
+def test_mongodb_query_to_pipeline():
+    q = MongoDBQuery(None).filter(username=['a', 'b'], number=[[1, 5]])
+    assert q.to_pipeline() == [{'$match': {'$and': [{'username': {'$in': ['a', 'b']}},
+                                                     {'number': {'$gte': 1, '$lte': 5}}]}}]
+
+    q2 = q.group_by('username').agg(total=('number', 'sum')).sort('total', descending=True).limit(1)
+    assert q2.to_pipeline()[1:] == [
+        {'$group': {'_id': {'username': '$username'}, 'total': {'$sum': '$number'}}},
+        {'$project': {'_id': 0, 'username': '$_id.username', 'total': 1}},
+        {'$sort': {'total': -1}},
+        {'$limit': 1}
+    ]
+
+    assert MongoDBQuery(None).select('text').to_pipeline() == [{'$project': {'text': 1, '_id': 0}}]
+
+    q3 = MongoDBQuery(None).select('username', 'number').group_by('username').agg(total=('number', 'sum'))
+    assert q3.to_pipeline()[-1] == {'$project': {'_id': 0, 'username': '$_id.username', 'total': 1}}
+    assert q3.select('total').to_pipeline()[-1] == {'$project': {'total': 1, '_id': 0}}
+
+    # count ignores null and missing values
+    q4 = MongoDBQuery(None).agg(num=('text', 'count'))
+    assert q4.to_pipeline()[0] == {'$group': {'_id': None, 'num': {'$sum': {'$cond': [
+        {'$ne': [{'$ifNull': ['$text', None]}, None]}, 1, 0]}}}}
+
+    # group_by() without agg()
+    try:
+        MongoDBQuery(None).group_by('username').to_pipeline()
+        assert False
+    except AssertionError as e:
+        assert 'agg()' in str(e)
+
+def test_mysql_query_collect():
+    engine = MySQLEngine(DB_MYSQL_CONFIG)
+    setup_test_db(engine, inject_data=True)
+
+    recs = DATA_INSERT_MYSQL['meta']
+    df = MySQLQuery(engine, DB_TEST, 'meta').filter(id_meta=recs[0][0]).select('id_meta').collect()
+    assert df['id_meta'].tolist() == [recs[0][0]]
+
+    df = MySQLQuery(engine, DB_TEST, 'meta').agg(num=('id_meta', 'count')).collect()
+    assert df['num'].tolist() == [len(recs)]
+
+def test_mongodb_query_collect():
+    engine, data = setup_db_and_insert_records()
+
+    q = MongoDBQuery(engine).filter(number=('>=', 0)).select('number').sort('number').limit(5)
+    df = q.collect()
+    assert df['number'].tolist() == sorted([d_['number'] for d_ in data])[:5]
+
+    df = MongoDBQuery(engine).agg(num=('number', 'count')).collect()
+    assert df['num'].tolist() == [len(data)]
@@ -1,10 +1,15 @@
 """Tests for MongoDB engine and other utils"""
 
 from typing import Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import time
+import os
 
 import pandas as pd
 
-from src.db_engines.mongodb_engine import MongoDBEngine
+from src.db_engines.mongodb_engine import MongoDBEngine, _CLIENTS, _get_client_key
+from src.db_engines.dtype_utils import DtypePolicy
+from src.db_engines.exceptions import MongoDBEngineError
 from src.db_engines.mongodb_utils import get_mongodb_records_gen, load_all_recs_with_distinct
 from src.db_engines.constants import MONGODB_FIND_MANY_MAX_COUNT
 from tests.constants_tests import DB_MONGO_CONFIG, DATABASES_MONGODB, COLLECTIONS_MONGODB
@@ -82,6 +87,34 @@ def test_mongodb_engine_setup():
     engine.set_db_info('1', '2')
     assert engine.get_db_info() == ('1', '2')
 
+def test_engine_construction():
+    # no network I/O: engines for an unreachable server are constructed immediately
+    config = dict(host='10.255.255.1', port=27017)
+    t0 = time.monotonic()
+    engines = [MongoDBEngine(config, database='db', collection=str(i)) for i in range(100)]
+    assert time.monotonic() - t0 < 1.0
+
+    # engines with the same config share a client, which is closed with the last engine
+    assert all(engine._db_client is engines[0]._db_client for engine in engines)
+    for engine in engines:
+        engine.close()
+    assert (os.getpid(), _get_client_key(config)) not in _CLIENTS
+
+    # the client is released even if the caller changes the config after construction
+    engine = MongoDBEngine(config)
+    key = _get_client_key(config)
+    config['port'] = 27018
+    engine.close()
+    assert (os.getpid(), key) not in _CLIENTS
+
+    # opt-in validation
+    database = DATABASES_MONGODB['test1']
+    collection = COLLECTIONS_MONGODB[database]['test11']
+    engine = MongoDBEngine(DB_MONGO_CONFIG, database=database, collection=collection)
+    engine.insert_one({'number': 0})
+    assert MongoDBEngine(DB_MONGO_CONFIG, database=database, collection=collection, validate=True).validate_namespace()
+    assert not MongoDBEngine(DB_MONGO_CONFIG, database=database, collection='nonexistent').validate_namespace()
+
 def test_creation_and_insert_one_and_find_one_ops():
     engine = MongoDBEngine(DB_MONGO_CONFIG, verbose=True)
     reset_mongodb(engine)
@@ -134,6 +167,16 @@ def test_find_many_gen():
     d_exp = [{key: d_[key] for key in ['text']} for d_ in data if d_['number'] > 50]
     assert df_matches_with_dict(df, d_exp)
 
+    # prefetching
+    df = pd.concat([df for df in engine.find_many_gen(filter=filter, prefetch=2)], ignore_index=True)
+    d_exp = [d_ for d_ in data if d_['number'] > 50]
+    assert df_matches_with_dict(df, d_exp)
+
+    # prefetching, consumer stops early
+    df_gen = engine.find_many_gen(prefetch=1)
+    assert len(next(df_gen)) == MONGODB_FIND_MANY_MAX_COUNT
+    df_gen.close()
+
 def test_find_one():
     engine, data = setup_db_and_insert_records()
 
@@ -157,6 +200,120 @@ def test_find_one():
     rec = engine.find_one(filter=filter, projection=projection)
     assert any([rec == {key: d_[key] for key in ['text']} for d_ in data if d_['number'] > 50])
 
+def test_find_one_cache():
+    engine, data = setup_db_and_insert_records()
+    database, collection = engine.get_db_info()
+    engine = MongoDBEngine(DB_MONGO_CONFIG, database=database, collection=collection, cache_size=10)
+
+    id_ = data[0]['_id']
+    rec = engine.find_one_by_id(id_)
+    assert rec == data[0]
+    rec['number'] = -1 # callers get their own copy
+    assert engine.find_one_by_id(id_) == data[0]
+    assert engine.get_cache_stats()['num_hits'] == 1
+
+    # read your writes
+    engine.update_one({'_id': id_}, {'$set': {'number': -2}})
+    assert engine.find_one_by_id(id_)['number'] == -2
+    engine.delete_many([id_])
+    assert engine.find_one_by_id(id_) is None
+
+def test_find_read_preference():
+    engine, data = setup_db_and_insert_records()
+
+    df = engine.find_many(projection={'number': 1}, read_preference='primaryPreferred')
+    assert len(df) == len(data)
+    rec = engine.find_one_by_id(data[0]['_id'], read_preference='nearest')
+    assert rec == data[0]
+
+def test_concurrent_generators():
+    engine, data = setup_db_and_insert_records()
+    ids_exp = set([d_['_id'] for d_ in data])
+
+    # interleaved generators on the same engine
+    gen1 = engine.find_many_gen(projection={'_id': 1})
+    gen2 = engine.find_many_gen(projection={'_id': 1})
+    ids1, ids2 = [], []
+    for df1, df2 in zip(gen1, gen2):
+        ids1 += list(df1['_id'])
+        ids2 += list(df2['_id'])
+    assert set(ids1) == ids_exp and set(ids2) == ids_exp
+
+    # one engine shared by a thread pool
+    def scan(_) -> set:
+        return set([id_ for df in engine.find_many_gen(projection={'_id': 1}) for id_ in df['_id']])
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert all([ids == ids_exp for ids in executor.map(scan, range(8))])
+
+def test_query_timeout():
+    engine, data = setup_db_and_insert_records()
+    filter = {'$where': 'sleep(10) || true'} # slow server-side scan
+
+    # server stops the query at the deadline
+    t0 = time.monotonic()
+    try:
+        for _ in engine.find_many_gen(filter=filter, timeout_s=0.5):
+            pass
+        assert False
+    except MongoDBEngineError as e:
+        assert e.code == 50 # MaxTimeMSExpired
+    assert time.monotonic() - t0 < 5
+
+    # engine-level default, overridden per call
+    engine = MongoDBEngine(DB_MONGO_CONFIG, *engine.get_db_info(), query_timeout_s=0.5)
+    try:
+        engine.find_many(filter=filter)
+        assert False
+    except MongoDBEngineError as e:
+        assert e.code == 50
+    assert len(engine.find_many_by_ids(limit=5, timeout_s=10)) == 5
+
+def test_single_flight():
+    _, data = setup_db_and_insert_records()
+    database = list(DATABASES_MONGODB.values())[0]
+    collection = list(COLLECTIONS_MONGODB[database].values())[0]
+    engine = MongoDBEngine(DB_MONGO_CONFIG, database=database, collection=collection, single_flight='engine')
+
+    # concurrent identical queries share one execution
+    filter = {'$where': 'sleep(1) || true'} # slow server-side scan
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        dfs = list(executor.map(lambda _: engine.find_many(filter=filter), range(8)))
+    assert all([df_matches_with_dict(df, data) for df in dfs])
+    stats = engine.get_single_flight_stats()
+    assert stats['num_calls'] == 8 and stats['num_deduplicated'] > 0
+
+def test_dtype_policy():
+    _, data = setup_db_and_insert_records()
+    database = list(DATABASES_MONGODB.values())[0]
+    collection = list(COLLECTIONS_MONGODB[database].values())[0]
+    engine = MongoDBEngine(DB_MONGO_CONFIG, database=database, collection=collection,
+                           dtype_policy=DtypePolicy(string_dtype='string'))
+
+    # string fields get the string dtype in every chunk, low-cardinality ones are categorical in whole results
+    dfs = list(engine.find_many_gen(projection={'_id': 0}))
+    assert len(dfs) == 2
+    assert all([str(df['text'].dtype) == 'string' and df['number'].dtype == 'int64' for df in dfs])
+    df = engine.find_many(projection={'_id': 0})
+    assert isinstance(df['text_nonunique'].dtype, pd.CategoricalDtype) and str(df['text'].dtype) == 'string'
+    assert df.astype(dict(text=object, text_nonunique=object)).equals(pd.DataFrame(data)[df.columns])
+
+    # a string field with other values in a later chunk is left as objects in that chunk
+    dtypes = {}
+    engine._make_df([dict(text='a')], dtypes)
+    df = engine._make_df([dict(text=1), dict(text='b')], dtypes)
+    assert df['text'].dtype == object and df['text'][0] == 1
+    assert str(engine._make_df([dict(text='c')], dtypes)['text'].dtype) == 'string'
+
+def test_lightweight_modes():
+    engine, data = setup_db_and_insert_records()
+
+    recs = [rec for chunk in engine.find_many_gen(projection={'_id': 0}, mode='list') for rec in chunk]
+    assert recs == [{key: d_[key] for key in d_ if key != '_id'} for d_ in data]
+    recs = [rec for chunk in engine.find_many_gen(mode='records') for rec in chunk]
+    assert [(rec.id, rec.text, rec.number) for rec in recs] == [(d_['_id'], d_['text'], d_['number']) for d_ in data]
+    chunks = list(engine.aggregate_gen([{'$group': {'_id': '$text_nonunique'}}], mode='columns'))
+    assert sorted(chunks[0]['_id']) == sorted(set([d_['text_nonunique'] for d_ in data]))
+
 def test_find_many_by_ids():
     engine, data = setup_db_and_insert_records()
 
@@ -191,6 +348,75 @@ def test_find_with_group_gen():
     df = pd.concat([df_ for df_ in engine.find_distinct_gen(field, filter=filter)])
     assert set(df[field]) == set([d_['text_nonunique'] for d_ in data if d_['text_nonunique'] in cols])
 
+def test_find_page():
+    engine, data = setup_db_and_insert_records()
+
+    # default key (_id), with filter and projection
+    filter = {'number': {'$gt': 50}}
+    projection = {'_id': 0, 'text': 1}
+    dfs, token = [], None
+    while 1:
+        df, token = engine.find_page(filter=filter, projection=projection, page_size=300, cursor_token=token)
+        dfs.append(df)
+        if token is None:
+            break
+    df = pd.concat(dfs, ignore_index=True)
+    assert list(df.columns) == ['text']
+    assert set(df['text']) == set([d_['text'] for d_ in data if d_['number'] > 50])
+
+    # composite key, descending
+    dfs, token = [], None
+    while 1:
+        df, token = engine.find_page(sort_keys=['text_nonunique', 'number'], page_size=250, cursor_token=token,
+                                     descending=True)
+        dfs.append(df)
+        if token is None:
+            break
+    df = pd.concat(dfs, ignore_index=True)
+    d_exp = sorted(data, key=lambda d_: (d_['text_nonunique'], d_['number']), reverse=True)
+    assert df_matches_with_dict(df, d_exp)
+
+    # raw records, with the token of the last record even on the last page
+    recs, token = engine.find_page_records(['number'], page_size=len(data) - 1)
+    assert [rec['number'] for rec in recs] == sorted([d_['number'] for d_ in data])[:-1]
+    recs, token = engine.find_page_records(['number'], cursor_token=token, page_size=len(data))
+    assert len(recs) == 1 and token is not None
+    assert engine.find_page_records(['number'], cursor_token=token) == ([], None)
+
+def test_find_many_resumable_gen(tmp_path):
+    engine, data = setup_db_and_insert_records()
+
+    # interrupt scan after first chunk
+    checkpoint = str(tmp_path / 'checkpoint.txt')
+    dfs = []
+    for df_ in engine.find_many_resumable_gen(chunk_size=300, checkpoint=checkpoint):
+        if len(dfs) == 1:
+            break
+        dfs.append(df_)
+
+    # resume
+    dfs += [df_ for df_ in engine.find_many_resumable_gen(chunk_size=300, checkpoint=checkpoint)]
+    df = pd.concat(dfs, ignore_index=True)
+    assert len(df) == len(data)
+    assert df_matches_with_dict(df, sorted(data, key=lambda d_: d_['_id']))
+
+def test_export_records(tmp_path):
+    engine, data = setup_db_and_insert_records()
+
+    path = str(tmp_path / 'recs.arrow')
+    res = engine.export_records(path, projection={'text': 1, 'number': 1}, format='feather')
+    assert res['num_records'] == len(data)
+    df = pd.read_feather(path)
+    assert set(df['_id']) == set([str(d_['_id']) for d_ in data])
+    assert set(df['number']) == set([d_['number'] for d_ in data])
+
+def test_find_many_spill(tmp_path):
+    engine, data = setup_db_and_insert_records()
+
+    df = engine.find_many(projection={'text': 1, 'number': 1}, spill_path=str(tmp_path / 'spill.arrow'))
+    assert len(df) == len(data)
+    assert set(df['number']) == set([d_['number'] for d_ in data])
+
 def test_delete_many():
     engine, data = setup_db_and_insert_records()
 
@@ -199,15 +425,36 @@ def test_delete_many():
     ids_to_keep = list(set([d_['_id'] for d_ in data]) - set(ids_to_delete))
 
     # delete some
-    engine.delete_many(ids_to_delete)
+    assert engine.delete_many(ids_to_delete) == len(ids_to_delete)
     df = pd.concat([df_ for df_ in engine.find_many_gen()], ignore_index=True)
     assert set(ids_to_keep) == set(df['_id'])
 
+    # delete in concurrent batches
+    assert engine.delete_many(ids_to_keep[:100], batch_size=7, max_workers=4) == 100
+    assert set(engine.get_ids()) == set(ids_to_keep[100:])
+
     # delete all
     engine.delete_many({})
     ids_ = engine.get_ids()
     assert len(ids_) == 0
 
+def test_truncate():
+    engine, data = setup_db_and_insert_records()
+    database, collection = engine.get_db_info()
+    cn = engine._get_collection()
+    cn.create_index([('number', 1)], unique=True, name='number_unique')
+
+    # records deleted, indexes kept
+    engine.delete_all_records(confirm_delete='yes', truncate=True)
+    assert len(engine.get_ids()) == 0
+    assert 'number_unique' in engine._get_collection().index_information()
+
+    # all collections of a database, in parallel; duplicates aren't counted as inserted
+    assert engine.insert_many([dict(number=i) for i in range(10)] + [dict(number=0)]) == 10
+    engine.delete_all_records_in_database(database, truncate=True, max_workers=4)
+    assert len(engine.get_ids()) == 0
+    assert 'number_unique' in engine._get_collection().index_information()
+
 
 
 """ Utils """
@@ -4,12 +4,17 @@ from typing import List, Optional
 import datetime
 import os
 import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 
 from src.db_engines.mysql_engine import MySQLEngine
+from src.db_engines.dtype_utils import DtypePolicy
+from src.db_engines.exceptions import MySQLEngineError, SQLScriptError
 from src.db_engines.mysql_utils import (get_table_colnames, get_table_primary_keys, insert_records_from_dict,
-                                        update_records_from_dict)
+                                        update_records_from_dict, perform_join_mysql_query, make_sql_where_clause,
+                                        split_filters_for_in_lists)
 from tests.constants_tests import (DB_MYSQL_CONFIG, DATABASES_MYSQL, TABLENAMES_MYSQL, SCHEMA_SQL_FNAME,
                                    CMDS_INSERT_MYSQL, DATA_INSERT_MYSQL, TABLE_COLS_MYSQL, TABLE_COLS_PRI_MYSQL)
 
@@ -113,6 +118,13 @@ def test_select_records():
         assert len(dfs) == 1
         assert set(convert_df_rec_to_list(dfs[0], tablename=tablename)) == expected
 
+        # generator with prefetching
+        df_gen = engine.select_records(DB_TEST, f"SELECT * FROM {tablename}", mode='pandas', tablename=tablename,
+                                       as_generator=True, prefetch=2)
+        dfs = [df_ for df_ in df_gen]
+        assert len(dfs) == 1
+        assert set(convert_df_rec_to_list(dfs[0], tablename=tablename)) == expected
+
 # def test_execute_pure_sql():
 #     # TODO: execute_pure_sql doesn't seem to like these test cases, gives "Unread result found"
 #     if 0:
@@ -173,6 +185,254 @@ def test_select_records_with_join():
     assert set(rec_) == set([('123', 'blah', 6532)])
 
 
+def test_select_one_by_key():
+    engine = MySQLEngine(DB_MYSQL_CONFIG, cache_size=10)
+    setup_test_db(engine, inject_data=True)
+
+    rec_exp = DATA_INSERT_MYSQL['stats'][1]
+    key = dict(id_meta=rec_exp[0], timestamp_stats=rec_exp[3])
+    assert engine.get_primary_keys(DB_TEST, 'stats') == TABLE_COLS_PRI_MYSQL['stats']
+    rec = engine.select_one_by_key(DB_TEST, 'stats', key)
+    assert tuple(rec.values()) == rec_exp
+    assert engine.select_one_by_key(DB_TEST, 'stats', (rec_exp[0], rec_exp[3]), cols=['count_stats']) == \
+           dict(count_stats=rec_exp[1])
+    assert engine.select_one_by_key(DB_TEST, 'stats', key) == rec
+    assert engine.get_cache_stats()['num_hits'] == 1
+
+    # read your writes
+    engine.execute_pure_sql(DB_TEST, f"UPDATE stats SET count_stats = 1 WHERE id_meta = '{rec_exp[0]}'")
+    assert engine.select_one_by_key(DB_TEST, 'stats', key)['count_stats'] == 1
+    assert engine.select_one_by_key(DB_TEST, 'meta', 'missing') is None
+
+def test_select_by_keys():
+    engine = MySQLEngine(DB_MYSQL_CONFIG)
+    setup_test_db(engine, inject_data=True)
+
+    # composite key, input order kept, missing key flagged
+    recs = DATA_INSERT_MYSQL['stats']
+    keys = [(recs[1][0], recs[1][3]), ('missing', recs[0][3]), dict(id_meta=recs[0][0], timestamp_stats=recs[0][3])]
+    df = engine.select_by_keys(DB_TEST, 'stats', keys, cols=['count_stats'], batch_size=1, max_workers=2)
+    assert list(df.columns) == ['id_meta', 'timestamp_stats', 'count_stats', 'found']
+    assert df['found'].tolist() == [True, False, True]
+    assert df['id_meta'].tolist() == [recs[1][0], 'missing', recs[0][0]]
+    assert df.loc[df['found'], 'count_stats'].tolist() == [recs[1][1], recs[0][1]]
+
+    # DataFrame of keys
+    df_keys = pd.DataFrame(dict(id_meta=[rec[0] for rec in DATA_INSERT_MYSQL['meta']]))
+    df = engine.select_by_keys(DB_TEST, 'meta', df_keys)
+    assert set(convert_df_rec_to_list(df.drop(columns=['found']), tablename='meta')) == set(DATA_INSERT_MYSQL['meta'])
+
+def test_read_hosts():
+    engine = MySQLEngine(DB_MYSQL_CONFIG)
+    setup_test_db(engine, inject_data=True)
+
+    # unreachable replica is taken out of rotation, reads fall back to the primary
+    engine = MySQLEngine({**DB_MYSQL_CONFIG, 'read_hosts': ['127.0.0.1:1', DB_MYSQL_CONFIG['host']]})
+    for _ in range(3):
+        recs = engine.select_records(DB_TEST, 'SELECT * FROM meta')
+        assert set(recs) == set(DATA_INSERT_MYSQL['meta'])
+
+def test_transaction():
+    engine = MySQLEngine(DB_MYSQL_CONFIG)
+    setup_test_db(engine)
+    query = CMDS_INSERT_MYSQL['usernames']
+    get_usernames = lambda: set([rec[0] for rec in engine.select_records(DB_TEST, 'SELECT username FROM usernames')])
+
+    # one commit, own writes visible inside, savepoint rolls back only the inner block
+    with engine.transaction(DB_TEST) as tx:
+        engine.insert_records_to_table(DB_TEST, query, [('a',)])
+        try:
+            with engine.transaction():
+                engine.insert_records_to_table(DB_TEST, query, [('b',)])
+                assert get_usernames() == {'a', 'b'}
+                raise ValueError
+        except ValueError:
+            pass
+        engine.insert_records_to_table(DB_TEST, query, [('c',)])
+        try: # options of the outer transaction can't be overridden by a nested one
+            with engine.transaction(commit_every=2):
+                pass
+            assert False
+        except AssertionError as e:
+            assert 'outermost' in str(e)
+    assert tx.num_commits == 1
+    assert get_usernames() == {'a', 'c'}
+
+    # rollback on error
+    try:
+        with engine.transaction(DB_TEST):
+            engine.insert_records_to_table(DB_TEST, query, [('d',)])
+            raise ValueError
+    except ValueError:
+        pass
+    assert get_usernames() == {'a', 'c'}
+
+    # batched commits
+    with engine.transaction(DB_TEST, commit_every=2) as tx:
+        for username in ['e', 'f', 'g']:
+            engine.insert_records_to_table(DB_TEST, query, [(username,)])
+    assert tx.num_commits == 2
+    assert get_usernames() == {'a', 'c', 'e', 'f', 'g'}
+
+def test_query_timeout():
+    engine = MySQLEngine(DB_MYSQL_CONFIG)
+    setup_test_db(engine)
+    query = ("SELECT COUNT(*) FROM information_schema.columns a, information_schema.columns b, "
+             "information_schema.columns c")
+
+    # server stops the query at the deadline
+    t0 = time.monotonic()
+    try:
+        engine.select_records(DB_TEST, query, timeout_s=0.5)
+        assert False
+    except MySQLEngineError as e:
+        assert e.code in [3024, 1317]
+    assert time.monotonic() - t0 < 5
+
+    # engine-level default, overridden per call
+    engine = MySQLEngine(DB_MYSQL_CONFIG, query_timeout_s=0.5)
+    try:
+        engine.select_records(DB_TEST, query)
+        assert False
+    except MySQLEngineError as e:
+        assert e.code in [3024, 1317]
+    assert engine.select_records(DB_TEST, 'SELECT 1', timeout_s=10) == [(1,)]
+
+def test_single_flight():
+    engine = MySQLEngine(DB_MYSQL_CONFIG, single_flight='engine')
+    setup_test_db(engine, inject_data=True)
+
+    # concurrent identical queries share one execution
+    query = 'SELECT id_meta, SLEEP(0.5) FROM meta'
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: engine.select_records(DB_TEST, query), range(8)))
+    assert all([res == results[0] for res in results])
+    stats = engine.get_single_flight_stats()
+    assert stats['num_calls'] == 8 and stats['num_deduplicated'] > 0
+
+def test_dtype_policy():
+    engine = MySQLEngine(DB_MYSQL_CONFIG, dtype_policy=DtypePolicy(string_dtype='string', categorical_min_rows=1))
+    setup_test_db(engine, inject_data=True)
+
+    # dtypes from the schema
+    df = engine.select_records(DB_TEST, 'SELECT * FROM meta', mode='pandas', tablename='meta')
+    assert [str(dtype) for dtype in df.dtypes] == \
+           ['string', 'string', 'datetime64[ms]', 'datetime64[ms]', 'UInt16']
+    recs_exp = [(rec[0], rec[4]) for rec in DATA_INSERT_MYSQL['meta']]
+    assert convert_df_rec_to_list(df, cols=['id_meta', 'score']) == recs_exp
+
+    # low-cardinality strings of whole results are categorical
+    df = engine.select_records(DB_TEST, 'SELECT id_meta FROM stats', mode='pandas', cols=['id_meta'])
+    assert isinstance(df['id_meta'].dtype, pd.CategoricalDtype)
+
+    # chunks have the same dtypes
+    dfs = list(engine.select_records(DB_TEST, 'SELECT * FROM stats', mode='pandas', tablename='stats',
+                                     as_generator=True))
+    assert [str(dtype) for dtype in dfs[0].dtypes] == ['string', 'UInt32', 'string', 'datetime64[ms]']
+
+def test_lightweight_modes():
+    engine = MySQLEngine(DB_MYSQL_CONFIG)
+    setup_test_db(engine, inject_data=True)
+
+    query = 'SELECT id_meta, score FROM meta ORDER BY id_meta'
+    recs = engine.select_records(DB_TEST, query, mode='records')
+    assert [(rec.id_meta, rec.score) for rec in recs] == [('123', 50), ('765', 210)]
+    cols = engine.select_records(DB_TEST, query, mode='columns', cols=['id', 'score'])
+    assert cols == dict(id=['123', '765'], score=[50, 210])
+    chunks = list(engine.select_records(DB_TEST, query, mode='records', as_generator=True))
+    assert chunks[0] == recs
+
+    recs = engine.select_records_with_join(DB_TEST, 'stats', 'meta', 'stats.id_meta = meta.id_meta',
+                                           ['stats.id_meta', 'meta.score'], cols_for_df=['id_meta', 'score'],
+                                           mode='records')
+    assert [(rec.id_meta, rec.score) for rec in recs] == [('123', 50), ('123', 50)]
+
+def test_execute_sql_script(tmp_path):
+    engine = MySQLEngine(DB_MYSQL_CONFIG)
+    setup_test_db(engine)
+
+    # delimiters in strings, comments and a procedure body don't split statements
+    fpath = os.path.join(tmp_path, 'seed.sql')
+    with open(fpath, 'w') as fd:
+        fd.write("-- seed data; with a comment\n"
+                 "INSERT INTO usernames VALUES ('a;b'), ('c''d');\n"
+                 "INSERT INTO usernames VALUES (\"e\\\";\"); /* f; */\n"
+                 "DELIMITER //\n"
+                 "CREATE PROCEDURE count_usernames() BEGIN SELECT COUNT(*) FROM usernames; END //\n"
+                 "DELIMITER ;\n"
+                 "DROP PROCEDURE count_usernames;\n")
+    progress = []
+    num = engine.execute_sql_script(fpath, database=DB_TEST, progress=lambda *args: progress.append(args))
+    assert num == 4
+    assert progress[-1] == (4, os.path.getsize(fpath), os.path.getsize(fpath))
+    assert set(engine.select_records(DB_TEST, 'SELECT * FROM usernames')) == {('a;b',), ("c'd",), ('e";',)}
+
+    # errors report the line of the failing statement
+    with open(fpath, 'w') as fd:
+        fd.write("INSERT INTO usernames VALUES ('g');\n\nINSERT INTO\n  no_such_table VALUES (1);\n")
+    try:
+        engine.execute_sql_script(fpath, database=DB_TEST)
+        assert False
+    except SQLScriptError as e:
+        assert e.line_no == 3 and e.code == 1146
+
+def test_select_page():
+    engine = MySQLEngine(DB_MYSQL_CONFIG)
+    setup_test_db(engine, inject_data=True)
+
+    # composite key, one record per page
+    key_cols = ['id_meta', 'timestamp_stats']
+    recs, token = [], None
+    while 1:
+        df, token = engine.select_page(DB_TEST, 'stats', key_cols, cols=['count_stats'], page_size=1,
+                                       cursor_token=token)
+        recs += convert_df_rec_to_list(df, cols=['count_stats'])
+        if token is None:
+            break
+    assert recs == [(5454,), (6532,)]
+
+    # filter and descending order
+    recs, token = engine.select_page(DB_TEST, 'usernames', ['username'], where_clause='username != %s',
+                                     where_params=['here'], descending=True, mode='list')
+    assert recs == [('test',), ('blah',)] and token is None
+
+def test_select_records_resumable_gen():
+    engine = MySQLEngine(DB_MYSQL_CONFIG)
+    setup_test_db(engine, inject_data=True)
+
+    tokens = []
+    df_gen = engine.select_records_resumable_gen(DB_TEST, 'stats', ['id_meta', 'timestamp_stats'], chunk_size=1,
+                                                 checkpoint=tokens.append)
+    df = next(df_gen)
+    df_gen.close()
+    assert convert_df_rec_to_list(df, tablename='stats') == [DATA_INSERT_MYSQL['stats'][0]]
+    assert len(tokens) == 0 # first chunk was never finished
+
+    dfs = [df_ for df_ in engine.select_records_resumable_gen(DB_TEST, 'stats', ['id_meta', 'timestamp_stats'],
+                                                              chunk_size=1, checkpoint=tokens.append)]
+    assert len(dfs) == 2 and len(tokens) == 2
+    df_gen = engine.select_records_resumable_gen(DB_TEST, 'stats', ['id_meta', 'timestamp_stats'], chunk_size=1,
+                                                 resume_token=tokens[0])
+    assert [convert_df_rec_to_list(df_, tablename='stats') for df_ in df_gen] == [[DATA_INSERT_MYSQL['stats'][1]]]
+
+
+def test_export_records(tmp_path):
+    engine = MySQLEngine(DB_MYSQL_CONFIG)
+    setup_test_db(engine, inject_data=True)
+
+    path = str(tmp_path / 'meta.parquet')
+    res = engine.export_records(DB_TEST, 'SELECT * FROM meta', path, tablename='meta')
+    assert res['num_records'] == len(DATA_INSERT_MYSQL['meta'])
+    df = pd.read_parquet(path)
+    assert set(df['id_meta']) == set([rec[0] for rec in DATA_INSERT_MYSQL['meta']])
+
+def test_select_records_spill(tmp_path):
+    engine = MySQLEngine(DB_MYSQL_CONFIG)
+    setup_test_db(engine, inject_data=True)
+
+    df = engine.select_records(DB_TEST, 'SELECT * FROM meta', mode='pandas', tablename='meta',
+                               spill_path=str(tmp_path / 'spill.arrow'))
+    assert set(df['id_meta']) == set([rec[0] for rec in DATA_INSERT_MYSQL['meta']])
 
 
 
@@ -249,4 +509,32 @@ def test_insert_and_update_records_from_dict():
 
     assert set(recs) == set(expected)
 
+def test_perform_join_mysql_query():
+    engine = MySQLEngine(DB_MYSQL_CONFIG)
+    setup_test_db(engine, inject_data=True)
 
+    cols_all = dict(m=['id_meta', 'username'], s=['count_stats'])
+
+    # parameterized where clause
+    filters = dict(username=['blah', 'test'], count_stats=[[6000, 7000]])
+    where_clause, params = make_sql_where_clause(filters, cols_all)
+    assert where_clause == 'm.username IN (%s,%s) AND s.count_stats BETWEEN %s AND %s'
+    assert params == ['blah', 'test', 6000, 7000]
+
+    # large IN-lists are split into fixed-size chunks
+    filters_split = split_filters_for_in_lists(dict(id_meta=[str(i) for i in range(5)]), max_in_list_len=2)
+    assert [f_['id_meta'] for f_ in filters_split] == [['0', '1'], ['2', '3'], ['4', '4']]
+
+    # join query, with and without chunking
+    for max_in_list_len in [1000, 1]:
+        filters = dict(id_meta=['123', '765', "' OR 1=1 -- "])
+        df, _ = perform_join_mysql_query(DB_MYSQL_CONFIG, DB_TEST, 'meta', 'stats', 'm', 's',
+                                         'm.id_meta = s.id_meta', cols_all, filters=filters,
+                                         max_in_list_len=max_in_list_len)
+        rec_ = convert_df_rec_to_list(df, cols=['id_meta', 'username', 'count_stats'])
+        assert set(rec_) == set([('123', 'blah', 5454), ('123', 'blah', 6532)])
+
+        df_gen, _ = perform_join_mysql_query(DB_MYSQL_CONFIG, DB_TEST, 'meta', 'stats', 'm', 's',
+                                             'm.id_meta = s.id_meta', cols_all, filters=filters, limit=1,
+                                             as_generator=True, max_in_list_len=max_in_list_len)
+        assert sum([len(df_) for df_ in df_gen]) == 1
@@ -0,0 +1,47 @@
+"""Tests for background prefetching"""
+
+import threading
+import time
+
+from src.db_engines.pipeline_utils import prefetch_gen
+
+
+
+
+def test_prefetch_gen():
+    # all items in order
+    assert [i for i in prefetch_gen(range(10), max_prefetch=3)] == list(range(10))
+
+    # exception propagation
+    def gen_err():
+        yield 1
+        raise ValueError('failed')
+
+    items = []
+    try:
+        for i in prefetch_gen(gen_err()):
+            items.append(i)
+        assert False
+    except ValueError:
+        assert items == [1]
+
+def test_prefetch_gen_backpressure_and_cancellation():
+    num_produced = []
+    closed = threading.Event()
+
+    def gen():
+        try:
+            for i in range(1000):
+                num_produced.append(i)
+                yield i
+        finally:
+            closed.set()
+
+    for i in prefetch_gen(gen(), max_prefetch=2):
+        time.sleep(0.1)
+        assert len(num_produced) <= i + 4 # consumed + queued + in-flight
+        if i == 2:
+            break
+
+    assert closed.wait(timeout=2)
+    assert len(num_produced) < 10
@@ -0,0 +1,31 @@
+"""Tests for lightweight record utils"""
+
+from src.db_engines.record_utils import (get_record_type, rows_to_records, rows_to_columns, format_rows,
+                                         format_dicts)
+
+
+
+
+def test_rows_to_records():
+    recs = rows_to_records([('a', 1), ('b', 2)], ['username', 'score'])
+    assert recs == [('a', 1), ('b', 2)]
+    assert recs[0].username == 'a' and recs[1].score == 2
+
+    # types are created once per set of columns, invalid names fall back to positions
+    assert get_record_type(('username', 'score')) is type(recs[0])
+    rec = rows_to_records([(1, 5, 2)], ['_id', 'COUNT(*)', 'id'])[0]
+    assert rec._fields == ('_0', '_1', 'id') and rec[1] == 5
+    assert rows_to_records([(1, 2)], ['_id', 'x'])[0].id == 1
+
+def test_rows_to_columns():
+    assert rows_to_columns([('a', 1), ('b', 2)], ['username', 'score']) == dict(username=['a', 'b'], score=[1, 2])
+    assert rows_to_columns([], ['username']) == dict(username=[])
+    assert rows_to_columns([(1, 2, 'a')], ['id', 'id', 'username']) == dict(id=[1], _1=[2], username=['a'])
+    assert format_rows([('a',)], ['username'], 'list') == [('a',)]
+
+def test_format_dicts():
+    recs = [dict(_id=1, name='a'), dict(_id=2, number=3)]
+    assert format_dicts(recs, 'list') is recs
+    assert format_dicts(recs, 'columns') == dict(_id=[1, 2], name=['a', None], number=[None, 3])
+    rec = format_dicts(recs, 'records')[1]
+    assert (rec.id, rec.name, rec.number) == (2, None, 3)
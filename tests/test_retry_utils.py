@@ -0,0 +1,87 @@
+"""Tests for retry policy and error classification"""
+
+import mysql.connector
+from pymongo.errors import AutoReconnect, ServerSelectionTimeoutError, OperationFailure
+
+from src.db_engines.retry_utils import RetryPolicy, call_with_retries
+from src.db_engines.deadline_utils import Deadline
+from src.db_engines.mysql_engine import is_mysql_error_retryable
+from src.db_engines.mongodb_engine import is_mongodb_error_retryable
+
+
+
+
+def test_retry_policy_backoff():
+    policy = RetryPolicy(backoff_base_s=0.1, backoff_max_s=0.5, jitter=False)
+    assert [policy.get_backoff(attempt) for attempt in range(1, 6)] == [0.1, 0.2, 0.4, 0.5, 0.5]
+
+    policy = RetryPolicy(backoff_base_s=0.1, backoff_max_s=0.5)
+    assert all([0 <= policy.get_backoff(4) <= 0.5 for _ in range(100)])
+
+def test_call_with_retries():
+    policy = RetryPolicy(max_attempts=3, backoff_base_s=0)
+    calls = []
+
+    def func():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ValueError('transient')
+        return 'ok'
+
+    # succeeds on last attempt
+    assert call_with_retries(func, policy, lambda e: isinstance(e, ValueError)) == 'ok'
+    assert len(calls) == 3
+
+    # not retryable
+    calls.clear()
+    try:
+        call_with_retries(func, policy, lambda e: False)
+        assert False
+    except ValueError as e:
+        assert e.db_engine_attempts == 1
+
+    # attempts exhausted
+    calls.clear()
+    try:
+        call_with_retries(func, RetryPolicy(max_attempts=2, backoff_base_s=0), lambda e: True)
+        assert False
+    except ValueError as e:
+        assert e.db_engine_attempts == 2
+
+def test_call_with_retries_deadline():
+    def func():
+        raise ValueError('transient')
+
+    # no retry once the backoff would pass the deadline
+    policy = RetryPolicy(max_attempts=10, backoff_base_s=0.2, jitter=False)
+    try:
+        call_with_retries(func, policy, lambda e: True, deadline=Deadline(0.5))
+        assert False
+    except ValueError as e:
+        assert e.db_engine_attempts == 2 # backoffs of 0.2 s, then 0.4 s which would pass the deadline
+
+    deadline = Deadline(0.05)
+    assert 1 <= deadline.remaining_ms() <= 50 and not deadline.expired()
+    assert Deadline.from_timeout(None) is None
+
+def test_mysql_error_classification():
+    policy = RetryPolicy()
+    deadlock = mysql.connector.errors.DatabaseError(errno=1213)
+    lock_wait_timeout = mysql.connector.errors.DatabaseError(errno=1205)
+    lost_connection = mysql.connector.errors.OperationalError(errno=2013)
+    syntax_error = mysql.connector.errors.ProgrammingError(errno=1064)
+
+    assert is_mysql_error_retryable(deadlock, False, policy)
+    assert is_mysql_error_retryable(lock_wait_timeout, True, policy)
+    assert not is_mysql_error_retryable(lock_wait_timeout, False, policy)
+    assert is_mysql_error_retryable(lost_connection, True, policy)
+    assert not is_mysql_error_retryable(lost_connection, False, policy)
+    assert is_mysql_error_retryable(lost_connection, False, RetryPolicy(retry_writes=True))
+    assert not is_mysql_error_retryable(syntax_error, True, policy)
+
+def test_mongodb_error_classification():
+    policy = RetryPolicy()
+    assert is_mongodb_error_retryable(AutoReconnect('connection reset'), True, policy)
+    assert not is_mongodb_error_retryable(AutoReconnect('connection reset'), False, policy)
+    assert not is_mongodb_error_retryable(ServerSelectionTimeoutError('no primary'), True, policy)
+    assert not is_mongodb_error_retryable(OperationFailure('bad query', code=2), True, policy)
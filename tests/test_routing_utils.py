@@ -0,0 +1,35 @@
+"""Tests for read routing utils"""
+
+import time
+
+from src.db_engines.routing_utils import HostSelector
+
+
+
+
+def test_host_selector_round_robin():
+    selector = HostSelector(['a', 'b', 'c'], cooldown_s=0.05)
+    assert [selector.choose() for _ in range(4)] == ['a', 'b', 'c', 'a']
+
+    # failed hosts are skipped during the cooldown
+    selector.mark_failed('b')
+    assert set([selector.choose() for _ in range(6)]) == {'a', 'c'}
+    time.sleep(0.1)
+    assert 'b' in set([selector.choose() for _ in range(3)])
+
+    for host in ['a', 'b', 'c']:
+        selector.mark_failed(host)
+    assert selector.choose() is None
+
+def test_host_selector_lag():
+    lags = dict(a=1.0, b=100.0, c=None)
+    num_checks = []
+
+    def get_lag(host: str):
+        num_checks.append(host)
+        return lags[host]
+
+    selector = HostSelector(['a', 'b', 'c'], max_lag_s=10.0, get_lag=get_lag, lag_check_interval_s=60.0)
+    assert set([selector.choose() for _ in range(6)]) == {'a'}
+    assert sorted(num_checks) == ['a', 'b', 'c'] # lags are checked once per interval
+    assert selector.get_lag('b') == 100.0
@@ -0,0 +1,96 @@
+"""Tests for single-flight utils"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.db_engines.singleflight_utils import SingleFlight, make_single_flight
+
+
+
+
+def test_single_flight():
+    sf = SingleFlight()
+    num_runs = []
+    started = threading.Event()
+
+    def func():
+        num_runs.append(1)
+        started.set()
+        time.sleep(0.2)
+        return [1, 2]
+
+    # concurrent calls share one execution, each gets its own copy
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        futures = [executor.submit(sf.do, 'a', func)]
+        started.wait()
+        futures += [executor.submit(sf.do, 'a', func) for _ in range(4)]
+        results = [future.result() for future in futures]
+    assert len(num_runs) == 1
+    assert all([res == [1, 2] for res in results])
+    assert len(set([id(res) for res in results])) == 5
+    assert sf.get_stats() == dict(num_calls=5, num_executions=1, num_deduplicated=4, num_in_flight=0)
+
+    # later calls run again
+    assert sf.do('a', func) == [1, 2] and len(num_runs) == 2
+
+def test_single_flight_error():
+    sf = SingleFlight()
+    started = threading.Event()
+
+    def func():
+        started.set()
+        time.sleep(0.2)
+        raise ValueError('failed')
+
+    def call():
+        try:
+            sf.do('a', func)
+            return None
+        except ValueError as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [executor.submit(call)]
+        started.wait()
+        futures += [executor.submit(call) for _ in range(2)]
+        errors = [future.result() for future in futures]
+    assert all([isinstance(e, ValueError) for e in errors])
+    assert sf.get_stats()['num_executions'] == 1
+
+def test_single_flight_invalidate():
+    sf = SingleFlight()
+    num_runs = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def func():
+        num_runs.append(1)
+        started.set()
+        release.wait()
+        return len(num_runs)
+
+    # after a write, later calls don't join the execution that started before it
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(sf.do, ('db1', 'a'), func)]
+        started.wait()
+        futures.append(executor.submit(sf.do, ('db1', 'a'), func)) # joins
+        while sf.get_stats()['num_deduplicated'] == 0:
+            time.sleep(0.01)
+        sf.invalidate_where(lambda key: key[0] == 'db2')
+        assert sf.get_stats()['num_in_flight'] == 1
+        sf.invalidate_where(lambda key: key[0] == 'db1')
+        assert sf.get_stats()['num_in_flight'] == 0
+        started.clear()
+        futures.append(executor.submit(sf.do, ('db1', 'a'), func)) # runs again
+        started.wait()
+        release.set()
+        results = [future.result() for future in futures]
+    assert len(num_runs) == 2
+    assert results[0] == results[1] and results[2] == 2
+    assert sf.get_stats() == dict(num_calls=3, num_executions=2, num_deduplicated=1, num_in_flight=0)
+
+def test_make_single_flight():
+    assert make_single_flight(None) is None
+    assert make_single_flight('engine') is not make_single_flight('engine')
+    assert make_single_flight('process') is make_single_flight('process')
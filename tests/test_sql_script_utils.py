@@ -0,0 +1,47 @@
+"""Tests for SQL script utils"""
+
+from src.db_engines.sql_script_utils import split_sql_statements, batch_sql_statements, SQLStatement
+
+
+SCRIPT = """-- schema; with a comment
+CREATE TABLE t (
+    a VARCHAR(10) DEFAULT 'x;y', # another; comment
+    `b;c` INT
+);
+/* block; comment */
+INSERT INTO t VALUES ('it''s;', 1), ("q\\";", 2), ('back\\\\', 3);
+SELECT 1--1;
+/*!40101 SET NAMES utf8 */;
+DELIMITER //
+CREATE PROCEDURE p() BEGIN SELECT 1; SELECT 2; END //
+DELIMITER ;
+SELECT 'multi
+line;' FROM t
+"""
+
+
+
+
+def test_split_sql_statements():
+    statements = list(split_sql_statements(SCRIPT.splitlines(keepends=True)))
+    assert [s.line_no for s in statements] == [2, 7, 8, 9, 11, 13]
+    assert [s.delimiter for s in statements] == [';', ';', ';', ';', '//', ';']
+
+    texts = [s.text for s in statements]
+    assert texts[0].startswith('CREATE TABLE t (') and "'x;y'" in texts[0] and '`b;c` INT' in texts[0]
+    assert 'another' not in texts[0]
+    assert texts[1] == """INSERT INTO t VALUES ('it''s;', 1), ("q\\";", 2), ('back\\\\', 3)"""
+    assert texts[2] == 'SELECT 1--1'
+    assert texts[3] == '/*!40101 SET NAMES utf8 */'
+    assert texts[4] == 'CREATE PROCEDURE p() BEGIN SELECT 1; SELECT 2; END'
+    assert texts[5] == "SELECT 'multi\nline;' FROM t"
+
+    # comments and whitespace alone aren't statements
+    assert list(split_sql_statements(['-- nothing\n', '/* here */;\n', '\n'])) == []
+
+def test_batch_sql_statements():
+    statements = [SQLStatement('a' * 10, i) for i in range(5)]
+    statements.insert(2, SQLStatement('p', 5, delimiter='//'))
+    batches = list(batch_sql_statements(statements, max_batch_bytes=25))
+    assert [[s.text for s in batch] for batch in batches] == \
+           [['a' * 10] * 2, ['p'], ['a' * 10] * 2, ['a' * 10]]
@@ -0,0 +1,52 @@
+"""Tests for MongoDB-to-MySQL sync"""
+
+from src.db_engines.mongodb_engine import MongoDBEngine
+from src.db_engines.mysql_engine import MySQLEngine
+from src.db_engines.sync_utils import sync_mongodb_to_mysql, map_record_to_row
+from tests.constants_tests import DB_MONGO_CONFIG, DB_MYSQL_CONFIG, DATABASES_MYSQL
+from tests.test_mongodb import setup_db_and_insert_records
+from tests.test_mysql import setup_test_db
+
+
+DB_TEST = DATABASES_MYSQL['test']
+
+TABLE_SYNC_QUERY = """
+    CREATE TABLE IF NOT EXISTS synced (
+        id VARCHAR(24) PRIMARY KEY,
+        text VARCHAR(100),
+        number INT
+    )
+"""
+
+COLUMN_MAP = dict(id='_id', text='text', number='number')
+
+
+
+
+def test_map_record_to_row():
+    rec = {'_id': 'a', 'info': {'count': 3}}
+    column_map = dict(id='_id', count='info.count', missing='other', doubled=lambda rec_: 2 * rec_['info']['count'])
+    assert map_record_to_row(rec, column_map, list(column_map)) == ('a', 3, None, 6)
+
+def test_sync_mongodb_to_mysql(tmp_path):
+    mongo_engine, data = setup_db_and_insert_records()
+    mysql_engine = MySQLEngine(DB_MYSQL_CONFIG)
+    setup_test_db(mysql_engine)
+    mysql_engine.create_tables(DB_TEST, TABLE_SYNC_QUERY)
+
+    # initial sync
+    checkpoint = str(tmp_path / 'checkpoint.txt')
+    stats = sync_mongodb_to_mysql(mongo_engine, mysql_engine, DB_TEST, 'synced', COLUMN_MAP, ['id'],
+                                  checkpoint=checkpoint, batch_size=300)
+    assert stats['num_upserted'] == len(data)
+    recs = mysql_engine.select_records(DB_TEST, 'SELECT id, text, number FROM synced')
+    assert set(recs) == set([(str(d_['_id']), d_['text'], d_['number']) for d_ in data])
+
+    # only new records move on the next sync
+    recs_new = [{'text': 'new' + str(i), 'number': -i, 'text_nonunique': 'new'} for i in range(10)]
+    mongo_engine.insert_many(recs_new)
+    stats = sync_mongodb_to_mysql(mongo_engine, mysql_engine, DB_TEST, 'synced', COLUMN_MAP, ['id'],
+                                  checkpoint=checkpoint, batch_size=300)
+    assert stats['num_upserted'] == len(recs_new)
+    recs = mysql_engine.select_records(DB_TEST, 'SELECT COUNT(*) FROM synced')
+    assert recs[0][0] == len(data) + len(recs_new)